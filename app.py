@@ -1,25 +1,129 @@
+import base64
+import csv
+import hashlib
+import gzip
+import io
+import json
+import logging
+import math
+import mimetypes
 import os
+import random
+import re
+import secrets
+import shutil
+import signal
+import socket
 import sqlite3
-from datetime import datetime
-from functools import wraps
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+import zipfile
+import zlib
+from collections import Counter, OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
 from pathlib import Path
 
+import click
 from flask import (
     Flask,
+    before_render_template,
+    current_app,
     flash,
+    g,
+    has_app_context,
+    has_request_context,
     redirect,
     render_template,
     request,
+    send_from_directory,
     session,
+    stream_template,
+    stream_with_context,
+    template_rendered,
     url_for,
 )
+from jinja2 import FileSystemBytecodeCache, pass_context
+from markupsafe import Markup, escape
+from werkzeug.datastructures import FileStorage
 from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, run_simple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; uploads are then served as-is
+    Image = ImageOps = None
+
+try:
+    import fcntl
+except ImportError:  # Windows: frozen pages are written without a cross-process lock
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; gzip variants are always built
+    brotli = None
+
+logger = logging.getLogger(__name__)
 
 BASE_DIR = Path(__file__).resolve().parent
-DATABASE_PATH = BASE_DIR / "site.db"
-UPLOAD_FOLDER = BASE_DIR / "static" / "uploads"
+DATABASE_PATH = Path(os.environ.get("SITE_DB_PATH", BASE_DIR / "site.db"))
+STATIC_FOLDER = BASE_DIR / "static"
+UPLOAD_FOLDER = STATIC_FOLDER / "uploads"
+UPLOAD_URL_PREFIX = "/static/uploads"
+UPLOAD_CHUNK_SIZE = 64 * 1024
+ORPHAN_GRACE_SECONDS = 60 * 60
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
+RESIZABLE_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+
+# SQLite tuning: WAL lets readers proceed while an admin write is in flight,
+# and the busy timeout makes writers wait for the lock instead of failing.
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_STATEMENT_CACHE_SIZE = 256
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", SQLITE_BUSY_TIMEOUT_MS),
+    ("cache_size", -16 * 1024),  # negative = KiB, i.e. 16MB page cache
+    ("mmap_size", 64 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+)
+# Tenant databases are small and numerous, so each connection gets a much
+# smaller private page cache; the OS page cache is shared anyway.
+TENANT_SQLITE_PRAGMAS = (("cache_size", -2 * 1024),)
+TENANT_CONNECTIONS_PER_THREAD = 16
+TENANT_NAME_PATTERN = re.compile(r"^[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?(?:\.[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?)*$")
+ASSET_BUILD_DIR = "dist"
+ASSET_SKIP_DIRS = {"uploads", ASSET_BUILD_DIR}
+ASSET_MANIFEST = "manifest.json"
+ICON_SPRITE_STEM = "icons"
+COMPRESSIBLE_SUFFIXES = {".css", ".js", ".svg"}
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+HASHED_UPLOAD_PATTERN = re.compile(r"^uploads/[0-9a-f]{64}(-\d+)?\.\w+$")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_CACHE_MAX_ENTRIES = 256
+ANNOUNCEMENTS_PAGE_SIZE = 10
+TOP_ANNOUNCEMENTS_LIMIT = 6
+GALLERY_PAGE_SIZE = 24
+# Gallery rows are ordered by sparse integer ranks; new uploads go on top.
+GALLERY_RANK_STEP = 1024
+GALLERY_ORDER = "display_order, created_at DESC, id DESC"
+GALLERY_TOP_RANK = (
+    f"(SELECT COALESCE(MIN(display_order), {GALLERY_RANK_STEP}) - {GALLERY_RANK_STEP}"
+    " FROM gallery_images)"
+)
+ADMIN_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+PAGE_CACHE_MAX_ENTRIES = 128
+SEARCH_PAGE_SIZE = 10
+SEARCH_MAX_TERMS = 8
 
 
 def create_app() -> Flask:
@@ -28,25 +132,917 @@ def create_app() -> Flask:
         SECRET_KEY=os.environ.get("SECRET_KEY", "change-this-secret"),
         UPLOAD_FOLDER=str(UPLOAD_FOLDER),
         MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 16MB upload limit
+        PAGE_CACHE_MAX_AGE=int(os.environ.get("PAGE_CACHE_MAX_AGE", 0)),
+        ASSET_FINGERPRINTING=os.environ.get("ASSET_FINGERPRINTING", "1") != "0",
+        AUTO_MIGRATE=os.environ.get("AUTO_MIGRATE", "1") != "0",
+        SLOW_REQUEST_MS=int(os.environ.get("SLOW_REQUEST_MS", 500)),
+        FREEZE_PAGES=os.environ.get("FREEZE_PAGES", "0") == "1",
+        FREEZE_FOLDER=os.environ.get("FREEZE_FOLDER", str(BASE_DIR / "frozen")),
+        PURGE_WEBHOOK_URL=os.environ.get("PURGE_WEBHOOK_URL"),
+        # Bearer token for /api/changes; admin sessions are accepted as well.
+        CHANGE_FEED_TOKEN=os.environ.get("CHANGE_FEED_TOKEN"),
+        TENANTS_FOLDER=os.environ.get("TENANTS_FOLDER"),
+        QUERY_CACHE_ENTRIES=int(os.environ.get("QUERY_CACHE_ENTRIES", QUERY_CACHE_MAX_ENTRIES)),
+        PAGE_CACHE_ENTRIES=int(os.environ.get("PAGE_CACHE_ENTRIES", PAGE_CACHE_MAX_ENTRIES)),
+        # None selects Jinja's private per-user directory under the temp dir.
+        TEMPLATE_CACHE_FOLDER=os.environ.get("TEMPLATE_CACHE_FOLDER"),
+        PASSWORD_HASH_METHOD=os.environ.get("PASSWORD_HASH_METHOD", "scrypt"),
+        # Job threads a process starts on its first enqueue; serve() sets 0 in
+        # its web workers because its own job process runs the queue.
+        JOB_WORKERS=int(os.environ.get("JOB_WORKERS", JOB_WORKER_THREADS)),
+        COMPRESS_RESPONSES=os.environ.get("COMPRESS_RESPONSES", "1") != "0",
+        STREAM_TEMPLATES=os.environ.get("STREAM_TEMPLATES", "0") == "1",
+        CRITICAL_CSS=os.environ.get("CRITICAL_CSS", "1") != "0",
+        EARLY_HINTS=os.environ.get("EARLY_HINTS", "0") == "1",
+        ICON_SOURCE_FOLDER=os.environ.get("ICON_SOURCE_FOLDER"),
     )
+    if app.config["TEMPLATE_CACHE_FOLDER"]:
+        os.makedirs(app.config["TEMPLATE_CACHE_FOLDER"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config["TEMPLATE_CACHE_FOLDER"])
+    query_cache.max_entries = app.config["QUERY_CACHE_ENTRIES"]
+    page_cache.max_entries = app.config["PAGE_CACHE_ENTRIES"]
+
+    if not app.config["TENANTS_FOLDER"]:
+        # Tenant databases are opened and migrated on their first request.
+        os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+        init_db(auto_migrate=app.config["AUTO_MIGRATE"])
 
-    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-    init_db()
+    app.extensions["asset_manifest"] = (
+        build_static_assets(Path(app.static_folder))
+        if app.config["ASSET_FINGERPRINTING"]
+        else {}
+    )
 
+    app.teardown_appcontext(release_db_connection)
+    register_tenants(app)
+    register_compression(app)
+    register_render_path(app)
+    register_instrumentation(app)
     register_routes(app)
+    register_commands(app)
+    precompile_templates(app)
+    if app.config["PURGE_WEBHOOK_URL"]:
+        register_purge_hook(app, webhook_purge_hook(app.config["PURGE_WEBHOOK_URL"]))
+    if app.config["FREEZE_PAGES"] and not app.config["TENANTS_FOLDER"]:
+        # Templates or code may have changed since the last run, so every
+        # page is rewritten once at startup regardless of its stamp.
+        freeze_pages(app, force=True)
     return app
 
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
+# Static asset pipeline
+#
+# At startup every file under static/ (except uploads) is minified, named
+# after its content hash under static/dist/ and given .gz / .br siblings.
+# url_for('static', ...) is rewritten to the fingerprinted name, and those
+# URLs are served with the best precompressed variant and an immutable
+# Cache-Control header, so a deploy changes URLs instead of going stale.
+# dist/manifest.json records each source's size and mtime, so unchanged
+# files are not read or minified again. When the build changes, files from
+# the build before it are kept (pages and workers from the previous deploy
+# still link to them) and anything older is pruned.
+
+def minify_css(text: str) -> str:
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{};,>])\s*", r"\1", text)
+    text = re.sub(r":\s+", ":", text)
+    return text.replace(";}", "}").strip()
+
+
+JS_REGEX_PRECEDERS = set("(,=:[!&|?{};+-*%<>~^")
+JS_REGEX_KEYWORDS = {
+    "return", "typeof", "instanceof", "in", "of", "new", "delete", "void",
+    "throw", "case", "do", "else", "yield", "await",
+}
+
+
+def _js_regex_can_start(text: str, index: int, last: str) -> bool:
+    # A slash opens a regex literal where an operand is expected: at the
+    # start, after an operator or opening bracket, or after a keyword.
+    if not last or last in JS_REGEX_PRECEDERS:
+        return True
+    word = re.search(r"(?<![\w$.])([a-z]+)\s*$", text[max(0, index - 16) : index])
+    return word is not None and word.group(1) in JS_REGEX_KEYWORDS
+
+
+def _js_line_modes(text: str) -> list[tuple[str | None, str | None]] | None:
+    # A lexer just good enough to tell, for each line, what it starts and
+    # ends in: code (None), a comment ("//", "/*"), a string or a template
+    # literal. Returns None whenever it loses track, e.g. at an unterminated
+    # literal or a regex literal that runs to the end of the line.
+    modes = []
+    mode, start = None, None
+    templates: list[int] = []  # open braces inside each ${ ... }
+    last = ""  # last significant code character
+    i, length = 0, len(text)
+    while i < length:
+        char = text[i]
+        following = text[i + 1] if i + 1 < length else ""
+        if char == "\n":
+            if mode in ("'", '"'):
+                return None
+            if mode == "//":
+                mode = None
+            modes.append((start, mode))
+            start = mode
+        elif mode is None:
+            if char in "'\"`":
+                mode = char
+            elif char == "/" and following in ("/", "*"):
+                mode = "/" + following
+                i += 1
+            elif char == "/" and _js_regex_can_start(text, i, last):
+                i += 1
+                in_class = False
+                while i < length and (text[i] != "/" or in_class):
+                    if text[i] == "\n":
+                        return None
+                    if text[i] == "\\":
+                        i += 1
+                    elif text[i] in "[]":
+                        in_class = text[i] == "["
+                    i += 1
+                if i >= length:
+                    return None
+                last = ")"  # a regex is an operand: a / after it divides
+            else:
+                if char == "{" and templates:
+                    templates[-1] += 1
+                elif char == "}" and templates:
+                    if templates[-1]:
+                        templates[-1] -= 1
+                    else:
+                        templates.pop()
+                        mode = "`"
+                if not char.isspace():
+                    last = char
+        elif mode in ("'", '"', "`"):
+            if char == "\\":
+                i += 1
+                if following == "\n":
+                    modes.append((start, mode))
+                    start = mode
+            elif char == mode:
+                mode, last = None, char
+            elif mode == "`" and char == "$" and following == "{":
+                templates.append(0)
+                mode, last = None, "{"
+                i += 1
+        elif mode == "/*" and char == "*" and following == "/":
+            mode = None
+            i += 1
+        i += 1
+    if mode not in (None, "//") or templates:
+        return None
+    modes.append((start, None))
+    return modes
+
+
+def minify_js(text: str) -> str:
+    # Conservative: only indentation, blank lines and whole-line comments,
+    # and only where the lexer vouches that a line starts (or ends) outside
+    # strings and template literals. Anything it cannot follow is left as is.
+    modes = _js_line_modes(text)
+    if modes is None:
+        return text
+    kept = []
+    for line, (start, end) in zip(text.split("\n"), modes):
+        if start in (None, "/*"):
+            line = line.lstrip()
+        if end in (None, "//", "/*"):
+            line = line.rstrip()
+        if start in (None, "/*") and not line:
+            continue
+        if start is None and line.startswith("//"):
+            continue
+        kept.append(line)
+    return "\n".join(kept)
+
+
+def minify_svg(text: str) -> str:
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.S)
+    return re.sub(r">\s+<", "><", text).strip()
+
+
+ASSET_MINIFIERS = {".css": minify_css, ".js": minify_js, ".svg": minify_svg}
+
+
+def _write_atomic(target: Path, data: bytes) -> None:
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(prefix=f".{target.name}.", dir=target.parent)
+    with os.fdopen(fd, "wb") as out:
+        out.write(data)
+    os.replace(temp_name, target)
+
+
+def _write_precompressed(target: Path, data: bytes) -> None:
+    # .gz / .br siblings are only kept when they are actually smaller.
+    gzipped = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(gzipped) < len(data):
+        _write_atomic(target.with_name(target.name + ".gz"), gzipped)
+    if brotli is not None:
+        compressed = brotli.compress(data, quality=11)
+        if len(compressed) < len(data):
+            _write_atomic(target.with_name(target.name + ".br"), compressed)
+
+
+def read_asset_manifest(build_folder: Path) -> dict:
+    try:
+        recorded = json.loads((build_folder / ASSET_MANIFEST).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return recorded if isinstance(recorded, dict) else {}
+
+
+def prune_built_assets(static_folder: Path, keep: set[str]) -> list[Path]:
+    removed = []
+    for path in (static_folder / ASSET_BUILD_DIR).rglob("*"):
+        # Dot files are temporary files another process is still writing;
+        # icon sprites are built separately and are not in the manifest.
+        if not path.is_file() or path.name.startswith(".") or path.name == ASSET_MANIFEST:
+            continue
+        built = path.relative_to(static_folder).as_posix()
+        if path.parent.name == ASSET_BUILD_DIR and path.name.startswith(ICON_SPRITE_STEM + "."):
+            continue
+        for suffix in (".gz", ".br"):
+            built = built.removesuffix(suffix)
+        if built not in keep:
+            path.unlink(missing_ok=True)
+            removed.append(path)
+    return removed
+
+
+def build_static_assets(static_folder: Path) -> dict[str, str]:
+    build_folder = static_folder / ASSET_BUILD_DIR
+    recorded = read_asset_manifest(build_folder)
+    known = recorded.get("sources", {})
+    sources = {}
+    for source in sorted(static_folder.rglob("*")):
+        relative = source.relative_to(static_folder)
+        if not source.is_file() or relative.parts[0] in ASSET_SKIP_DIRS:
+            continue
+        if source.name.startswith("."):
+            continue
+        stat = source.stat()
+        entry = known.get(relative.as_posix())
+        if (
+            isinstance(entry, dict)
+            and entry.get("mtime_ns") == stat.st_mtime_ns
+            and entry.get("size") == stat.st_size
+            and (static_folder / str(entry.get("built"))).is_file()
+        ):
+            sources[relative.as_posix()] = entry
+            continue
+        data = source.read_bytes()
+        minify = ASSET_MINIFIERS.get(source.suffix)
+        if minify is not None:
+            data = minify(data.decode("utf-8")).encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        built = Path(ASSET_BUILD_DIR, relative.parent, f"{source.stem}.{digest}{source.suffix}")
+        target = static_folder / built
+        if not target.exists():
+            # Workers may race here; the content is identical so last write wins.
+            _write_atomic(target, data)
+            if source.suffix in COMPRESSIBLE_SUFFIXES:
+                _write_precompressed(target, data)
+        sources[relative.as_posix()] = {
+            "built": built.as_posix(),
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+        }
+    if sources != known:
+        current = {entry["built"] for entry in sources.values()}
+        earlier = {entry.get("built") for entry in known.values() if isinstance(entry, dict)}
+        # Touched but identical sources do not make a new build.
+        previous = set(recorded.get("previous", [])) if earlier == current else earlier - current
+        _write_atomic(
+            build_folder / ASSET_MANIFEST,
+            json.dumps({"sources": sources, "previous": sorted(previous)}).encode("utf-8"),
+        )
+        # Without an earlier manifest there is no telling which files the
+        # running deploy links to, so the first build leaves them alone.
+        if recorded:
+            prune_built_assets(static_folder, current | previous)
+    return {relative: entry["built"] for relative, entry in sources.items()}
+
+
+def serve_static_file(app: Flask, filename: str):
+    static_folder = Path(app.static_folder)
+    if filename.startswith(ASSET_BUILD_DIR + "/"):
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            if encoding in request.accept_encodings and (static_folder / (filename + suffix)).is_file():
+                response = send_from_directory(
+                    static_folder,
+                    filename + suffix,
+                    mimetype=mimetypes.guess_type(filename)[0],
+                    max_age=IMMUTABLE_MAX_AGE,
+                )
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_from_directory(static_folder, filename, max_age=IMMUTABLE_MAX_AGE)
+        response.vary.add("Accept-Encoding")
+    elif HASHED_UPLOAD_PATTERN.match(filename):
+        response = send_from_directory(
+            tenant_upload_folder(), filename.split("/", 1)[1], max_age=IMMUTABLE_MAX_AGE
+        )
+    elif filename.startswith("uploads/"):
+        return send_from_directory(tenant_upload_folder(), filename.split("/", 1)[1])
+    else:
+        return app.send_static_file(filename)
+    response.cache_control.immutable = True
+    return response
+
+
+# Templates
+#
+# Every template is compiled once at startup, before serve() forks, and the
+# compiled code also lands in a FileSystemBytecodeCache that survives
+# restarts, so a fresh worker never parses Jinja on its first request. The
+# site header and footer depend only on the active page and the year: they
+# are rendered through fragment() once per combination and reused as Markup.
+
+NAV_LINKS = (
+    ("ホーム", "main.top"),
+    ("アクセス", "main.access"),
+    ("予約", "main.reservations"),
+    ("ギャラリー", "main.gallery"),
+    ("ストーリー", "main.about"),
+    ("ハイライト", "main.features"),
+    ("検索", "main.search"),
+)
+
+_fragments: dict[tuple, Markup] = {}
+
+
+def precompile_templates(app: Flask) -> int:
+    names = [name for name in app.jinja_env.list_templates() if name.endswith(".html")]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def render_fragment(app: Flask, name: str) -> Markup:
+    active = request.endpoint if has_request_context() else None
+    year = time.gmtime().tm_year
+    key = (name, active, year, request.script_root if has_request_context() else "")
+    fragment = _fragments.get(key)
+    if fragment is None:
+        fragment = Markup(
+            app.jinja_env.get_template(name).render(
+                active_endpoint=active, year=year, nav_links=NAV_LINKS
+            )
+        )
+        # With auto-reload on (debug) edits to the partials must show up.
+        if not app.jinja_env.auto_reload:
+            _fragments[key] = fragment
+    return fragment
+
+
+# Render path
+#
+# Nothing in <head> blocks first paint. At startup the rules of site.css
+# that can style the part of each public page above the fold (the layout
+# before <main>, the header, and the page up to its first flush point or
+# </section>) are picked by matching selectors against the tags, classes,
+# ids and attributes written in those template sources, and inlined per
+# template through critical_css(). The full stylesheet and the web fonts
+# are preloaded and applied once they arrive. Each public page's preload
+# and preconnect <link>s are repeated as Link headers and remembered per
+# path, so streamed pages and, with EARLY_HINTS=1, a 103 response sent by
+# serve() before the view runs can announce them too.
+#
+# With ICON_SOURCE_FOLDER pointing at Font Awesome Free's svgs/ directory,
+# icon() draws from a sprite built at startup that holds only the icons
+# named in templates and in features.icon; an icon added later is inlined
+# from the source folder until the next start. Without it, icon() falls
+# back to <i> tags and the Font Awesome stylesheet is loaded asynchronously.
+
+CRITICAL_STYLESHEET = "css/site.css"
+CRITICAL_LAYOUT = ("site/base.html", "<main>")
+CRITICAL_PARTIALS = ("site/_header.html",)
+CRITICAL_FOLD_MARKS = ("flush_point()", "</section>")
+# Classes that only scripts or icon() put on above-the-fold elements.
+CRITICAL_RUNTIME_CLASSES = frozenset({"js", "in-view", "hide", "open", "icon"})
+# Interaction states cannot apply before first paint.
+CRITICAL_SKIP_PSEUDO = re.compile(r":(?:hover|focus|focus-visible|focus-within|active|visited)\b")
+SELECTOR_COMBINATOR = re.compile(r"\s*[>+~]\s*|\s+")
+SELECTOR_PSEUDO = re.compile(r"::?[\w-]+(?:\([^)]*\))?")
+SELECTOR_PART = re.compile(r"([.#]?)([\w-]+)|\[([\w-]+)[^\]]*\]")
+ANIMATION_NAMES = re.compile(r"animation(?:-name)?:([^;}]+)")
+LINK_HINT_ENTRIES = 256
+LINK_HINT_TAG = re.compile(r"<link\s[^>]*\brel=\"(?:preload|preconnect)\"[^>]*>")
+LINK_HINT_ATTRIBUTE = re.compile(r'([\w-]+)(?:="([^"]*)")?')
+LINK_HINT_PARAMS = ("rel", "as", "type", "crossorigin", "fetchpriority")
+ICON_STYLES = {"fas": "solid", "far": "regular", "fab": "brands"}
+ICON_NAME_PATTERN = re.compile(r"^[a-z0-9]+(?:-[a-z0-9]+)*$")
+ICON_CALL = re.compile(r"""\bicon\(\s*['"]([\w -]+)['"](?:\s*,\s*['"](fa[srb])['"])?""")
+
+PageVocabulary = namedtuple("PageVocabulary", "tags classes ids attributes")
+IconSprite = namedtuple("IconSprite", "path symbols")
+
+_link_hints: OrderedDict[tuple[str, str], str] = OrderedDict()
+_link_hints_lock = threading.Lock()
+
+
+def parse_css_blocks(text: str) -> list[tuple[str, str]]:
+    # (prelude, body) pairs at one nesting level; site.css keeps braces out
+    # of strings, which is all this needs to hold for.
+    blocks, depth, start, prelude = [], 0, 0, ""
+    for index, char in enumerate(text):
+        if char == "{":
+            if depth == 0:
+                prelude = text[start:index].rsplit(";", 1)[-1].strip()
+                start = index + 1
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                blocks.append((prelude, text[start:index]))
+                start = index + 1
+    return blocks
+
+
+def page_vocabulary(source: str) -> PageVocabulary:
+    classes = set(CRITICAL_RUNTIME_CLASSES)
+    for value in re.findall(r'\bclass="([^"]*)"', source):
+        # Classes computed by Jinja expressions are never above the fold.
+        classes.update(token for token in value.split() if re.fullmatch(r"[\w-]+", token))
+    return PageVocabulary(
+        tags={tag.lower() for tag in re.findall(r"<([a-zA-Z][\w-]*)", source)} | {"html", "body", "svg", "use"},
+        classes=classes,
+        ids=set(re.findall(r'\bid="([\w-]+)"', source)),
+        attributes=set(re.findall(r"\s([a-zA-Z][\w-]*)(?==|[\s>])", source)),
+    )
+
+
+def selector_matches(selector: str, vocabulary: PageVocabulary) -> bool:
+    if CRITICAL_SKIP_PSEUDO.search(selector):
+        return False
+    for compound in SELECTOR_COMBINATOR.split(selector.strip()):
+        for prefix, name, attribute in SELECTOR_PART.findall(SELECTOR_PSEUDO.sub("", compound)):
+            if attribute:
+                found = attribute in vocabulary.attributes
+            elif prefix == ".":
+                found = name in vocabulary.classes
+            elif prefix == "#":
+                found = name in vocabulary.ids
+            else:
+                found = name.lower() in vocabulary.tags
+            if not found:
+                return False
+    return True
+
+
+def critical_rules(blocks: list[tuple[str, str]], vocabulary: PageVocabulary) -> list[str]:
+    rules = []
+    for prelude, body in blocks:
+        if prelude.startswith(("@media", "@supports")):
+            inner = critical_rules(parse_css_blocks(body), vocabulary)
+            if inner:
+                rules.append(f"{prelude}{{{''.join(inner)}}}")
+        elif prelude.startswith("@font-face"):
+            rules.append(f"{prelude}{{{body}}}")
+        elif not prelude.startswith("@"):
+            selectors = [s.strip() for s in prelude.split(",") if selector_matches(s, vocabulary)]
+            if selectors:
+                rules.append(f"{','.join(selectors)}{{{body}}}")
+    return rules
+
+
+def extract_critical_css(stylesheet: str, source: str) -> str:
+    blocks = parse_css_blocks(re.sub(r"/\*.*?\*/", "", stylesheet, flags=re.S))
+    rules = critical_rules(blocks, page_vocabulary(source))
+    animations = {
+        name
+        for value in ANIMATION_NAMES.findall(minify_css("".join(rules)))
+        for name in value.replace(",", " ").split()
+    }
+    rules.extend(
+        f"{prelude}{{{body}}}"
+        for prelude, body in blocks
+        if prelude.startswith("@keyframes") and prelude.split()[-1] in animations
+    )
+    return minify_css("".join(rules))
+
+
+def above_the_fold_source(app: Flask, name: str) -> str:
+    def source(template: str) -> str:
+        return app.jinja_loader.get_source(app.jinja_env, template)[0]
+
+    layout, layout_end = CRITICAL_LAYOUT
+    parts = [source(layout).split(layout_end)[0]]
+    parts.extend(source(partial) for partial in CRITICAL_PARTIALS)
+    page = source(name)
+    cuts = [page.find(mark) for mark in CRITICAL_FOLD_MARKS if mark in page]
+    parts.append(page[: min(cuts)] if cuts else page)
+    return "\n".join(parts)
+
+
+def build_critical_css(app: Flask) -> dict[str, Markup]:
+    stylesheet = (Path(app.static_folder) / CRITICAL_STYLESHEET).read_text(encoding="utf-8")
+    layout = CRITICAL_LAYOUT[0]
+    critical = {}
+    for name in app.jinja_env.list_templates():
+        if not name.endswith(".html"):
+            continue
+        text = app.jinja_loader.get_source(app.jinja_env, name)[0]
+        if re.search(rf"{{%-?\s*extends\s+['\"]{re.escape(layout)}['\"]", text):
+            css = extract_critical_css(stylesheet, above_the_fold_source(app, name))
+            critical[name] = Markup(css.replace("</", "<\\/"))
+    return critical
+
+
+def parse_icon(name: str | None, style: str = "fas") -> tuple[str, str] | None:
+    # Accepts "fa-leaf", "fab fa-instagram" or the bare glyph name.
+    glyph = None
+    for token in (name or "").split():
+        if token in ICON_STYLES:
+            style = token
+        else:
+            glyph = token.removeprefix("fa-")
+    if glyph is None or style not in ICON_STYLES or not ICON_NAME_PATTERN.match(glyph):
+        return None
+    return style, glyph
+
+
+@lru_cache(maxsize=512)
+def load_icon_svg(folder: str, style: str, glyph: str) -> tuple[str, str] | None:
+    path = Path(folder, ICON_STYLES[style], f"{glyph}.svg")
+    try:
+        text = minify_svg(path.read_text(encoding="utf-8"))
+    except OSError:
+        return None
+    match = re.search(r"<svg\b[^>]*\bviewBox=\"([^\"]+)\"[^>]*>(.*)</svg>", text, flags=re.S)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def used_icons(app: Flask) -> set[tuple[str, str]]:
+    names = set()
+    for template in app.jinja_env.list_templates():
+        if template.endswith(".html"):
+            text = app.jinja_loader.get_source(app.jinja_env, template)[0]
+            names.update(f"{style or 'fas'} {name}" for name, style in ICON_CALL.findall(text))
+    for tenant in all_tenants(app):
+        if not tenant.database.exists():
+            continue
+        with tenant_context(app, tenant, prepare=False):
+            try:
+                rows = get_db_connection().execute("SELECT DISTINCT icon FROM features").fetchall()
+            except sqlite3.Error:
+                continue
+            names.update(row[0] for row in rows)
+    return {icon for icon in map(parse_icon, names) if icon is not None}
+
+
+def build_icon_sprite(app: Flask) -> IconSprite | None:
+    folder = app.config["ICON_SOURCE_FOLDER"]
+    if not folder:
+        return None
+    symbols, parts = {}, []
+    for style, glyph in sorted(used_icons(app)):
+        svg = load_icon_svg(folder, style, glyph)
+        if svg is None:
+            logger.warning("Icon %s fa-%s not found under %s", style, glyph, folder)
+            continue
+        symbol = f"{style}-{glyph}"
+        symbols[symbol] = svg[0]
+        parts.append(f'<symbol id="{symbol}" viewBox="{svg[0]}">{svg[1]}</symbol>')
+    data = f'<svg xmlns="http://www.w3.org/2000/svg">{"".join(parts)}</svg>'.encode("utf-8")
+    built = Path(ASSET_BUILD_DIR, f"{ICON_SPRITE_STEM}.{hashlib.sha256(data).hexdigest()[:12]}.svg")
+    target = Path(app.static_folder) / built
+    if not target.exists():
+        _write_atomic(target, data)
+        _write_precompressed(target, data)
+    return IconSprite(built.as_posix(), symbols)
+
+
+def render_icon(app: Flask, name: str | None, style: str = "fas") -> Markup:
+    icon = parse_icon(name, style)
+    if icon is None:
+        return Markup("")
+    style, glyph = icon
+    sprite = app.extensions["icon_sprite"]
+    if sprite is None:
+        return Markup('<i class="{} fa-{}" aria-hidden="true"></i>').format(style, glyph)
+    symbol = f"{style}-{glyph}"
+    if symbol in sprite.symbols:
+        return Markup('<svg class="icon" viewBox="{}" aria-hidden="true"><use href="{}#{}"></use></svg>').format(
+            sprite.symbols[symbol], url_for("static", filename=sprite.path), symbol
+        )
+    svg = load_icon_svg(app.config["ICON_SOURCE_FOLDER"], style, glyph)
+    if svg is None:
+        return Markup("")
+    return Markup('<svg class="icon" viewBox="{}" aria-hidden="true">{}</svg>').format(svg[0], Markup(svg[1]))
+
+
+def link_hints_from_html(html: bytes) -> str:
+    end = html.find(b"</head>")
+    if end < 0:
+        return ""
+    hints = []
+    for tag in LINK_HINT_TAG.findall(html[:end].decode("utf-8", "replace")):
+        attributes = {name.lower(): value for name, value in LINK_HINT_ATTRIBUTE.findall(tag[5:-1])}
+        if not attributes.get("href"):
+            continue
+        href = urllib.parse.quote(Markup(attributes["href"]).unescape(), safe=":/?#[]@!$&'()*+,;=%~")
+        params = "".join(
+            f"; {param}" if value == "" else f"; {param}={value}"
+            for param in LINK_HINT_PARAMS
+            if (value := attributes.get(param)) is not None
+        )
+        hints.append(f"<{href}>{params}")
+    return ", ".join(hints)
+
+
+def link_hint_key(app: Flask, host: str, path: str) -> tuple[str, str]:
+    tenant = host.partition(":")[0].lower().rstrip(".") if app.config["TENANTS_FOLDER"] else ""
+    return tenant, path
+
+
+def remember_link_hints(key: tuple[str, str], hints: str) -> None:
+    with _link_hints_lock:
+        _link_hints[key] = hints
+        _link_hints.move_to_end(key)
+        while len(_link_hints) > LINK_HINT_ENTRIES:
+            _link_hints.popitem(last=False)
+
+
+def remembered_link_hints(key: tuple[str, str]) -> str | None:
+    with _link_hints_lock:
+        return _link_hints.get(key)
+
+
+def register_render_path(app: Flask) -> None:
+    app.extensions["critical_css"] = build_critical_css(app) if app.config["CRITICAL_CSS"] else {}
+    app.extensions["icon_sprite"] = build_icon_sprite(app)
+
+    @pass_context
+    def critical_css(context) -> Markup:
+        return app.extensions["critical_css"].get(context.name, Markup(""))
+
+    app.jinja_env.globals.update(
+        critical_css=critical_css,
+        icon=lambda name, style="fas": render_icon(app, name, style),
+        icon_sprite=app.extensions["icon_sprite"],
+    )
+
+    @app.after_request
+    def add_link_hints(response):
+        # Registered right after compression, so the body is still plain HTML.
+        if (
+            request.method != "GET"
+            or response.status_code != 200
+            or response.mimetype != "text/html"
+            or not (request.endpoint or "").startswith("main.")
+        ):
+            return response
+        key = link_hint_key(app, request.host, request.path)
+        if response.is_streamed:
+            hints = remembered_link_hints(key)
+        else:
+            hints = link_hints_from_html(response.get_data())
+            remember_link_hints(key, hints)
+        if hints:
+            response.headers["Link"] = hints
+        return response
+
+
+# Connection management
+#
+# Each thread keeps long-lived connections per process, one per database
+# file, in a small LRU (only one entry unless multi-tenant mode is on).
+# Requests borrow the current tenant's connection through the app context
+# and hand it back in release_db_connection(), which rolls back anything a
+# failed view left open so the next request on the thread starts clean.
+
+_connections = threading.local()
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Times every statement issued through conn.execute/executemany and
+    # attributes it to the current request (see register_instrumentation).
+    def execute(self, sql, parameters=(), /):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, parameters, /):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - started)
+
+
+def _open_connection(database: Path, tenant: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        database,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+        cached_statements=SQLITE_STATEMENT_CACHE_SIZE,
+        factory=InstrumentedConnection,
+    )
     conn.row_factory = sqlite3.Row
+    for name, value in SQLITE_PRAGMAS + (TENANT_SQLITE_PRAGMAS if tenant else ()):
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def _forget_inherited_connections() -> None:
+    # A forked worker must never touch the parent's SQLite handles. Keep the
+    # old objects referenced so they are not closed (and finalised) in the child.
+    global _connections
+    _inherited_connections.append(_connections)
+    _connections = threading.local()
+
+
+_inherited_connections: list[threading.local] = []
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_inherited_connections)
+
+
+def get_db_connection() -> sqlite3.Connection:
+    tenant = current_tenant()
+    pool = getattr(_connections, "pool", None)
+    if pool is None or _connections.pid != os.getpid():
+        pool = _connections.pool = OrderedDict()
+        _connections.pid = os.getpid()
+    conn = pool.get(tenant.database)
+    if conn is None:
+        conn = pool[tenant.database] = _open_connection(tenant.database, bool(tenant.name))
+        while len(pool) > TENANT_CONNECTIONS_PER_THREAD:
+            _, idle = pool.popitem(last=False)
+            idle.close()
+    else:
+        pool.move_to_end(tenant.database)
+    if has_app_context():
+        g._db_connection = conn
     return conn
 
 
-def init_db():
+def release_db_connection(exc: BaseException | None = None) -> None:
+    conn = g.pop("_db_connection", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+@contextmanager
+def write_transaction():
+    # BEGIN IMMEDIATE takes the write lock up front (waiting up to the busy
+    # timeout), which also serialises file-system work done inside the block.
+    conn = get_db_connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+@contextmanager
+def read_snapshot():
+    # Run several reads inside one deferred transaction. Under WAL the first
+    # SELECT pins a snapshot, so a concurrent admin commit cannot show up
+    # half-way through a page. Nested use joins the outer snapshot.
     conn = get_db_connection()
-    cur = conn.cursor()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    if has_app_context():
+        g.pop("_generations", None)
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+
+
+# Tenants
+#
+# With TENANTS_FOLDER set, one process serves many stores. The Host header
+# picks <TENANTS_FOLDER>/<host>/, which holds that store's site.db and
+# uploads/. The tenant rides on g, so connections, caches, uploads and
+# frozen pages all follow it; background jobs carry it into their own app
+# context via tenant_context(). Query and page caches stay shared LRUs keyed
+# by tenant, so total memory is bounded however many tenants there are and
+# idle stores simply age out. Without TENANTS_FOLDER the single default
+# tenant maps to DATABASE_PATH and UPLOAD_FOLDER exactly as before.
+
+Tenant = namedtuple("Tenant", "name database upload_folder")
+
+_ready_tenants: set[str] = set()
+_ready_lock = threading.Lock()
 
+
+def default_tenant() -> Tenant:
+    if has_app_context():
+        return Tenant("", DATABASE_PATH, Path(current_app.config["UPLOAD_FOLDER"]))
+    return Tenant("", DATABASE_PATH, UPLOAD_FOLDER)
+
+
+def current_tenant() -> Tenant:
+    if has_app_context():
+        tenant = g.get("_tenant")
+        if tenant is not None:
+            return tenant
+    return default_tenant()
+
+
+def tenant_upload_folder() -> Path:
+    return current_tenant().upload_folder
+
+
+def tenant_for(app: Flask, name: str) -> Tenant | None:
+    name = name.strip().lower().rstrip(".")
+    if not TENANT_NAME_PATTERN.match(name):
+        return None
+    folder = Path(app.config["TENANTS_FOLDER"]) / name
+    if not folder.is_dir():
+        return None
+    return Tenant(name, folder / "site.db", folder / "uploads")
+
+
+def tenant_from_host(app: Flask, host: str) -> Tenant | None:
+    # An IPv6 literal leaves "[" behind, which never names a tenant.
+    return tenant_for(app, host.partition(":")[0])
+
+
+def list_tenants(app: Flask) -> list[Tenant]:
+    folder = Path(app.config["TENANTS_FOLDER"])
+    if not folder.is_dir():
+        return []
+    return [
+        tenant
+        for tenant in (tenant_for(app, path.name) for path in sorted(folder.iterdir()))
+        if tenant is not None
+    ]
+
+
+def all_tenants(app: Flask) -> list[Tenant]:
+    if app.config["TENANTS_FOLDER"]:
+        return list_tenants(app)
+    with app.app_context():
+        return [default_tenant()]
+
+
+def prepare_tenant(app: Flask, tenant: Tenant) -> None:
+    # Runs once per process per tenant: the schema check is a single PRAGMA
+    # read unless the store's database is new or behind.
+    if tenant.name in _ready_tenants:
+        return
+    with _ready_lock:
+        if tenant.name in _ready_tenants:
+            return
+        tenant.upload_folder.mkdir(parents=True, exist_ok=True)
+        init_db(auto_migrate=app.config["AUTO_MIGRATE"])
+        _ready_tenants.add(tenant.name)
+
+
+@contextmanager
+def tenant_context(app: Flask, tenant: Tenant, prepare: bool = True):
+    with app.app_context():
+        g._tenant = tenant
+        if prepare and tenant.name:
+            prepare_tenant(app, tenant)
+        yield tenant
+
+
+def create_tenant(app: Flask, name: str) -> Tenant:
+    name = name.strip().lower().rstrip(".")
+    if not TENANT_NAME_PATTERN.match(name):
+        raise ValueError(f"{name} はホスト名として使用できません。")
+    (Path(app.config["TENANTS_FOLDER"]) / name / "uploads").mkdir(parents=True, exist_ok=True)
+    return tenant_for(app, name)
+
+
+def register_tenants(app: Flask) -> None:
+    if not app.config["TENANTS_FOLDER"]:
+        return
+
+    @app.before_request
+    def select_tenant():
+        tenant = tenant_from_host(app, request.host)
+        if tenant is None:
+            return "Unknown site", 404
+        g._tenant = tenant
+        prepare_tenant(app, tenant)
+
+
+# Schema migrations
+#
+# PRAGMA user_version records the last applied migration. A worker whose
+# database is already current pays for a single PRAGMA read at startup;
+# otherwise the first process to take the write lock applies the missing
+# steps and everyone else finds the work done once the lock is released.
+# Early migrations use IF NOT EXISTS / ensure_column() so databases created
+# before versioning was introduced upgrade cleanly.
+
+def migrate_base_schema(cur: sqlite3.Cursor) -> None:
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
@@ -107,8 +1103,6 @@ def init_db():
         """
     )
 
-    conn.commit()
-
     # Seed default admin user
     cur.execute("SELECT COUNT(*) FROM users")
     if cur.fetchone()[0] == 0:
@@ -119,176 +1113,1870 @@ def init_db():
             "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
             (default_username, password_hash, datetime.utcnow().isoformat()),
         )
-        conn.commit()
         print("初期管理者ユーザーを作成しました -> ユーザー名: admin / パスワード: admin1234")
 
     # Seed content
     seed_content(cur)
-    conn.commit()
-    conn.close()
 
 
-def seed_content(cur: sqlite3.Cursor) -> None:
-    default_contents = {
-        "top": dict(
-            title="Sample Cafe へようこそ",
-            subtitle="一杯ごとに、ちいさなひと休みを。",
-            body=(
-                "こちらはカフェ・飲食店向けのデモサイトです。写真や文章、色合いを整えることで、"
-                "初めてのお客様にもお店の雰囲気やこだわりが伝わるトップページを表現できます。"
-                "管理画面からテキストや画像を自由に編集して、あなたのお店仕様にカスタマイズしてください。"
-            ),
-            highlight="淹れたての時間を、ゆっくりと。",
-            image="/static/images/hero.svg",
-            extra_info="signature=季節ごとに変わるシングルオリジンコーヒーと自家製デザート",
-        ),
-        "access": dict(
-            title="アクセス・営業時間",
-            subtitle="落ち着いた時間を過ごせる、あなたの隠れ家へ。",
-            body=(
-                "こちらのページでは、住所・電話番号・最寄り駅からの道順など、"
-                "ご来店に必要な情報をまとめて案内できます。管理画面から営業時間や"
-                "定休日などを変更して、実際の店舗情報に合わせてご利用ください。"
-            ),
-            highlight="平日 09:00〜20:00 / 土日祝 10:00〜22:00",
-            image="/static/images/interior.svg",
-            extra_info=(
-                "住所=デモ市サンプル区サンプル町1-2-3\n"
-                "電話=000-0000-0000\n"
-                "定休日=年中無休"
-            ),
-        ),
-        "reservations": dict(
-            title="ご予約について",
-            subtitle="お席のご予約はお気軽にどうぞ。",
-            body=(
-                "お客様がスムーズにお席を予約できるように、予約方法をわかりやすくまとめておくスペースです。"
-                "外部の予約システムへのリンクや、お電話・メールでの受付方法などを自由に記載できます。"
-            ),
-            highlight="一人ひとりに合わせた心地よい時間をご用意します。",
-            image="/static/images/latte-art.svg",
-            extra_info="cta=Webで予約する|link=#",
-        ),
-        "about": dict(
-            title="ストーリーとこだわり",
-            subtitle="一杯のコーヒーに込めた想い。",
-            body=(
-                "お店のはじまりや、豆・食材へのこだわり、空間づくりへの想いなどを伝えるためのページです。"
-                "産地とのつながりや、地域への想い、スタッフのストーリーなどを自由に書き換えて、"
-                "ブランドの世界観をお客様に届けてください。"
-            ),
-            highlight="心をほどく一杯を、ていねいに。",
-            image="/static/images/roastery.svg",
-            extra_info="team=オーナー, バリスタ, パティシエ",
-        ),
-        "features": dict(
-            title="ハイライト",
-            subtitle="訪れるたびにうれしい、小さな特別をご用意しています。",
-            body=(
-                "おすすめメニューや季節限定、イベント情報など、お店の『推しポイント』を"
-                "カード形式で一覧表示できます。管理画面から自由に追加・削除・編集可能です。"
-            ),
-            highlight="今日の気分に寄り添う一杯を。",
-            image="/static/images/dessert.svg",
-            extra_info="",
-        ),
-    }
+def migrate_content_generations(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS content_generations (
+            scope TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    # Give every scope a shared starting timestamp so all workers agree on
+    # Last-Modified before the first edit.
+    cur.executemany(
+        "INSERT OR IGNORE INTO content_generations (scope, generation, updated_at) VALUES (?, 0, ?)",
+        [
+            (scope, datetime.utcnow().isoformat())
+            for scope in sorted(set().union(*PAGE_DEPENDENCIES.values()))
+        ],
+    )
+
+
+def migrate_listing_indexes(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_announcements_published
+        ON announcements (published_at DESC, id DESC)
+        """
+    )
+
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_gallery_images_order
+        ON gallery_images (display_order, created_at DESC, id DESC)
+        """
+    )
+
+
+def migrate_gallery_variants(cur: sqlite3.Cursor) -> None:
+    ensure_column(cur, "gallery_images", "variants", "TEXT")
+    ensure_column(cur, "gallery_images", "status", "TEXT NOT NULL DEFAULT 'ready'")
+
+
+def migrate_gallery_file_path_index(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_gallery_images_file_path
+        ON gallery_images (file_path)
+        """
+    )
+
+
+def migrate_structured_extra_info(cur: sqlite3.Cursor) -> None:
+    ensure_column(cur, "site_content", "extra_data", "TEXT")
+    rows = cur.execute("SELECT section, extra_info FROM site_content").fetchall()
+    # Legacy free text may not validate; keep whatever lines do parse.
+    cur.executemany(
+        "UPDATE site_content SET extra_data = ? WHERE section = ?",
+        [
+            (dump_extra_info(parse_extra_info(section, extra_info, strict=False)), section)
+            for section, extra_info in rows
+        ],
+    )
+
+
+def migrate_search_index(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            title, body, kind UNINDEXED, ref UNINDEXED, tokenize = 'trigram'
+        )
+        """
+    )
+    for table, kind, number, title, body, ref in SEARCH_SOURCES:
+        values = {
+            row: f"{row}.id * 4 + {number}, {title.format(row=row)}, "
+            f"{body.format(row=row)}, '{kind}', {ref.format(row=row)}"
+            for row in ("new", table)
+        }
+        insert = f"INSERT INTO search_index (rowid, title, body, kind, ref) VALUES ({values['new']});"
+        delete = f"DELETE FROM search_index WHERE rowid = old.id * 4 + {number};"
+        # executescript() would COMMIT the migration transaction, so the
+        # triggers are created one statement at a time.
+        for event, actions in (
+            ("INSERT", insert),
+            ("UPDATE", delete + insert),
+            ("DELETE", delete),
+        ):
+            cur.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_search_{event.lower()}
+                AFTER {event} ON {table} BEGIN {actions} END
+                """
+            )
+        cur.execute(
+            f"INSERT INTO search_index (rowid, title, body, kind, ref) SELECT {values[table]} FROM {table}"
+        )
+
+
+def migrate_search_bigrams(cur: sqlite3.Cursor) -> None:
+    # Shares search_index's rowids; title and body hold search_grams_sql()
+    # output. Also rebuilds the triggers and rows, since v13 first shipped
+    # triggers that called an app-registered function and so failed for any
+    # other writer (the sqlite3 shell, restores, scripts).
+    cur.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_bigrams USING fts5(
+            title, body, tokenize = 'unicode61'
+        )
+        """
+    )
+    for table, kind, number, title, body, ref in SEARCH_SOURCES:
+        values = (
+            f"new.id * 4 + {number}, {search_grams_sql(title.format(row='new'))}, "
+            f"{search_grams_sql(body.format(row='new'))}"
+        )
+        insert = f"INSERT INTO search_bigrams (rowid, title, body) VALUES ({values});"
+        delete = f"DELETE FROM search_bigrams WHERE rowid = old.id * 4 + {number};"
+        for event, actions in (
+            ("INSERT", insert),
+            ("UPDATE", delete + insert),
+            ("DELETE", delete),
+        ):
+            cur.execute(f"DROP TRIGGER IF EXISTS {table}_bigrams_{event.lower()}")
+            cur.execute(
+                f"""
+                CREATE TRIGGER {table}_bigrams_{event.lower()}
+                AFTER {event} ON {table} BEGIN {actions} END
+                """
+            )
+    cur.execute("DELETE FROM search_bigrams")
+    cur.execute(
+        f"""
+        INSERT INTO search_bigrams (rowid, title, body)
+        SELECT rowid, {search_grams_sql("title")}, {search_grams_sql("body")} FROM search_index
+        """
+    )
+
+
+def migrate_change_log(cur: sqlite3.Cursor) -> None:
+    # AUTOINCREMENT keeps seq monotonic even after old rows are pruned, so a
+    # consumer's since=<seq> cursor never points at a reused number.
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT NOT NULL,
+            entity TEXT NOT NULL,
+            entity_id TEXT,
+            action TEXT NOT NULL,
+            changed_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def migrate_login_throttle(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS login_throttle (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_login_throttle_updated ON login_throttle (updated_at)"
+    )
+
+
+def migrate_gallery_ranks(cur: sqlite3.Cursor) -> None:
+    # Spread the current order out into sparse ranks so that later moves
+    # rewrite a single row.
+    cur.executemany(
+        "UPDATE gallery_images SET display_order = ? WHERE id = ?",
+        [
+            (position * GALLERY_RANK_STEP, image_id)
+            for position, (image_id,) in enumerate(
+                cur.execute(f"SELECT id FROM gallery_images ORDER BY {GALLERY_ORDER}").fetchall(), 1
+            )
+        ],
+    )
+
+
+def migrate_image_metadata(cur: sqlite3.Cursor) -> None:
+    ensure_column(cur, "gallery_images", "width", "INTEGER")
+    ensure_column(cur, "gallery_images", "height", "INTEGER")
+    ensure_column(cur, "gallery_images", "byte_size", "INTEGER")
+    ensure_column(cur, "gallery_images", "mime_type", "TEXT")
+    ensure_column(cur, "gallery_images", "placeholder", "TEXT")
+    backfill_image_metadata(cur)
+
+
+def migrate_jobs(cur: sqlite3.Cursor) -> None:
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL,
+            run_at REAL NOT NULL,
+            locked_by TEXT,
+            locked_until REAL,
+            last_error TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        """
+    )
+    # At most one pending copy of any job; running and finished ones may repeat.
+    cur.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_pending
+        ON jobs (kind, payload) WHERE status = 'pending'
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, run_at)")
+
+
+MIGRATIONS = (
+    (1, migrate_base_schema),
+    (2, migrate_content_generations),
+    (3, migrate_listing_indexes),
+    (4, migrate_gallery_variants),
+    (5, migrate_gallery_file_path_index),
+    (6, migrate_structured_extra_info),
+    (7, migrate_search_index),
+    (8, migrate_change_log),
+    (9, migrate_login_throttle),
+    (10, migrate_gallery_ranks),
+    (11, migrate_image_metadata),
+    (12, migrate_jobs),
+    (13, migrate_search_bigrams),
+    (14, migrate_search_bigrams),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_db() -> list[int]:
+    if schema_version(get_db_connection()) >= SCHEMA_VERSION:
+        return []
+    applied = []
+    with write_transaction() as conn:
+        # Re-read under the write lock: another worker may have just finished.
+        version = schema_version(conn)
+        cur = conn.cursor()
+        for number, migration in MIGRATIONS:
+            if number > version:
+                migration(cur)
+                applied.append(number)
+        if applied:
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return applied
+
+
+def init_db(auto_migrate: bool = True) -> None:
+    version = schema_version(get_db_connection())
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(
+            f"site.db のスキーマ (v{version}) がアプリ (v{SCHEMA_VERSION}) より新しいため起動できません。"
+        )
+    if not auto_migrate:
+        logger.error(
+            "Database schema is at v%s but v%s is required; run `flask --app app migrate`.",
+            version,
+            SCHEMA_VERSION,
+        )
+        return
+    migrate_db()
+
+
+def ensure_column(cur: sqlite3.Cursor, table: str, column: str, definition: str) -> None:
+    columns = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def seed_content(cur: sqlite3.Cursor) -> None:
+    default_contents = {
+        "top": dict(
+            title="Sample Cafe へようこそ",
+            subtitle="一杯ごとに、ちいさなひと休みを。",
+            body=(
+                "こちらはカフェ・飲食店向けのデモサイトです。写真や文章、色合いを整えることで、"
+                "初めてのお客様にもお店の雰囲気やこだわりが伝わるトップページを表現できます。"
+                "管理画面からテキストや画像を自由に編集して、あなたのお店仕様にカスタマイズしてください。"
+            ),
+            highlight="淹れたての時間を、ゆっくりと。",
+            image="/static/images/hero.svg",
+            extra_info="signature=季節ごとに変わるシングルオリジンコーヒーと自家製デザート",
+        ),
+        "access": dict(
+            title="アクセス・営業時間",
+            subtitle="落ち着いた時間を過ごせる、あなたの隠れ家へ。",
+            body=(
+                "こちらのページでは、住所・電話番号・最寄り駅からの道順など、"
+                "ご来店に必要な情報をまとめて案内できます。管理画面から営業時間や"
+                "定休日などを変更して、実際の店舗情報に合わせてご利用ください。"
+            ),
+            highlight="平日 09:00〜20:00 / 土日祝 10:00〜22:00",
+            image="/static/images/interior.svg",
+            extra_info=(
+                "住所=デモ市サンプル区サンプル町1-2-3\n"
+                "電話=000-0000-0000\n"
+                "定休日=年中無休"
+            ),
+        ),
+        "reservations": dict(
+            title="ご予約について",
+            subtitle="お席のご予約はお気軽にどうぞ。",
+            body=(
+                "お客様がスムーズにお席を予約できるように、予約方法をわかりやすくまとめておくスペースです。"
+                "外部の予約システムへのリンクや、お電話・メールでの受付方法などを自由に記載できます。"
+            ),
+            highlight="一人ひとりに合わせた心地よい時間をご用意します。",
+            image="/static/images/latte-art.svg",
+            extra_info="cta=Webで予約する|link=#",
+        ),
+        "about": dict(
+            title="ストーリーとこだわり",
+            subtitle="一杯のコーヒーに込めた想い。",
+            body=(
+                "お店のはじまりや、豆・食材へのこだわり、空間づくりへの想いなどを伝えるためのページです。"
+                "産地とのつながりや、地域への想い、スタッフのストーリーなどを自由に書き換えて、"
+                "ブランドの世界観をお客様に届けてください。"
+            ),
+            highlight="心をほどく一杯を、ていねいに。",
+            image="/static/images/roastery.svg",
+            extra_info="team=オーナー, バリスタ, パティシエ",
+        ),
+        "features": dict(
+            title="ハイライト",
+            subtitle="訪れるたびにうれしい、小さな特別をご用意しています。",
+            body=(
+                "おすすめメニューや季節限定、イベント情報など、お店の『推しポイント』を"
+                "カード形式で一覧表示できます。管理画面から自由に追加・削除・編集可能です。"
+            ),
+            highlight="今日の気分に寄り添う一杯を。",
+            image="/static/images/dessert.svg",
+            extra_info="",
+        ),
+    }
+
+    for section, data in default_contents.items():
+        placeholders = "SELECT id FROM site_content WHERE section = ?"
+        cur.execute(placeholders, (section,))
+        if cur.fetchone() is None:
+            cur.execute(
+                """
+                INSERT INTO site_content (section, title, subtitle, body, highlight, image, extra_info)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    section,
+                    data.get("title"),
+                    data.get("subtitle"),
+                    data.get("body"),
+                    data.get("highlight"),
+                    data.get("image"),
+                    data.get("extra_info"),
+                ),
+            )
+
+    # Seed gallery images if empty
+    cur.execute("SELECT COUNT(*) FROM gallery_images")
+    if cur.fetchone()[0] == 0:
+        sample_images = [
+            ("/static/images/gallery1.svg", "看板エスプレッソの一杯"),
+            ("/static/images/gallery2.svg", "イベントやポップアップの様子"),
+            ("/static/images/gallery3.svg", "季節のデザートとドリンクのペアリング"),
+        ]
+        for order, (path, caption) in enumerate(sample_images, start=1):
+            cur.execute(
+                "INSERT INTO gallery_images (file_path, caption, display_order, created_at) VALUES (?, ?, ?, ?)",
+                (path, caption, order, datetime.utcnow().isoformat()),
+            )
+
+    # Seed feature cards if empty
+    cur.execute("SELECT COUNT(*) FROM features")
+    if cur.fetchone()[0] == 0:
+        sample_features = [
+            (
+                "季節のペアリング",
+                "コーヒーごとに相性を考えた、季節限定のデザートセットをご用意しています。",
+                "fa-leaf",
+            ),
+            (
+                "アコースティックナイト",
+                "週末の夜には、地域のアーティストによる生演奏をお楽しみいただけます。",
+                "fa-music",
+            ),
+            (
+                "バリスタワークショップ",
+                "ご自宅でも楽しめるハンドドリップ講座など、少人数制のワークショップを開催しています。",
+                "fa-chalkboard-teacher",
+            ),
+        ]
+        for title, description, icon in sample_features:
+            cur.execute(
+                "INSERT INTO features (title, description, icon) VALUES (?, ?, ?)",
+                (title, description, icon),
+            )
+
+    cur.execute("SELECT COUNT(*) FROM announcements")
+    if cur.fetchone()[0] == 0:
+        cur.execute(
+            "INSERT INTO announcements (title, content, published_at) VALUES (?, ?, ?)",
+            (
+                "本日のおすすめ豆が変わりました",
+                "季節のおすすめや新入荷の豆など、最新情報をここでお知らせできます。",
+                datetime.utcnow().isoformat(),
+            ),
+        )
+
+
+def allowed_file(filename: str) -> bool:
+    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+# Upload storage
+#
+# Uploads are streamed to a temp file while being hashed and stored as
+# <sha256>.<ext>, so re-uploading the same photo costs one rename and no
+# extra disk. Rows referencing the same file share it; the file and its
+# derivatives are removed when the last row goes, and gc_orphan_uploads()
+# sweeps anything left behind by crashes or older versions.
+
+StagedUpload = namedtuple("StagedUpload", "temp_path filename metadata")
+
+
+def stage_upload(file, upload_folder: Path) -> StagedUpload:
+    extension = file.filename.rsplit(".", 1)[1].lower()
+    if extension == "jpeg":
+        extension = "jpg"
+    digest = hashlib.sha256()
+    head = b""
+    byte_size = 0
+    fd, temp_name = tempfile.mkstemp(prefix=".upload-", suffix=".tmp", dir=upload_folder)
+    with os.fdopen(fd, "w+b") as out:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            out.write(chunk)
+            byte_size += len(chunk)
+            if len(head) < IMAGE_HEADER_BYTES:
+                head += chunk[: IMAGE_HEADER_BYTES - len(head)]
+        metadata = read_image_metadata(out, head, byte_size)
+    return StagedUpload(Path(temp_name), f"{digest.hexdigest()}.{extension}", metadata)
+
+
+def upload_file_names(file_path: str, variants: str | None) -> set[str]:
+    names = {
+        src.rsplit("/", 1)[1]
+        for _, src, _ in parse_variants(variants)
+        if src.startswith(UPLOAD_URL_PREFIX + "/")
+    }
+    if file_path.startswith(UPLOAD_URL_PREFIX + "/"):
+        names.add(file_path.rsplit("/", 1)[1])
+    return names
+
+
+def gc_orphan_uploads(
+    upload_folder: Path, grace_seconds: int = ORPHAN_GRACE_SECONDS, dry_run: bool = False
+) -> list[Path]:
+    referenced = set()
+    for row in get_db_connection().execute("SELECT file_path, variants FROM gallery_images"):
+        referenced |= upload_file_names(row["file_path"], row["variants"])
+    # Recent files may belong to an upload or derivative job still in flight.
+    cutoff = time.time() - grace_seconds
+    removed = []
+    for path in upload_folder.iterdir():
+        if path.name == ".gitkeep" or path.name in referenced or not path.is_file():
+            continue
+        if path.stat().st_mtime > cutoff:
+            continue
+        if not dry_run:
+            path.unlink(missing_ok=True)
+        removed.append(path)
+    return removed
+
+
+# Image metadata
+#
+# Pixel size, byte size and MIME type come from the file header while an
+# upload is being staged, so pages can reserve each image's box before it
+# loads. The derivative job decodes the photo anyway; it settles the final
+# size (after EXIF rotation) and the placeholder colour, the average of a
+# small thumbnail. SVGs report their width/height or viewBox and the mean of
+# the colours they declare.
+
+ImageMetadata = namedtuple("ImageMetadata", "width height byte_size mime_type placeholder")
+IMAGE_METADATA_COLUMNS = ImageMetadata._fields
+IMAGE_HEADER_BYTES = 64 * 1024
+SVG_ROOT_PATTERN = re.compile(rb"<svg\b[^>]*>", re.IGNORECASE)
+SVG_LENGTH_PATTERN = re.compile(rb"""\b(width|height)\s*=\s*["']\s*([\d.]+)\s*(?:px)?\s*["']""")
+SVG_VIEWBOX_PATTERN = re.compile(rb"""\bviewBox\s*=\s*["']\s*[-\d.]+[\s,]+[-\d.]+[\s,]+([\d.]+)[\s,]+([\d.]+)""")
+SVG_COLOUR_PATTERN = re.compile(rb"#([0-9a-fA-F]{6})\b")
+# Standalone JPEG markers carry no length field.
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD9)}
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Orientations 5-8 rotate by 90 degrees, swapping the displayed width/height.
+EXIF_ORIENTATION_TAG = 0x0112
+EXIF_TRANSPOSED = {5, 6, 7, 8}
+
+
+def _jpeg_size(handle) -> tuple[int, int] | None:
+    # Walk the segment headers, seeking over their bodies, so a large EXIF
+    # block costs a seek rather than a read.
+    handle.seek(2)
+    while True:
+        prefix = handle.read(1)
+        if prefix != b"\xff":
+            return None
+        code = b"\xff"
+        while code == b"\xff":
+            code = handle.read(1)
+        if not code:
+            return None
+        marker = code[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        length = int.from_bytes(handle.read(2), "big")
+        if marker in JPEG_SOF_MARKERS:
+            frame = handle.read(5)
+            if len(frame) < 5:
+                return None
+            return int.from_bytes(frame[3:5], "big"), int.from_bytes(frame[1:3], "big")
+        if length < 2:
+            return None
+        handle.seek(length - 2, os.SEEK_CUR)
+
+
+def mean_colour(colours) -> str | None:
+    colours = list(colours)
+    if not colours:
+        return None
+    channels = [round(sum(colour[i] for colour in colours) / len(colours)) for i in range(3)]
+    return "#" + "".join(f"{channel:02x}" for channel in channels)
+
+
+def _svg_metadata(head: bytes) -> tuple[int, int, str | None] | None:
+    root = SVG_ROOT_PATTERN.search(head)
+    if root is None:
+        return None
+    lengths = {name.decode(): float(value) for name, value in SVG_LENGTH_PATTERN.findall(root.group())}
+    if "width" not in lengths or "height" not in lengths:
+        viewbox = SVG_VIEWBOX_PATTERN.search(root.group())
+        if viewbox is None:
+            return None
+        lengths = {"width": float(viewbox.group(1)), "height": float(viewbox.group(2))}
+    placeholder = mean_colour(bytes.fromhex(value.decode()) for value in SVG_COLOUR_PATTERN.findall(head))
+    return round(lengths["width"]), round(lengths["height"]), placeholder
+
+
+def read_image_metadata(handle, head: bytes, byte_size: int) -> ImageMetadata | None:
+    placeholder = None
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+        mime_type = "image/png"
+        size = int.from_bytes(head[16:20], "big"), int.from_bytes(head[20:24], "big")
+    elif head[:6] in (b"GIF87a", b"GIF89a"):
+        mime_type = "image/gif"
+        size = int.from_bytes(head[6:8], "little"), int.from_bytes(head[8:10], "little")
+    elif head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        mime_type = "image/webp"
+        chunk = head[12:16]
+        if chunk == b"VP8 ":
+            size = int.from_bytes(head[26:28], "little") & 0x3FFF, int.from_bytes(head[28:30], "little") & 0x3FFF
+        elif chunk == b"VP8L":
+            bits = int.from_bytes(head[21:25], "little")
+            size = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        elif chunk == b"VP8X":
+            size = int.from_bytes(head[24:27], "little") + 1, int.from_bytes(head[27:30], "little") + 1
+        else:
+            return None
+    elif head[:2] == b"\xff\xd8":
+        mime_type = "image/jpeg"
+        size = _jpeg_size(handle)
+    else:
+        svg = _svg_metadata(head)
+        if svg is None:
+            return None
+        mime_type = "image/svg+xml"
+        *size, placeholder = svg
+    if not size or not all(size):
+        return None
+    return ImageMetadata(size[0], size[1], byte_size, mime_type, placeholder)
+
+
+def probe_image(path: Path) -> ImageMetadata | None:
+    try:
+        with open(path, "rb") as handle:
+            head = handle.read(IMAGE_HEADER_BYTES)
+            metadata = read_image_metadata(handle, head, os.fstat(handle.fileno()).st_size)
+    except OSError:
+        return None
+    if metadata is not None and metadata.placeholder is None and can_make_derivatives(path.name):
+        try:
+            with Image.open(path) as opened:
+                if opened.getexif().get(EXIF_ORIENTATION_TAG) in EXIF_TRANSPOSED:
+                    metadata = metadata._replace(width=metadata.height, height=metadata.width)
+                opened.draft("RGB", (64, 64))
+                metadata = metadata._replace(placeholder=placeholder_colour(opened))
+        except (OSError, ValueError):
+            pass
+    return metadata
+
+
+def placeholder_colour(image) -> str:
+    thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((32, 32))
+    return mean_colour([thumbnail.resize((1, 1), Image.BOX).getpixel((0, 0))])
+
+
+def gallery_file_source(file_path: str) -> Path | None:
+    if ".." in file_path:
+        return None
+    if file_path.startswith(UPLOAD_URL_PREFIX + "/"):
+        return tenant_upload_folder() / file_path.rsplit("/", 1)[1]
+    if file_path.startswith("/static/"):
+        return STATIC_FOLDER / file_path[len("/static/"):]
+    return None
+
+
+def backfill_image_metadata(cur: sqlite3.Cursor) -> int:
+    rows = cur.execute(
+        "SELECT id, file_path FROM gallery_images WHERE width IS NULL OR placeholder IS NULL"
+    ).fetchall()
+    probed: dict[str, ImageMetadata | None] = {}
+    updates = []
+    for image_id, file_path in rows:
+        if file_path not in probed:
+            source = gallery_file_source(file_path)
+            probed[file_path] = probe_image(source) if source else None
+        metadata = probed[file_path]
+        if metadata is not None:
+            updates.append((*metadata, image_id))
+    cur.executemany(
+        """
+        UPDATE gallery_images
+        SET width = ?, height = ?, byte_size = ?, mime_type = ?, placeholder = ?
+        WHERE id = ?
+        """,
+        updates,
+    )
+    return len(updates)
+
+
+# Image derivatives
+#
+# Uploaded photos are resized by a background job. Each row starts as
+# 'processing' and flips to 'ready' (or 'failed') once its variants exist;
+# the templates fall back to the original file until then.
+
+def can_make_derivatives(filename: str) -> bool:
+    return Image is not None and filename.rsplit(".", 1)[-1].lower() in RESIZABLE_EXTENSIONS
+
+
+def _save_variant(image, target: Path, image_format: str, **options) -> None:
+    tmp_path = target.with_name(f".{target.name}.tmp")
+    image.save(tmp_path, format=image_format, **options)
+    os.replace(tmp_path, target)
+
+
+def build_derivatives(source: Path, url_prefix: str) -> tuple[list[dict], dict]:
+    variants = []
+    with Image.open(source) as opened:
+        original = ImageOps.exif_transpose(opened)
+        original_format = opened.format
+        mime_type = Image.MIME.get(original_format, "application/octet-stream")
+        variants.append({"width": original.width, "src": f"{url_prefix}/{source.name}", "type": mime_type})
+        if original_format == "JPEG" and original.mode not in ("RGB", "L"):
+            original = original.convert("RGB")
+
+        widths = [width for width in DERIVATIVE_WIDTHS if width < original.width]
+        smallest = None
+        for width in widths + [original.width]:
+            if width == original.width:
+                resized = original
+            else:
+                height = max(1, round(original.height * width / original.width))
+                resized = original.resize((width, height), Image.LANCZOS)
+            # The narrowest rendition is plenty for an average colour.
+            smallest = smallest or resized
+            webp_target = source.with_name(f"{source.stem}-{width}.webp")
+            _save_variant(resized, webp_target, "WEBP", quality=80, method=4)
+            variants.append({"width": width, "src": f"{url_prefix}/{webp_target.name}", "type": "image/webp"})
+            if width != original.width and original_format != "WEBP":
+                target = source.with_name(f"{source.stem}-{width}{source.suffix}")
+                options = {"quality": 82, "optimize": True} if original_format == "JPEG" else {"optimize": True}
+                _save_variant(resized, target, original_format, **options)
+                variants.append({"width": width, "src": f"{url_prefix}/{target.name}", "type": mime_type})
+        summary = {"width": original.width, "height": original.height, "placeholder": placeholder_colour(smallest)}
+    return variants, summary
+
+
+def process_derivatives(app: Flask, image_id: int, source: Path, url_prefix: str) -> None:
+    try:
+        variants, summary = build_derivatives(source, url_prefix)
+        status = "ready"
+    except (OSError, ValueError):  # includes PIL.UnidentifiedImageError
+        # A broken image will not get better on retry.
+        logger.exception("Could not build derivatives for %s", source)
+        variants, summary, status = [], {}, "failed"
+    set_gallery_variants(image_id, variants, status, summary)
+    dispatch_changes(app)
+    if app.config["FREEZE_PAGES"]:
+        enqueue_job("freeze")
+
+
+def schedule_derivatives(image_id: int, source: Path) -> None:
+    enqueue_job("derivatives", {"image_id": image_id, "filename": source.name})
+
+
+@lru_cache(maxsize=1024)
+def parse_variants(raw: str | None) -> tuple:
+    if not raw:
+        return ()
+    return tuple(
+        (variant["width"], variant["src"], variant["type"]) for variant in json.loads(raw)
+    )
+
+
+# Content cache
+#
+# Public reads go through a small in-process LRU. Every write bumps a
+# per-scope generation counter in content_generations inside the same
+# transaction, so each worker process notices changes made by any other
+# worker with a single lookup per request and reloads only stale scopes.
+
+class RecordMixin:
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return tuple.__getitem__(self, self._index[key])
+            except KeyError:
+                raise KeyError(key) from None
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return self._fields
+
+
+_record_types: dict[tuple[str, ...], type] = {}
+
+
+def record_type(fields: tuple[str, ...]) -> type:
+    cls = _record_types.get(fields)
+    if cls is None:
+        base = namedtuple("Record", fields)
+        cls = type(
+            "Record",
+            (RecordMixin, base),
+            {"__slots__": (), "_index": {name: i for i, name in enumerate(fields)}},
+        )
+        _record_types[fields] = cls
+    return cls
+
+
+def to_records(cursor: sqlite3.Cursor) -> tuple:
+    cls = record_type(tuple(column[0] for column in cursor.description))
+    return tuple(cls._make(row) for row in cursor)
+
+
+class QueryCache:
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != generation:
+                self.misses += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, generation: int, value) -> None:
+        with self._lock:
+            self._entries[key] = (generation, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_MISSING = object()
+query_cache = QueryCache(QUERY_CACHE_MAX_ENTRIES)
+
+
+def current_generations() -> dict[str, tuple[int, str]]:
+    # One lookup per request; the result is memoised on g until the request
+    # itself writes something.
+    if has_app_context() and "_generations" in g:
+        return g._generations
+    rows = get_db_connection().execute(
+        "SELECT scope, generation, updated_at FROM content_generations"
+    ).fetchall()
+    generations = {row["scope"]: (row["generation"], row["updated_at"]) for row in rows}
+    if has_app_context():
+        g._generations = generations
+    return generations
+
+
+def bump_generation(conn: sqlite3.Connection, scope: str) -> None:
+    conn.execute(
+        """
+        INSERT INTO content_generations (scope, generation, updated_at)
+        VALUES (?, 1, ?)
+        ON CONFLICT(scope) DO UPDATE
+        SET generation = generation + 1, updated_at = excluded.updated_at
+        """,
+        (scope, datetime.utcnow().isoformat()),
+    )
+    if has_app_context():
+        g.pop("_generations", None)
+
+
+def cached_query(scope: str, key, loader):
+    generation = current_generations().get(scope, (0, None))[0]
+    key = (current_tenant().name, key)
+    value = query_cache.get(key, generation)
+    if value is _MISSING:
+        value = loader()
+        query_cache.put(key, generation, value)
+    return value
+
+
+# Page cache
+#
+# Rendered public pages are keyed by tenant, endpoint and the query
+# parameters the view reads (PAGE_QUERY_ARGS), and stamped with the
+# generations of the scopes they read, so an edit only invalidates the pages
+# listed against the scope it bumped. Any other parameter is left out of the
+# key: it does not change the page, and keying on it would let anyone mint
+# fresh entries with ?x=1, ?x=2, ... and push the real pages out.
+
+PAGE_DEPENDENCIES = {
+    "main.top": ("site_content:top", "features", "announcements", "gallery_images"),
+    "main.access": ("site_content:access",),
+    "main.reservations": ("site_content:reservations",),
+    "main.gallery": ("gallery_images",),
+    "main.about": ("site_content:about", "announcements"),
+    "main.features": ("site_content:features", "features"),
+}
+
+PAGE_QUERY_ARGS = {
+    "main.gallery": ("after",),
+    "main.about": ("after",),
+}
+
+CachedPage = namedtuple("CachedPage", "body etag last_modified")
+page_cache = QueryCache(PAGE_CACHE_MAX_ENTRIES)
+
+
+def page_stamp(endpoint: str) -> tuple[tuple[int, ...], datetime | None]:
+    generations = current_generations()
+    entries = [generations.get(scope, (0, None)) for scope in PAGE_DEPENDENCIES[endpoint]]
+    timestamps = [updated_at for _, updated_at in entries if updated_at]
+    last_modified = datetime.fromisoformat(max(timestamps)) if timestamps else None
+    return tuple(generation for generation, _ in entries), last_modified
+
+
+def page_cache_key(endpoint: str, args=None) -> tuple:
+    # An empty value reads the same as a missing one (the first page).
+    params = tuple(
+        (name, args[name]) for name in PAGE_QUERY_ARGS.get(endpoint, ()) if args and args.get(name)
+    )
+    return (current_tenant().name, endpoint, params)
+
+
+def make_cached_page(body: str, last_modified: datetime | None) -> CachedPage:
+    etag = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+    return CachedPage(body, etag, last_modified)
+
+
+def render_cached_page(endpoint: str, render):
+    stamp, last_modified = page_stamp(endpoint)
+    key = page_cache_key(endpoint, request.args)
+    page = page_cache.get(key, stamp)
+    if page is _MISSING:
+        # Frozen copies exist only for the unparameterised pages.
+        page = None if key[2] else read_frozen_page(endpoint, stamp)
+        if page is None:
+            body = render()
+            if isinstance(body, StreamedPage):
+                chunks = cache_streamed_page(body.chunks, key, stamp, last_modified)
+                return StreamedPage(chunks, last_modified)
+            if not isinstance(body, str):
+                return body
+            page = make_cached_page(body, last_modified)
+        page_cache.put(key, stamp, page)
+    return page
+
+
+# Streamed rendering
+#
+# With STREAM_TEMPLATES=1 the heavier pages (STREAMED_ENDPOINTS) are sent
+# while they render on a page-cache miss: the views call render_page(),
+# which then hands back Jinja's generator instead of a string. Templates
+# mark where the head and hero end with {{ flush_point() }}; output is sent
+# there and otherwise in STREAM_FLUSH_BYTES batches, so the browser starts
+# on CSS and the hero while the long list below is still being produced.
+# The chunks are collected on the way out and land in the page cache once
+# the last one is sent, so only that first response goes without an ETag.
+
+STREAMED_ENDPOINTS = frozenset({"main.top", "main.gallery", "main.about"})
+STREAM_FLUSH_BYTES = 16 * 1024
+STREAM_FLUSH_MARK = "\x00flush\x00"
+
+StreamedPage = namedtuple("StreamedPage", "chunks last_modified", defaults=(None,))
+
+
+def streaming_page() -> bool:
+    return g.get("_stream_page", False)
+
+
+def render_page(template_name: str, **context):
+    if streaming_page():
+        return StreamedPage(batch_chunks(stream_template(template_name, **context)))
+    return render_template(template_name, **context)
+
+
+def batch_chunks(chunks, size: int = STREAM_FLUSH_BYTES):
+    # Jinja yields a string per template node; joining them keeps writes
+    # (and compressor flushes) down to a few per page.
+    buffer, buffered = [], 0
+    for chunk in chunks:
+        flush = STREAM_FLUSH_MARK in chunk
+        if flush:
+            chunk = chunk.replace(STREAM_FLUSH_MARK, "")
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if flush or buffered >= size:
+            yield "".join(buffer)
+            buffer, buffered = [], 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def cache_streamed_page(chunks, key: tuple, stamp: tuple[int, ...], last_modified: datetime | None):
+    # A client that disconnects closes the generator early and nothing is
+    # cached from the partial page.
+    sent = []
+    for chunk in chunks:
+        sent.append(chunk)
+        yield chunk
+    page_cache.put(key, stamp, make_cached_page("".join(sent), last_modified))
+
+
+# Frozen pages
+#
+# With FREEZE_PAGES=1 the six public pages are also written to FREEZE_FOLDER
+# as <path>/index.html (plus .gz / .br), so a front-end server can answer
+# them without Python. Next to each page a stamp records the generations it
+# was rendered from. After every admin POST, and after background image
+# work, only pages whose stamp no longer matches are re-rendered. Flask
+# serves a frozen page only while its stamp is current and otherwise
+# renders live, so missing or stale output never reaches a visitor through
+# the app.
+
+FROZEN_STAMP_DIR = ".stamps"
+
+
+def frozen_folder() -> Path | None:
+    if not current_app.config["FREEZE_PAGES"]:
+        return None
+    return tenant_frozen_folder(current_app)
+
+
+def tenant_frozen_folder(app: Flask) -> Path:
+    # Each tenant freezes into its own <FREEZE_FOLDER>/<host>/ so a front-end
+    # server can map $host straight onto it.
+    return Path(app.config["FREEZE_FOLDER"]) / current_tenant().name
+
+
+def endpoint_path(endpoint: str) -> str:
+    # The public pages take no arguments, so the rule is the path; unlike
+    # url_for() this also works outside a request (background threads).
+    return next(current_app.url_map.iter_rules(endpoint)).rule
+
+
+def frozen_target(folder: Path, endpoint: str) -> Path:
+    rule = endpoint_path(endpoint).strip("/")
+    return folder / rule / "index.html" if rule else folder / "index.html"
+
+
+def read_frozen_stamp(folder: Path, endpoint: str) -> dict | None:
+    try:
+        return json.loads((folder / FROZEN_STAMP_DIR / f"{endpoint}.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def read_frozen_page(endpoint: str, stamp: tuple[int, ...]) -> CachedPage | None:
+    folder = frozen_folder()
+    if folder is None:
+        return None
+    recorded = read_frozen_stamp(folder, endpoint)
+    if recorded is None or tuple(recorded["stamp"]) != stamp:
+        return None
+    try:
+        body = frozen_target(folder, endpoint).read_text(encoding="utf-8")
+    except OSError:
+        return None
+    if hashlib.sha256(body.encode("utf-8")).hexdigest()[:32] != recorded["etag"]:
+        return None  # replaced between reading the stamp and the page
+    last_modified = recorded["last_modified"]
+    return CachedPage(body, recorded["etag"], last_modified and datetime.fromisoformat(last_modified))
+
+
+@contextmanager
+def frozen_lock(folder: Path):
+    # Serialises re-rendering across workers, so the newest render is also
+    # the last one written.
+    folder.mkdir(parents=True, exist_ok=True)
+    with open(folder / ".lock", "w") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        yield
+
+
+def freeze_pages(app: Flask, force: bool = False) -> list[str]:
+    folder = tenant_frozen_folder(app)
+    written = []
+    with app.test_request_context(), frozen_lock(folder):
+        for endpoint in PAGE_DEPENDENCIES:
+            stamp, last_modified = page_stamp(endpoint)
+            target = frozen_target(folder, endpoint)
+            recorded = read_frozen_stamp(folder, endpoint)
+            if not force and recorded and tuple(recorded["stamp"]) == stamp and target.exists():
+                continue
+            with app.test_request_context(url_for(endpoint)):
+                body = app.view_functions[endpoint].__wrapped__()
+            page = make_cached_page(body, last_modified)
+            data = body.encode("utf-8")
+            _write_atomic(target, data)
+            _write_precompressed(target, data)
+            _write_atomic(
+                folder / FROZEN_STAMP_DIR / f"{endpoint}.json",
+                json.dumps(
+                    {
+                        "stamp": list(stamp),
+                        "etag": page.etag,
+                        "last_modified": last_modified and last_modified.isoformat(),
+                    }
+                ).encode("utf-8"),
+            )
+            page_cache.put(page_cache_key(endpoint), stamp, page)
+            written.append(endpoint)
+    return written
+
+
+# Change feed
+#
+# Every content write appends a row to change_log next to its generation
+# bump, inside the same transaction. SQLite commits one writer at a time,
+# so seq order is commit order and a rolled-back write leaves no row.
+# /api/changes?since=<seq> returns the delta since a consumer's last seq
+# together with the public paths it affects (derived from
+# PAGE_DEPENDENCIES), and purge hooks receive the same paths right after
+# the request that made the change has committed.
+
+CHANGE_FEED_LIMIT = 500
+CHANGE_LOG_RETENTION_DAYS = 30
+PURGE_WEBHOOK_TIMEOUT = 5
+
+
+def record_change(
+    conn: sqlite3.Connection, scope: str, entity: str, entity_id, action: str
+) -> None:
+    bump_generation(conn, scope)
+    cur = conn.execute(
+        """
+        INSERT INTO change_log (scope, entity, entity_id, action, changed_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        (
+            scope,
+            entity,
+            None if entity_id is None else str(entity_id),
+            action,
+            datetime.utcnow().isoformat(),
+        ),
+    )
+    if has_app_context():
+        g.setdefault("_recorded_changes", []).append(cur.lastrowid)
+
+
+@lru_cache(maxsize=64)
+def _scope_endpoints(scope: str) -> tuple[str, ...]:
+    return tuple(endpoint for endpoint, scopes in PAGE_DEPENDENCIES.items() if scope in scopes)
+
+
+def scope_paths(scope: str) -> list[str]:
+    return [endpoint_path(endpoint) for endpoint in _scope_endpoints(scope)]
+
+
+def change_entries(rows) -> list[dict]:
+    return [
+        {
+            "seq": row["seq"],
+            "entity": row["entity"],
+            "id": row["entity_id"],
+            "action": row["action"],
+            "at": row["changed_at"],
+            "paths": scope_paths(row["scope"]),
+        }
+        for row in rows
+    ]
+
+
+def purge_paths(changes: list[dict]) -> list[str]:
+    return sorted({path for change in changes for path in change["paths"]})
+
+
+def fetch_changes(since: int, limit: int = CHANGE_FEED_LIMIT) -> dict:
+    limit = max(1, min(int(limit), CHANGE_FEED_LIMIT))
+    with read_snapshot() as conn:
+        latest = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'change_log'"
+        ).fetchone()
+        latest = latest[0] if latest else 0
+        oldest = conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+        # A cursor from before the pruned range (or from another database)
+        # has missed changes: the consumer purges everything and resumes
+        # from the latest seq.
+        reset = since > latest or since < (oldest or latest + 1) - 1
+        rows = [] if reset else conn.execute(
+            """
+            SELECT seq, scope, entity, entity_id, action, changed_at
+            FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?
+            """,
+            (since, limit + 1),
+        ).fetchall()
+    has_more = len(rows) > limit
+    changes = change_entries(rows[:limit])
+    return {
+        "since": since,
+        "next": changes[-1]["seq"] if changes else latest,
+        "latest": latest,
+        "reset": reset,
+        "has_more": has_more,
+        "purge": purge_paths(changes),
+        "changes": changes,
+    }
+
+
+def prune_change_log(days: int) -> int:
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    with write_transaction() as conn:
+        return conn.execute("DELETE FROM change_log WHERE changed_at < ?", (cutoff,)).rowcount
+
+
+def register_purge_hook(app: Flask, hook) -> None:
+    # hook(paths, changes) is called once per committed write request.
+    app.extensions.setdefault("purge_hooks", []).append(hook)
+
+
+def dispatch_changes(app: Flask) -> None:
+    seqs = g.pop("_recorded_changes", None)
+    hooks = app.extensions.get("purge_hooks")
+    if not seqs or not hooks:
+        return
+    conn = get_db_connection()
+    if conn.in_transaction:
+        return  # the write failed and is about to be rolled back
+    # Read back by seq: only rows that actually committed are announced.
+    rows = conn.execute(
+        f"""
+        SELECT seq, scope, entity, entity_id, action, changed_at
+        FROM change_log WHERE seq IN ({', '.join('?' * len(seqs))}) ORDER BY seq
+        """,
+        seqs,
+    ).fetchall()
+    if not rows:
+        return
+    changes = change_entries(rows)
+    paths = purge_paths(changes)
+    for hook in hooks:
+        try:
+            hook(paths, changes)
+        except Exception:
+            logger.exception("Purge hook %r failed", hook)
+
+
+def post_purge_webhook(url: str, payload: dict) -> None:
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=PURGE_WEBHOOK_TIMEOUT) as response:
+        response.read()
+
+
+def webhook_purge_hook(url: str):
+    def hook(paths: list[str], changes: list[dict]) -> None:
+        # Never hold up the admin response on a slow CDN API; the job also
+        # retries while the endpoint is down.
+        enqueue_job("purge-webhook", {"url": url, "paths": paths, "changes": changes})
+
+    return hook
+
+
+# Background jobs
+#
+# Slow work triggered from the admin (image derivatives, re-freezing pages,
+# purge webhooks) is queued in the jobs table of the store's site.db
+# instead of running inside the request. enqueue_job() joins the caller's
+# write transaction when there is one, so a job exists exactly when the
+# write that needs it committed. Identical pending jobs collapse into one
+# through a partial unique index, so a burst of edits re-freezes the site
+# once. A worker claims a job with one UPDATE ... RETURNING and holds it
+# under a lease; if the worker dies, the job is picked up again when the
+# lease runs out. Failures are retried with exponential backoff (with
+# jitter) up to max_attempts; after that the job stays 'failed' on the
+# dashboard, where it can be retried by hand.
+# `serve` forks one job process at a lower CPU priority and leaves its web
+# workers to requests. Any other process (flask run, another WSGI server)
+# starts JOB_WORKERS job threads itself the first time it enqueues; set
+# JOB_WORKERS=0 there only when `flask --app app jobs-worker` runs the queue
+# elsewhere, and a process that then enqueues says so in the log once.
+# With TENANTS_FOLDER set, enqueueing a job touches a marker file named
+# after the store under <TENANTS_FOLDER>/.jobs-due/, and workers only poll
+# stores that have one, so idle stores cost neither a connection nor a
+# query. A worker that finds a store with nothing left to run removes its
+# marker; an hourly pass over every store prunes old jobs and restores any
+# marker that went missing.
+
+JOB_WORKER_THREADS = 2
+JOB_POLL_SECONDS = 2.0
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BASE_SECONDS = 5.0
+JOB_RETRY_MAX_SECONDS = 600.0
+JOB_RETENTION_DAYS = 7
+JOB_PRUNE_INTERVAL = 60 * 60
+JOB_NICE = 10
+JOB_DASHBOARD_LIMIT = 10
+JOB_MARKER_DIR = ".jobs-due"
+# A marker this fresh may belong to a job whose transaction is still open.
+JOB_MARKER_GRACE_SECONDS = 60
+# Pending and due, or running on a lease that has expired.
+JOB_DUE = "(status = 'pending' AND run_at <= :now) OR (status = 'running' AND locked_until < :now)"
+
+Job = namedtuple("Job", "id kind payload attempts max_attempts")
+
+_job_wakeup = threading.Event()
+_job_threads: list[threading.Thread] = []
+_job_threads_lock = threading.Lock()
+# Set by serve() when its job process (or, with --job-threads 0, a separate
+# jobs-worker) is responsible for the queue.
+_job_queue_external = False
+_job_queue_warned = False
+
+
+def _reset_job_threads() -> None:
+    # Threads do not survive fork(); children start their own on demand.
+    global _job_threads, _job_threads_lock
+    _job_threads = []
+    _job_threads_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_job_threads)
+
+
+def enqueue_job(kind: str, payload: dict | None = None, delay: float = 0.0) -> int:
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    conn = get_db_connection()
+    if conn.in_transaction:
+        job_id = _insert_job(conn, kind, payload, delay)
+    else:
+        with write_transaction() as conn:
+            job_id = _insert_job(conn, kind, payload, delay)
+    mark_jobs_due(current_app._get_current_object())
+    start_job_workers(current_app._get_current_object())
+    _job_wakeup.set()
+    return job_id
+
+
+def _insert_job(conn: sqlite3.Connection, kind: str, payload: dict | None, delay: float) -> int:
+    now = datetime.utcnow().isoformat()
+    # A duplicate of a pending job only pulls that job forward.
+    return conn.execute(
+        """
+        INSERT INTO jobs (kind, payload, max_attempts, run_at, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (kind, payload) WHERE status = 'pending'
+        DO UPDATE SET run_at = MIN(run_at, excluded.run_at)
+        RETURNING id
+        """,
+        (
+            kind,
+            json.dumps(payload or {}, sort_keys=True, separators=(",", ":"), ensure_ascii=False),
+            JOB_MAX_ATTEMPTS,
+            time.time() + delay,
+            now,
+            now,
+        ),
+    ).fetchone()[0]
+
+
+def claim_job(worker: str) -> Job | None:
+    conn = get_db_connection()
+    now = time.time()
+    # Idle polls only read, so they never queue behind the write lock.
+    if conn.execute(f"SELECT 1 FROM jobs WHERE {JOB_DUE} LIMIT 1", {"now": now}).fetchone() is None:
+        return None
+    with write_transaction() as conn:
+        row = conn.execute(
+            f"""
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, locked_by = :worker,
+                locked_until = :now + {JOB_LEASE_SECONDS}, updated_at = :updated_at
+            WHERE id = (SELECT id FROM jobs WHERE {JOB_DUE} ORDER BY run_at, id LIMIT 1)
+            RETURNING id, kind, payload, attempts, max_attempts
+            """,
+            {"worker": worker, "now": now, "updated_at": datetime.utcnow().isoformat()},
+        ).fetchone()
+    if row is None:
+        return None
+    return Job(row["id"], row["kind"], json.loads(row["payload"]), row["attempts"], row["max_attempts"])
+
+
+def finish_job(job: Job) -> None:
+    with write_transaction() as conn:
+        conn.execute(
+            """
+            UPDATE jobs SET status = 'done', locked_by = NULL, locked_until = NULL,
+                last_error = NULL, updated_at = ?
+            WHERE id = ?
+            """,
+            (datetime.utcnow().isoformat(), job.id),
+        )
+
+
+def fail_job(job: Job, error: str) -> None:
+    now = datetime.utcnow().isoformat()
+    with write_transaction() as conn:
+        if job.attempts >= job.max_attempts:
+            conn.execute(
+                """
+                UPDATE jobs SET status = 'failed', locked_by = NULL, locked_until = NULL,
+                    last_error = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (error, now, job.id),
+            )
+            return
+        delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+        cur = conn.execute(
+            """
+            UPDATE OR IGNORE jobs SET status = 'pending', run_at = ?, locked_by = NULL,
+                locked_until = NULL, last_error = ?, updated_at = ?
+            WHERE id = ?
+            """,
+            (time.time() + delay * random.uniform(0.5, 1.0), error, now, job.id),
+        )
+        if not cur.rowcount:
+            # An identical job was queued meanwhile and will do the same work.
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+
+def retry_job(job_id: int) -> bool:
+    with write_transaction() as conn:
+        cur = conn.execute(
+            """
+            UPDATE OR IGNORE jobs SET status = 'pending', attempts = 0, run_at = ?, updated_at = ?
+            WHERE id = ? AND status = 'failed'
+            """,
+            (time.time(), datetime.utcnow().isoformat(), job_id),
+        )
+    if cur.rowcount:
+        mark_jobs_due(current_app._get_current_object())
+        start_job_workers(current_app._get_current_object())
+        _job_wakeup.set()
+    return bool(cur.rowcount)
+
+
+def job_marker_folder(app: Flask) -> Path:
+    return Path(app.config["TENANTS_FOLDER"]) / JOB_MARKER_DIR
+
+
+def mark_jobs_due(app: Flask) -> None:
+    if not app.config["TENANTS_FOLDER"]:
+        return
+    folder = job_marker_folder(app)
+    folder.mkdir(exist_ok=True)
+    (folder / current_tenant().name).touch()
+
+
+def has_open_jobs() -> bool:
+    row = get_db_connection().execute(
+        "SELECT 1 FROM jobs WHERE status IN ('pending', 'running') LIMIT 1"
+    ).fetchone()
+    return row is not None
+
+
+def due_tenants(app: Flask) -> list[Tenant]:
+    if not app.config["TENANTS_FOLDER"]:
+        return all_tenants(app)
+    try:
+        names = sorted(entry.name for entry in os.scandir(job_marker_folder(app)) if not entry.name.startswith("."))
+    except FileNotFoundError:
+        return []
+    return [tenant for tenant in (tenant_for(app, name) for name in names) if tenant is not None]
+
+
+def settle_job_marker(app: Flask, tenant: Tenant) -> None:
+    # The marker is moved aside before the queue is checked, so a job
+    # enqueued meanwhile leaves a new marker instead of being missed.
+    if not app.config["TENANTS_FOLDER"]:
+        return
+    marker = job_marker_folder(app) / tenant.name
+    claimed = marker.with_name(f".{tenant.name}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        os.replace(marker, claimed)
+    except FileNotFoundError:
+        return
+    fresh = time.time() - claimed.stat().st_mtime < JOB_MARKER_GRACE_SECONDS
+    if (fresh or has_open_jobs()) and not marker.exists():
+        os.replace(claimed, marker)
+    else:
+        claimed.unlink()
+
+
+def run_job(app: Flask, job: Job, worker: str) -> None:
+    handler = JOB_HANDLERS.get(job.kind)
+    started = time.perf_counter()
+    try:
+        if handler is None:
+            raise LookupError(f"Unknown job kind: {job.kind}")
+        handler(app, job.payload)
+    except Exception as exc:
+        if job.attempts >= job.max_attempts:
+            logger.exception("Job %s (%s) gave up after %d attempts", job.id, job.kind, job.attempts)
+        else:
+            logger.warning(
+                "Job %s (%s) failed on attempt %d/%d: %s", job.id, job.kind, job.attempts, job.max_attempts, exc
+            )
+        conn = get_db_connection()
+        if conn.in_transaction:
+            conn.rollback()
+        fail_job(job, f"{type(exc).__name__}: {exc}")
+        return
+    finish_job(job)
+    logger.info("Job %s (%s) done by %s in %.0f ms", job.id, job.kind, worker, (time.perf_counter() - started) * 1000)
+
 
-    for section, data in default_contents.items():
-        placeholders = "SELECT id FROM site_content WHERE section = ?"
-        cur.execute(placeholders, (section,))
-        if cur.fetchone() is None:
-            cur.execute(
-                """
-                INSERT INTO site_content (section, title, subtitle, body, highlight, image, extra_info)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    section,
-                    data.get("title"),
-                    data.get("subtitle"),
-                    data.get("body"),
-                    data.get("highlight"),
-                    data.get("image"),
-                    data.get("extra_info"),
-                ),
+def prune_jobs(days: int = JOB_RETENTION_DAYS) -> int:
+    cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    with write_transaction() as conn:
+        cur = conn.execute("DELETE FROM jobs WHERE status = 'done' AND updated_at < ?", (cutoff,))
+    return cur.rowcount
+
+
+def job_worker_loop(app: Flask, stop: threading.Event, worker: str) -> None:
+    pruned_at = 0.0
+    while not stop.is_set():
+        ran = False
+        for tenant in due_tenants(app):
+            if stop.is_set():
+                break
+            try:
+                with tenant_context(app, tenant):
+                    job = claim_job(worker)
+                    if job is not None:
+                        run_job(app, job, worker)
+                        ran = True
+                    else:
+                        settle_job_marker(app, tenant)
+            except Exception:
+                logger.exception("Job worker %s failed on %s", worker, tenant.name or "default site")
+        if ran:
+            continue
+        if time.monotonic() - pruned_at > JOB_PRUNE_INTERVAL:
+            pruned_at = time.monotonic()
+            for tenant in all_tenants(app):
+                if stop.is_set():
+                    break
+                try:
+                    with tenant_context(app, tenant):
+                        prune_jobs()
+                        if has_open_jobs():
+                            mark_jobs_due(app)
+                except Exception:
+                    logger.exception("Job worker %s could not prune %s", worker, tenant.name or "default site")
+        _job_wakeup.wait(JOB_POLL_SECONDS)
+        _job_wakeup.clear()
+
+
+def start_job_workers(app: Flask, threads: int | None = None, stop: threading.Event | None = None) -> list[threading.Thread]:
+    global _job_queue_warned
+    threads = app.config["JOB_WORKERS"] if threads is None else threads
+    with _job_threads_lock:
+        if threads <= 0 and not _job_threads and not (_job_queue_external or _job_queue_warned):
+            _job_queue_warned = True
+            logger.warning(
+                "JOB_WORKERS=0: queued jobs stay pending until `flask --app app jobs-worker` runs"
             )
+        if _job_threads or threads <= 0:
+            return _job_threads
+        stop = stop or threading.Event()
+        for number in range(threads):
+            worker = f"{socket.gethostname()}:{os.getpid()}:{number}"
+            thread = threading.Thread(
+                target=job_worker_loop, args=(app, stop, worker), name=f"jobs-{number}", daemon=True
+            )
+            thread.start()
+            _job_threads.append(thread)
+        return _job_threads
 
-    # Seed gallery images if empty
-    cur.execute("SELECT COUNT(*) FROM gallery_images")
-    if cur.fetchone()[0] == 0:
-        sample_images = [
-            ("/static/images/gallery1.svg", "看板エスプレッソの一杯"),
-            ("/static/images/gallery2.svg", "イベントやポップアップの様子"),
-            ("/static/images/gallery3.svg", "季節のデザートとドリンクのペアリング"),
-        ]
-        for order, (path, caption) in enumerate(sample_images, start=1):
-            cur.execute(
-                "INSERT INTO gallery_images (file_path, caption, display_order, created_at) VALUES (?, ?, ?, ?)",
-                (path, caption, order, datetime.utcnow().isoformat()),
+
+def run_job_process(app: Flask, threads: int, nice: int = JOB_NICE) -> None:
+    # Blocks until SIGTERM / SIGINT; the job in hand is finished first.
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: (stop.set(), _job_wakeup.set()))
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+    workers = start_job_workers(app, threads, stop)
+    while not stop.is_set():
+        stop.wait(1.0)
+    for thread in workers:
+        thread.join()
+
+
+def job_summary(limit: int = JOB_DASHBOARD_LIMIT) -> dict:
+    conn = get_db_connection()
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    recent = conn.execute(
+        """
+        SELECT id, kind, status, attempts, max_attempts, last_error, updated_at
+        FROM jobs ORDER BY updated_at DESC, id DESC LIMIT ?
+        """,
+        (limit,),
+    ).fetchall()
+    return {"counts": counts, "recent": recent}
+
+
+def derivatives_job(app: Flask, payload: dict) -> None:
+    source = tenant_upload_folder() / Path(payload["filename"]).name
+    process_derivatives(app, payload["image_id"], source, UPLOAD_URL_PREFIX)
+
+
+def freeze_job(app: Flask, payload: dict) -> None:
+    freeze_pages(app)
+
+
+def purge_webhook_job(app: Flask, payload: dict) -> None:
+    post_purge_webhook(payload["url"], {"paths": payload["paths"], "changes": payload["changes"]})
+
+
+JOB_HANDLERS = {
+    "derivatives": derivatives_job,
+    "freeze": freeze_job,
+    "purge-webhook": purge_webhook_job,
+}
+
+
+# Login throttling
+#
+# Password hashes are deliberately expensive, so login attempts are rationed
+# before any hashing happens. Token buckets per client IP and per username
+# live in login_throttle and are shared by every worker; each process also
+# keeps a local mirror, which never holds fewer tokens than the shared row,
+# so a flood is turned away without touching the SQLite write lock. A flood
+# spread over many IPs finds every IP bucket full, so each process also
+# rations all of its attempts (LOGIN_PROCESS_BUCKET, about what its hashing
+# pool can verify) before the shared rows are read; those are checked with a
+# plain read and only a permitted attempt takes the write lock, and a lock
+# that stays busy turns into a 429 rather than an error. The username bucket
+# is charged only for failed passwords, so the admin's own logins never use
+# it up.
+# Verification runs on a small per-process pool with a bounded number of
+# slots: when they are taken the request is refused at once instead of
+# queueing, so logins can tie up at most a few request threads and cores
+# (and, with scrypt, a bounded amount of memory). Hashes made with an older
+# PASSWORD_HASH_METHOD are replaced on the next successful login.
+
+LOGIN_IP_BUCKET = (10, 10 / 60)  # burst, tokens refilled per second
+LOGIN_USER_BUCKET = (5, 5 / 300)
+LOGIN_PROCESS_BUCKET = (20, 20.0)
+LOGIN_BUSY_RETRY_SECONDS = 1.0
+LOGIN_LOCAL_BUCKETS = 10_000
+# A row idle this long has refilled completely and can be dropped.
+LOGIN_THROTTLE_IDLE = max(burst / rate for burst, rate in (LOGIN_IP_BUCKET, LOGIN_USER_BUCKET))
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_SLOTS = 6
+
+
+class PasswordHashBusy(RuntimeError):
+    pass
+
+
+class TokenBuckets:
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst: float, rate: float, now: float, cost: int = 1) -> float:
+        # Returns 0 when a token was taken, otherwise the seconds until one
+        # will be available. cost=0 only checks.
+        with self._lock:
+            tokens, updated = self._entries.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._entries[key] = (tokens - cost if allowed else tokens, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return 0.0 if allowed else (1 - tokens) / rate
+
+
+login_buckets = TokenBuckets(LOGIN_LOCAL_BUCKETS)
+
+_password_pool: ThreadPoolExecutor | None = None
+_password_pool_lock = threading.Lock()
+_password_slots = threading.BoundedSemaphore(PASSWORD_HASH_SLOTS)
+
+
+def _reset_password_pool() -> None:
+    global _password_pool, _password_slots
+    _password_pool = None
+    _password_slots = threading.BoundedSemaphore(PASSWORD_HASH_SLOTS)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_password_pool)
+
+
+def password_pool() -> ThreadPoolExecutor:
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            _password_pool = ThreadPoolExecutor(
+                max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
             )
+        return _password_pool
 
-    # Seed feature cards if empty
-    cur.execute("SELECT COUNT(*) FROM features")
-    if cur.fetchone()[0] == 0:
-        sample_features = [
-            (
-                "季節のペアリング",
-                "コーヒーごとに相性を考えた、季節限定のデザートセットをご用意しています。",
-                "fa-leaf",
-            ),
-            (
-                "アコースティックナイト",
-                "週末の夜には、地域のアーティストによる生演奏をお楽しみいただけます。",
-                "fa-music",
-            ),
-            (
-                "バリスタワークショップ",
-                "ご自宅でも楽しめるハンドドリップ講座など、少人数制のワークショップを開催しています。",
-                "fa-chalkboard-teacher",
-            ),
-        ]
-        for title, description, icon in sample_features:
-            cur.execute(
-                "INSERT INTO features (title, description, icon) VALUES (?, ?, ?)",
-                (title, description, icon),
+
+def _shared_tokens(conn: sqlite3.Connection, key: str, burst: float, rate: float, now: float) -> float:
+    row = conn.execute(
+        "SELECT tokens, updated_at FROM login_throttle WHERE key = ?", (key,)
+    ).fetchone()
+    return burst if row is None else min(burst, row["tokens"] + (now - row["updated_at"]) * rate)
+
+
+def _take_shared_token(
+    conn: sqlite3.Connection, key: str, burst: float, rate: float, now: float
+) -> float:
+    tokens = _shared_tokens(conn, key, burst, rate, now)
+    if tokens < 1:
+        return (1 - tokens) / rate
+    conn.execute(
+        """
+        INSERT INTO login_throttle (key, tokens, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+        """,
+        (key, tokens - 1, now),
+    )
+    return 0.0
+
+
+def acquire_login_attempt(remote_addr: str | None, username: str) -> float:
+    now = time.time()
+    ip_key, user_key = f"ip:{remote_addr or ''}", f"user:{username.lower()}"
+    tenant = current_tenant().name
+    for key, bucket, cost in (
+        ("process", LOGIN_PROCESS_BUCKET, 1),
+        ((tenant, user_key), LOGIN_USER_BUCKET, 0),
+        ((tenant, ip_key), LOGIN_IP_BUCKET, 1),
+    ):
+        wait = login_buckets.take(key, *bucket, now, cost)
+        if wait:
+            return wait
+    try:
+        conn = get_db_connection()
+        for key, (burst, rate) in ((user_key, LOGIN_USER_BUCKET), (ip_key, LOGIN_IP_BUCKET)):
+            tokens = _shared_tokens(conn, key, burst, rate, now)
+            if tokens < 1:
+                return (1 - tokens) / rate
+        with write_transaction() as conn:
+            conn.execute(
+                "DELETE FROM login_throttle WHERE updated_at < ?", (now - LOGIN_THROTTLE_IDLE,)
             )
+            return _take_shared_token(conn, ip_key, *LOGIN_IP_BUCKET, now)
+    except sqlite3.OperationalError:
+        logger.warning("Login throttle is busy; refusing an attempt for %r", username)
+        return LOGIN_BUSY_RETRY_SECONDS
 
-    cur.execute("SELECT COUNT(*) FROM announcements")
-    if cur.fetchone()[0] == 0:
-        cur.execute(
-            "INSERT INTO announcements (title, content, published_at) VALUES (?, ?, ?)",
-            (
-                "本日のおすすめ豆が変わりました",
-                "季節のおすすめや新入荷の豆など、最新情報をここでお知らせできます。",
-                datetime.utcnow().isoformat(),
-            ),
-        )
 
+def record_login_failure(username: str) -> None:
+    now = time.time()
+    key = f"user:{username.lower()}"
+    login_buckets.take((current_tenant().name, key), *LOGIN_USER_BUCKET, now)
+    try:
+        with write_transaction() as conn:
+            _take_shared_token(conn, key, *LOGIN_USER_BUCKET, now)
+    except sqlite3.OperationalError:
+        logger.warning("Login throttle is busy; failed attempt for %r not recorded", username)
 
-def allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+
+@lru_cache(maxsize=4)
+def password_policy(method: str) -> tuple[str, str]:
+    # The prefix werkzeug writes for this method (default cost filled in)
+    # and a throwaway hash of that cost, checked for unknown usernames so
+    # they take as long as real ones.
+    dummy = generate_password_hash(secrets.token_hex(16), method)
+    return dummy.split("$", 1)[0], dummy
+
+
+def _verify_password(stored: str | None, password: str, method: str) -> tuple[bool, str | None]:
+    prefix, dummy = password_policy(method)
+    if not check_password_hash(stored or dummy, password) or stored is None:
+        return False, None
+    if stored.split("$", 1)[0] != prefix:
+        return True, generate_password_hash(password, method)
+    return True, None
+
+
+def run_password_hash(func, *args):
+    if not _password_slots.acquire(blocking=False):
+        raise PasswordHashBusy
+    try:
+        return password_pool().submit(func, *args).result()
+    finally:
+        _password_slots.release()
+
+
+def verify_login(username: str, password: str, method: str):
+    user = get_db_connection().execute(
+        "SELECT * FROM users WHERE username = ?", (username,)
+    ).fetchone()
+    stored = user["password_hash"] if user else None
+    valid, upgraded = run_password_hash(_verify_password, stored, password, method)
+    if not valid:
+        return None
+    if upgraded:
+        with write_transaction() as conn:
+            conn.execute(
+                "UPDATE users SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                (upgraded, user["id"], stored),
+            )
+    return user
+
+
+# Structured extra_info
+#
+# Staff still edit extra_info as "key=value" lines (or "|"-separated pairs).
+# It is parsed once when saved and stored as JSON in extra_data, so
+# templates read content['extra'] instead of splitting strings per render.
+
+EXTRA_INFO_LIST_KEYS = {"team"}
+EXTRA_INFO_LINK_KEYS = {"link"}
+
+
+class ExtraInfoError(ValueError):
+    pass
+
+
+def parse_extra_info(section: str, text: str | None, strict: bool = True) -> dict:
+    extra = {}
+    for part in re.split(r"[\n|]", text or ""):
+        part = part.strip()
+        if not part:
+            continue
+        key, separator, value = part.partition("=")
+        key, value = key.strip(), value.strip()
+        if not separator or not key:
+            if strict:
+                raise ExtraInfoError(f"「{part}」は キー=値 の形式になっていません。")
+            continue
+        if key in EXTRA_INFO_LINK_KEYS and not re.match(r"^(https?://|/|#|tel:|mailto:)", value):
+            if strict:
+                raise ExtraInfoError(f"{key} には http(s)://、/、# で始まるURLを指定してください。")
+            continue
+        if key in EXTRA_INFO_LIST_KEYS:
+            value = [item.strip() for item in re.split(r"[,、]", value) if item.strip()]
+        extra[key] = value
+    return extra
+
+
+def dump_extra_info(extra: dict) -> str:
+    return json.dumps(extra, ensure_ascii=False, separators=(",", ":"))
 
 
 # Utility functions
 
+def content_scope(section: str) -> str:
+    return f"site_content:{section}"
+
+
 def fetch_content(section: str):
-    conn = get_db_connection()
-    row = conn.execute(
-        "SELECT * FROM site_content WHERE section = ?", (section,)
-    ).fetchone()
-    conn.close()
-    # Row → dict にして返す（存在しなければ None）
-    return dict(row) if row is not None else None
+    def load():
+        records = to_records(
+            get_db_connection().execute(
+                "SELECT * FROM site_content WHERE section = ?", (section,)
+            )
+        )
+        # 存在しなければ None
+        if not records:
+            return None
+        record = records[0]
+        extra = json.loads(record["extra_data"]) if record["extra_data"] else {}
+        return record_type(record._fields + ("extra",))(*record, extra)
+
+    return cached_query(content_scope(section), ("site_content", section), load)
 
 
 
 def update_content(section: str, data: dict) -> None:
+    extra = parse_extra_info(section, data.get("extra_info"))
     conn = get_db_connection()
     conn.execute(
         """
         UPDATE site_content
-        SET title = ?, subtitle = ?, body = ?, highlight = ?, image = ?, extra_info = ?
+        SET title = ?, subtitle = ?, body = ?, highlight = ?, image = ?, extra_info = ?,
+            extra_data = ?
         WHERE section = ?
         """,
         (
@@ -298,94 +2986,563 @@ def update_content(section: str, data: dict) -> None:
             data.get("highlight"),
             data.get("image"),
             data.get("extra_info"),
+            dump_extra_info(extra),
             section,
         ),
     )
+    record_change(conn, content_scope(section), "site_content", section, "update")
     conn.commit()
-    conn.close()
+
+
+# Response compression
+#
+# Dynamic responses are gzip- or brotli-encoded here according to
+# Accept-Encoding (brotli preferred when the module is installed). Each
+# content type has its own policy: a minimum size below which the framing
+# costs more than it saves, the compression levels, and whether a streamed
+# body is flushed after every chunk (HTML, so early bytes stay early) or
+# left to the compressor (exports). Files are skipped: fingerprinted assets
+# already have .gz / .br siblings, and uploads are images. An encoded
+# response's ETag is downgraded to a weak one, because the bytes now depend
+# on the encoding; If-None-Match uses weak comparison, so the 304s issued
+# by cached_page() keep working for every encoding.
+
+CompressionPolicy = namedtuple("CompressionPolicy", "min_size gzip_level brotli_quality flush")
+
+COMPRESSION_POLICIES = {
+    "text/html": CompressionPolicy(1024, 6, 5, True),
+    "text/plain": CompressionPolicy(1024, 6, 5, True),
+    "text/css": CompressionPolicy(1024, 6, 5, False),
+    "text/javascript": CompressionPolicy(1024, 6, 5, False),
+    "application/javascript": CompressionPolicy(1024, 6, 5, False),
+    "application/json": CompressionPolicy(1024, 6, 5, False),
+    "image/svg+xml": CompressionPolicy(1024, 6, 5, False),
+    "text/csv": CompressionPolicy(4096, 6, 4, False),
+}
+
+
+def negotiate_encoding() -> str | None:
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip") if brotli is not None else ("gzip",):
+        if accepted[encoding]:
+            return encoding
+    return None
+
+
+def compress_data(data: bytes, encoding: str, policy: CompressionPolicy) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=policy.brotli_quality)
+    return gzip.compress(data, compresslevel=policy.gzip_level, mtime=0)
+
+
+def compress_chunks(chunks, encoding: str, policy: CompressionPolicy):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=policy.brotli_quality)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    else:
+        compressor = zlib.compressobj(policy.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)  # noqa: E731
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = process(chunk)
+            if policy.flush:
+                data += flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def compress_response(response):
+    policy = COMPRESSION_POLICIES.get(response.mimetype)
+    if (
+        policy is None
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or response.status_code not in (200, 304)
+        or "no-transform" in response.headers.get("Cache-Control", "")
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, encoding, policy)
+        response.headers.pop("Content-Length", None)
+    elif response.status_code == 200:
+        data = response.get_data()
+        if len(data) < policy.min_size:
+            return response
+        compressed = compress_data(data, encoding, policy)
+        if len(compressed) >= len(data):
+            return response
+        response.set_data(compressed)
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    if response.status_code == 200:
+        response.content_encoding = encoding
+    return response
+
+
+def register_compression(app: Flask) -> None:
+    if app.config["COMPRESS_RESPONSES"]:
+        # Registered before the other hooks, so it runs after all of them.
+        app.after_request(compress_response)
+
+
+# Instrumentation
+#
+# Every request records wall time, template render time and the SQL it ran;
+# a streamed response is recorded once its last chunk has been sent, so
+# the time spent rendering while sending counts too. Per-endpoint
+# aggregates are exposed in the Prometheus text format at /admin/metrics;
+# requests slower than SLOW_REQUEST_MS are logged together with their
+# statements. Under `serve` each worker also writes its totals to
+# <pid>.json in a metrics folder shared by the master and its workers, at
+# most once per METRICS_FLUSH_SECONDS, and a scrape answered by any worker
+# adds up every file. When a worker exits the master folds its last totals
+# into retired.json, so counters only grow while workers come and go; the
+# cache entry gauges cover live workers only.
+
+METRICS_FLUSH_SECONDS = 1.0
+METRICS_RETIRED = "retired"
+METRIC_SUMS = ("count", "sum", "sql_count", "sql_seconds", "render_seconds")
+CACHE_COUNTERS = ("hits", "misses", "evictions")
+
+
+@contextmanager
+def metrics_lock(folder: Path, shared: bool = False):
+    # Keeps a scrape from seeing a worker both in its own file and in
+    # retired.json (or in neither). Without fcntl the window stays open.
+    if fcntl is None:
+        yield
+        return
+    with open(folder / ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_metrics_file(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def merge_metrics(snapshots) -> dict:
+    endpoints, caches = {}, {}
+    for snapshot in snapshots:
+        for name, stats in snapshot["endpoints"].items():
+            total = endpoints.setdefault(
+                name, {"buckets": [0] * len(stats["buckets"]), **dict.fromkeys(METRIC_SUMS, 0)}
+            )
+            total["buckets"] = [a + b for a, b in zip(total["buckets"], stats["buckets"])]
+            for key in METRIC_SUMS:
+                total[key] += stats[key]
+        for name, stats in snapshot["caches"].items():
+            total = caches.setdefault(name, dict.fromkeys((*CACHE_COUNTERS, "entries"), 0))
+            for key in total:
+                total[key] += stats.get(key, 0)
+    return {"endpoints": endpoints, "caches": caches}
+
+
+def retire_worker_metrics(folder: Path | None, pids) -> None:
+    if folder is None:
+        return
+    with metrics_lock(folder):
+        paths = [folder / f"{pid}.json" for pid in pids]
+        snapshots = [snapshot for snapshot in map(read_metrics_file, paths) if snapshot]
+        if not snapshots:
+            return
+        retired_path = folder / f"{METRICS_RETIRED}.json"
+        retired = read_metrics_file(retired_path) or {"endpoints": {}, "caches": {}}
+        merged = merge_metrics([retired, *snapshots])
+        for stats in merged["caches"].values():
+            stats["entries"] = 0  # a retired worker's cache is gone
+        _write_atomic(retired_path, json.dumps(merged).encode("utf-8"))
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+
+class RequestMetrics:
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._endpoints: dict[str, dict] = {}
+        self._folder: Path | None = None
+        self._dirty = False
+
+    def observe(self, endpoint: str, seconds: float, queries: list, render_seconds: float) -> None:
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = {
+                    "buckets": [0] * len(self.buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                    "sql_count": 0,
+                    "sql_seconds": 0.0,
+                    "render_seconds": 0.0,
+                }
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats["buckets"][index] += 1
+            stats["count"] += 1
+            stats["sum"] += seconds
+            stats["sql_count"] += len(queries)
+            stats["sql_seconds"] += sum(duration for _, duration in queries)
+            stats["render_seconds"] += render_seconds
+            self._dirty = True
+
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            endpoints = {
+                name: dict(stats, buckets=list(stats["buckets"]))
+                for name, stats in self._endpoints.items()
+            }
+        caches = {name: cache.stats() for name, cache in (("query", query_cache), ("page", page_cache))}
+        return {"endpoints": endpoints, "caches": caches}
+
+    def share(self, folder: Path) -> None:
+        # Called in a worker right after fork(); the flusher thread is its own.
+        self._folder = folder
+        threading.Thread(target=self._flush_loop, name="metrics", daemon=True).start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception("Could not write worker metrics")
+
+    def flush(self) -> None:
+        if self._folder is None or not self._dirty:
+            return
+        self._dirty = False
+        _write_atomic(self._folder / f"{os.getpid()}.json", json.dumps(self.snapshot()).encode("utf-8"))
+
+    def render(self) -> str:
+        snapshots, workers = [self.snapshot()], 1
+        if self._folder is not None:
+            own = f"{os.getpid()}.json"
+            with metrics_lock(self._folder, shared=True):
+                for path in self._folder.glob("*.json"):
+                    snapshot = read_metrics_file(path) if path.name != own else None
+                    if snapshot:
+                        snapshots.append(snapshot)
+                        workers += path.stem != METRICS_RETIRED
+        merged = merge_metrics(snapshots)
+        endpoints = merged["endpoints"]
+        lines = [
+            "# HELP cafe_request_duration_seconds Wall time per request.",
+            "# TYPE cafe_request_duration_seconds histogram",
+        ]
+        for name, stats in sorted(endpoints.items()):
+            label = f'endpoint="{name}"'
+            for bound, count in zip(self.buckets, stats["buckets"]):
+                lines.append(f'cafe_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'cafe_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats["count"]}')
+            lines.append(f"cafe_request_duration_seconds_sum{{{label}}} {stats['sum']:.6f}")
+            lines.append(f"cafe_request_duration_seconds_count{{{label}}} {stats['count']}")
+        for metric, key, help_text in (
+            ("cafe_sql_queries_total", "sql_count", "SQL statements executed."),
+            ("cafe_sql_duration_seconds_total", "sql_seconds", "Time spent in SQL statements."),
+            ("cafe_template_render_seconds_total", "render_seconds", "Time spent rendering templates."),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stats in sorted(endpoints.items()):
+                value = stats[key]
+                formatted = value if isinstance(value, int) else f"{value:.6f}"
+                lines.append(f'{metric}{{endpoint="{name}"}} {formatted}')
+        for cache_name, cache_stats in sorted(merged["caches"].items()):
+            for key in CACHE_COUNTERS:
+                metric = f"cafe_{cache_name}_cache_{key}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {cache_stats[key]}")
+            lines.append(f"# TYPE cafe_{cache_name}_cache_entries gauge")
+            lines.append(f"cafe_{cache_name}_cache_entries {cache_stats['entries']}")
+        lines.append("# HELP cafe_metrics_workers Live processes whose metrics are included.")
+        lines.append("# TYPE cafe_metrics_workers gauge")
+        lines.append(f"cafe_metrics_workers {workers}")
+        return "\n".join(lines) + "\n"
+
+
+request_metrics = RequestMetrics(LATENCY_BUCKETS)
+
+
+def record_query(sql: str, seconds: float) -> None:
+    if has_request_context():
+        log = g.get("_query_log")
+        if log is not None:
+            log.append((sql, seconds))
+
+
+def register_instrumentation(app: Flask) -> None:
+    @app.before_request
+    def start_request_timer():
+        g._request_started = time.perf_counter()
+        g._query_log = []
+        g._render_seconds = 0.0
+
+    def start_render_timer(sender, template, context, **extra):
+        g._render_started = time.perf_counter()
+
+    def stop_render_timer(sender, template, context, **extra):
+        started = g.pop("_render_started", None)
+        if started is not None:
+            g._render_seconds += time.perf_counter() - started
+
+    # Signals hold receivers weakly; these closures have no other owner.
+    before_render_template.connect(start_render_timer, app, weak=False)
+    template_rendered.connect(stop_render_timer, app, weak=False)
+
+    def observe_request(state, method: str, path: str, endpoint: str) -> None:
+        # state is the request's g; a streamed body may outlive its context.
+        elapsed = time.perf_counter() - state._request_started
+        queries = state._query_log
+        request_metrics.observe(endpoint, elapsed, queries, state._render_seconds)
+        if elapsed * 1000 >= app.config["SLOW_REQUEST_MS"]:
+            repeated = any(count > 1 for count in Counter(sql for sql, _ in queries).values())
+            logger.warning(
+                "Slow request %s %s (%s): %.1f ms, %d queries%s\n%s",
+                method,
+                path,
+                endpoint,
+                elapsed * 1000,
+                len(queries),
+                " (repeated statements: possible N+1)" if repeated else "",
+                "\n".join(
+                    f"  {duration * 1000:8.2f} ms  {' '.join(sql.split())[:200]}"
+                    for sql, duration in sorted(queries, key=lambda query: -query[1])
+                ),
+            )
+
+    @app.after_request
+    def record_request(response):
+        state = g._get_current_object()
+        if "_request_started" not in state:
+            return response
+        args = (state, request.method, request.path, request.endpoint or "unmatched")
+        if response.is_streamed:
+            response.call_on_close(lambda: observe_request(*args))
+        else:
+            observe_request(*args)
+        return response
 
 
 # Route registration
 
 def register_routes(app: Flask) -> None:
-    @app.context_processor
-    def inject_navigation():
-        return dict(
-            nav_links=[
-                ("ホーム", "main.top"),
-                ("アクセス", "main.access"),
-                ("予約", "main.reservations"),
-                ("ギャラリー", "main.gallery"),
-                ("ストーリー", "main.about"),
-                ("ハイライト", "main.features"),
-            ]
-        )
-
-    @app.context_processor
-    def inject_now():
-        return dict(now=datetime.utcnow)
+    # Globals rather than context processors: nothing runs per render.
+    app.jinja_env.globals.update(
+        nav_links=NAV_LINKS,
+        fragment=lambda name: render_fragment(app, name),
+        flush_point=lambda: STREAM_FLUSH_MARK if streaming_page() else "",
+    )
+
+    @app.url_defaults
+    def fingerprint_static_urls(endpoint, values):
+        if endpoint == "static" and "filename" in values:
+            manifest = app.extensions["asset_manifest"]
+            values["filename"] = manifest.get(values["filename"], values["filename"])
+
+    app.view_functions["static"] = lambda filename: serve_static_file(app, filename)
+
+    @app.after_request
+    def announce_changes(response):
+        dispatch_changes(app)
+        return response
+
+    @app.after_request
+    def refreeze_changed_pages(response):
+        # Runs before announce_changes(), which consumes the recorded seqs.
+        # Only admin requests that wrote content queue a pass, so rejected
+        # logins and failed forms never take the write lock. Admin views
+        # commit before returning, so every generation they bumped is
+        # visible to the job and only pages with stale stamps re-render.
+        # Pending freeze jobs collapse, so a burst of edits costs one pass.
+        if (
+            app.config["FREEZE_PAGES"]
+            and request.method == "POST"
+            and request.endpoint != "admin.login"
+            and (request.endpoint or "").startswith("admin.")
+            and g.get("_recorded_changes")
+        ):
+            enqueue_job("freeze")
+        return response
+
+    @app.template_filter("asset_url")
+    def asset_url_filter(path: str | None) -> str | None:
+        # Content rows store plain /static/... paths; map them to the
+        # fingerprinted URL when the file is part of the build.
+        if path and path.startswith("/static/"):
+            filename = path[len("/static/"):]
+            if filename in app.extensions["asset_manifest"]:
+                return url_for("static", filename=filename)
+        return path
+
+    @app.template_filter("srcset")
+    def srcset_filter(raw_variants: str | None, mime_type: str | None = None) -> str:
+        # mime_type=None selects the non-WebP fallback set for <img srcset>.
+        return ", ".join(
+            f"{src} {width}w"
+            for width, src, variant_type in parse_variants(raw_variants)
+            if (variant_type == mime_type if mime_type else variant_type != "image/webp")
+        )
+
+    def cached_page(view_func):
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            g._stream_page = app.config["STREAM_TEMPLATES"] and request.endpoint in STREAMED_ENDPOINTS
+            page = render_cached_page(
+                request.endpoint, lambda: view_func(*args, **kwargs)
+            )
+            if isinstance(page, StreamedPage):
+                # No ETag until the page has been rendered once; Last-Modified
+                # still lets a returning browser revalidate. Without implicit
+                # sequence conversion make_conditional() cannot buffer the body
+                # to measure it.
+                response = app.response_class(page.chunks, mimetype="text/html")
+                response.implicit_sequence_conversion = False
+            elif isinstance(page, CachedPage):
+                response = app.response_class(page.body, mimetype="text/html")
+                response.set_etag(page.etag)
+            else:
+                return page
+            if page.last_modified is not None:
+                response.last_modified = page.last_modified
+            response.cache_control.public = True
+            response.cache_control.max_age = app.config["PAGE_CACHE_MAX_AGE"]
+            response.cache_control.must_revalidate = True
+            return response.make_conditional(request)
+
+        return wrapper
+
+    def logged_in() -> bool:
+        # All tenants share SECRET_KEY, so a session is only valid on the
+        # host that issued it.
+        return bool(session.get("user_id")) and session.get("tenant", "") == current_tenant().name
 
     def login_required(view_func):
         @wraps(view_func)
         def wrapper(*args, **kwargs):
-            if not session.get("user_id"):
+            if not logged_in():
                 flash("ログインが必要です。", "warning")
                 return redirect(url_for("admin.login"))
             return view_func(*args, **kwargs)
 
         return wrapper
 
+    def token_required(view_func):
+        # For machine clients: a CHANGE_FEED_TOKEN bearer token, or the
+        # admin's own session. Without a configured token only the latter.
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            token = app.config["CHANGE_FEED_TOKEN"]
+            scheme, _, supplied = request.headers.get("Authorization", "").partition(" ")
+            if logged_in() or (
+                token and scheme.lower() == "bearer" and secrets.compare_digest(supplied.strip(), token)
+            ):
+                return view_func(*args, **kwargs)
+            return {"error": "認証が必要です。"}, 401, {"WWW-Authenticate": "Bearer", "Cache-Control": "no-store"}
+
+        return wrapper
+
     # Public pages blueprint-like grouping
+    @cached_page
     def top():
-        content = fetch_content("top")
-        features = fetch_features()
-        announcements = fetch_announcements()
-        gallery = fetch_gallery(limit=4)
-        return render_template(
-            "site/top.html",
-            content=content,
-            features=features,
-            announcements=announcements,
-            gallery=gallery,
-        )
+        return render_page("site/top.html", **load_top_page())
 
+    @cached_page
     def access():
         content = fetch_content("access")
         return render_template("site/access.html", content=content)
 
+    @cached_page
     def reservations():
         content = fetch_content("reservations")
         return render_template("site/reservations.html", content=content)
 
+    @cached_page
     def gallery():
-        images = fetch_gallery()
-        return render_template("site/gallery.html", images=images)
+        images = fetch_gallery(after=request.args.get("after"))
+        return render_page("site/gallery.html", images=images)
 
+    @cached_page
     def about():
-        content = fetch_content("about")
-        announcements = fetch_announcements()
-        return render_template("site/about.html", content=content, announcements=announcements)
+        with read_snapshot():
+            content = fetch_content("about")
+            announcements = fetch_announcements(after=request.args.get("after"))
+        return render_page("site/about.html", content=content, announcements=announcements)
 
+    @cached_page
     def features_page():
-        content = fetch_content("features")
-        features = fetch_features()
+        with read_snapshot():
+            content = fetch_content("features")
+            features = fetch_features()
         return render_template("site/features.html", content=content, features=features)
 
+    def search():
+        query = request.args.get("q", "").strip()
+        results = search_site(query, after=request.args.get("after"))
+        return render_template(
+            "site/search.html", query=query, results=results, kind_labels=SEARCH_KIND_LABELS
+        )
+
+    @app.template_global()
+    def search_hit_url(hit: SearchHit, admin: bool = False) -> str:
+        if admin:
+            if hit.kind == "content":
+                return url_for("admin.edit_content", section=hit.ref)
+            if hit.kind == "announcement":
+                return url_for("admin.manage_announcements")
+            return url_for("admin.manage_features")
+        if hit.kind == "content":
+            return url_for(f"main.{hit.ref}")
+        return url_for("main.about" if hit.kind == "announcement" else "main.features")
+
     # Admin routes
     def login():
         if request.method == "POST":
             username = request.form.get("username", "").strip()
             password = request.form.get("password", "")
-            conn = get_db_connection()
-            user = conn.execute(
-                "SELECT * FROM users WHERE username = ?", (username,)
-            ).fetchone()
-            conn.close()
-            if user and check_password_hash(user["password_hash"], password):
+            retry_after = acquire_login_attempt(request.remote_addr, username)
+            if retry_after:
+                flash("ログインの試行回数が上限に達しました。しばらくしてから再度お試しください。", "danger")
+                return (
+                    render_template("admin/login.html"),
+                    429,
+                    {"Retry-After": str(math.ceil(retry_after))},
+                )
+            try:
+                user = verify_login(username, password, app.config["PASSWORD_HASH_METHOD"])
+            except PasswordHashBusy:
+                flash("ただいまログインが混み合っています。少し待ってから再度お試しください。", "warning")
+                return render_template("admin/login.html"), 503, {"Retry-After": "1"}
+            if user:
                 session["user_id"] = user["id"]
                 session["username"] = user["username"]
+                session["tenant"] = current_tenant().name
                 flash("ログインしました。", "success")
                 return redirect(url_for("admin.dashboard"))
+            record_login_failure(username)
             flash("ログインに失敗しました。", "danger")
         return render_template("admin/login.html")
 
@@ -397,16 +3554,21 @@ def register_routes(app: Flask) -> None:
 
     @login_required
     def dashboard():
-        contents = fetch_all_content()
-        stats = {
-            "gallery_count": len(fetch_gallery()),
-            "feature_count": len(fetch_features()),
-            "announcement_count": len(fetch_announcements()),
-        }
         return render_template(
-            "admin/dashboard.html", contents=contents, stats=stats
+            "admin/dashboard.html",
+            cache_stats=query_cache.stats(),
+            jobs=job_summary(),
+            **load_dashboard_page(),
         )
 
+    @login_required
+    def retry_failed_job(job_id):
+        if retry_job(job_id):
+            flash("ジョブを再実行待ちに戻しました。", "success")
+        else:
+            flash("再実行できるジョブが見つかりません。", "warning")
+        return redirect(url_for("admin.dashboard"))
+
     @login_required
     def edit_content(section):
         content = fetch_content(section)
@@ -422,7 +3584,13 @@ def register_routes(app: Flask) -> None:
                 "image": request.form.get("image"),
                 "extra_info": request.form.get("extra_info"),
             }
-            update_content(section, data)
+            try:
+                update_content(section, data)
+            except ExtraInfoError as exc:
+                flash(f"追加情報を保存できませんでした: {exc}", "danger")
+                return render_template(
+                    "admin/edit_content.html", content=dict(content, **data)
+                )
             flash("更新しました。", "success")
             return redirect(url_for("admin.edit_content", section=section))
         return render_template("admin/edit_content.html", content=content)
@@ -433,29 +3601,49 @@ def register_routes(app: Flask) -> None:
             action = request.form.get("action")
             if action == "delete":
                 image_id = request.form.get("image_id")
-                delete_gallery_image(image_id)
+                delete_gallery_image(image_id, tenant_upload_folder())
                 flash("画像を削除しました。", "info")
             else:
                 file = request.files.get("image")
                 caption = request.form.get("caption")
                 if file and allowed_file(file.filename):
-                    filename = secure_filename(file.filename)
-                    save_path = Path(app.config["UPLOAD_FOLDER"]) / filename
-                    counter = 1
-                    base, ext = os.path.splitext(filename)
-                    while save_path.exists():
-                        filename = f"{base}_{counter}{ext}"
-                        save_path = Path(app.config["UPLOAD_FOLDER"]) / filename
-                        counter += 1
-                    file.save(save_path)
-                    store_path = f"/static/uploads/{filename}"
-                    add_gallery_image(store_path, caption)
-                    flash("ギャラリーを更新しました。", "success")
+                    upload_folder = tenant_upload_folder()
+                    staged = stage_upload(file, upload_folder)
+                    image_id, status = add_gallery_upload(staged, caption, upload_folder)
+                    if status == "processing":
+                        schedule_derivatives(image_id, upload_folder / staged.filename)
+                        flash("ギャラリーを更新しました。画像サイズを最適化しています。", "success")
+                    else:
+                        flash("ギャラリーを更新しました。", "success")
                 else:
                     flash("画像ファイルを選択してください。", "warning")
-        images = fetch_gallery()
+        images = fetch_gallery(limit=ADMIN_PAGE_SIZE, after=request.args.get("after"))
         return render_template("admin/manage_gallery.html", images=images)
 
+    @login_required
+    def reorder_gallery():
+        # {"id": 3, "after": 7} / {"id": 3, "before": 7} moves one image;
+        # {"order": [7, 3, 5]} reorders the listed images among themselves.
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return {"error": "JSON 形式で指定してください。"}, 400
+        try:
+            if "order" in payload:
+                updated = apply_gallery_order([int(image_id) for image_id in payload["order"]])
+            else:
+                after, before = payload.get("after"), payload.get("before")
+                move_gallery_image(
+                    int(payload["id"]),
+                    None if after is None else int(after),
+                    None if before is None else int(before),
+                )
+                updated = 1
+        except GalleryOrderError as exc:
+            return {"error": str(exc)}, 400
+        except (KeyError, TypeError, ValueError):
+            return {"error": "並び順の指定が正しくありません。"}, 400
+        return {"updated": updated}
+
     @login_required
     def manage_features():
         if request.method == "POST":
@@ -474,21 +3662,99 @@ def register_routes(app: Flask) -> None:
         return render_template("admin/manage_features.html", features=features)
 
     @login_required
-    def manage_announcements():
-        if request.method == "POST":
-            action = request.form.get("action")
-            if action == "add":
-                title = request.form.get("title")
-                content = request.form.get("content")
-                add_announcement(title, content)
-                flash("お知らせを追加しました。", "success")
-            elif action == "delete":
-                announcement_id = request.form.get("announcement_id")
-                delete_announcement(announcement_id)
-                flash("お知らせを削除しました。", "info")
-        announcements = fetch_announcements()
+    def manage_announcements():
+        if request.method == "POST":
+            action = request.form.get("action")
+            if action == "add":
+                title = request.form.get("title")
+                content = request.form.get("content")
+                add_announcement(title, content)
+                flash("お知らせを追加しました。", "success")
+            elif action == "delete":
+                announcement_id = request.form.get("announcement_id")
+                delete_announcement(announcement_id)
+                flash("お知らせを削除しました。", "info")
+        announcements = fetch_announcements(
+            limit=ADMIN_PAGE_SIZE, after=request.args.get("after")
+        )
+        return render_template(
+            "admin/manage_announcements.html", announcements=announcements
+        )
+
+    @login_required
+    def bulk_import():
+        if request.method == "POST":
+            entity = request.form.get("entity", "")
+            file = request.files.get("file")
+            if not file or not file.filename:
+                flash("取り込むファイルを選択してください。", "warning")
+                return redirect(url_for("admin.bulk_import"))
+            job_id = request.form.get("job_id", "")
+            try:
+                imported = import_upload(
+                    entity,
+                    file,
+                    tenant_upload_folder(),
+                    job_id if JOB_ID_PATTERN.match(job_id) else None,
+                )
+            except BulkImportError as exc:
+                flash(f"取り込みを中止しました。{exc}", "danger")
+                return redirect(url_for("admin.bulk_import"))
+            flash(f"{imported} 件を取り込みました。", "success")
+            return redirect(url_for("admin.bulk_import"))
+        return render_template(
+            "admin/bulk_import.html",
+            entities=BULK_ENTITIES,
+            job_id=secrets.token_hex(8),
+        )
+
+    @login_required
+    def import_progress(job_id):
+        progress = read_import_progress(job_id)
+        if progress is None:
+            return {"state": "unknown"}, 404
+        return progress
+
+    @login_required
+    def bulk_export(entity, fmt):
+        valid = entity in BULK_ENTITIES and fmt in ("csv", "json", "zip")
+        if not valid or (fmt == "zip" and entity != "gallery"):
+            flash("エクスポートの形式が正しくありません。", "danger")
+            return redirect(url_for("admin.bulk_import"))
+        if fmt == "csv":
+            body, mimetype = export_csv(entity), "text/csv"
+        elif fmt == "json":
+            body, mimetype = export_json(entity), "application/json"
+        else:
+            body, mimetype = export_gallery_zip(tenant_upload_folder()), "application/zip"
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        return app.response_class(
+            stream_with_context(body),
+            mimetype=mimetype,
+            headers={"Content-Disposition": f'attachment; filename="{entity}-{stamp}.{fmt}"'},
+        )
+
+    @login_required
+    def admin_search():
+        query = request.args.get("q", "").strip()
+        results = search_site(query, limit=ADMIN_PAGE_SIZE, after=request.args.get("after"))
         return render_template(
-            "admin/manage_announcements.html", announcements=announcements
+            "admin/search.html", query=query, results=results, kind_labels=SEARCH_KIND_LABELS
+        )
+
+    @token_required
+    def change_feed():
+        try:
+            since = max(0, int(request.args.get("since", 0)))
+            limit = int(request.args.get("limit", CHANGE_FEED_LIMIT))
+        except ValueError:
+            return {"error": "since と limit は整数で指定してください。"}, 400
+        return fetch_changes(since, limit), 200, {"Cache-Control": "no-store"}
+
+    @login_required
+    def metrics():
+        return app.response_class(
+            request_metrics.render(), mimetype="text/plain; version=0.0.4"
         )
 
     # Blueprint naming compatibility for nav
@@ -500,6 +3766,8 @@ def register_routes(app: Flask) -> None:
     app.add_url_rule("/gallery", endpoint="main.gallery", view_func=gallery)
     app.add_url_rule("/about", endpoint="main.about", view_func=about)
     app.add_url_rule("/highlights", endpoint="main.features", view_func=features_page)
+    app.add_url_rule("/search", endpoint="main.search", view_func=search)
+    app.add_url_rule("/api/changes", endpoint="api.changes", view_func=change_feed)
 
     app.add_url_rule(
         "/admin", endpoint="admin.dashboard", view_func=dashboard
@@ -510,6 +3778,28 @@ def register_routes(app: Flask) -> None:
     app.add_url_rule(
         "/admin/logout", endpoint="admin.logout", view_func=logout
     )
+    app.add_url_rule(
+        "/admin/metrics", endpoint="admin.metrics", view_func=metrics
+    )
+    app.add_url_rule(
+        "/admin/search", endpoint="admin.search", view_func=admin_search
+    )
+    app.add_url_rule(
+        "/admin/import",
+        endpoint="admin.bulk_import",
+        view_func=bulk_import,
+        methods=["GET", "POST"],
+    )
+    app.add_url_rule(
+        "/admin/import/progress/<job_id>",
+        endpoint="admin.import_progress",
+        view_func=import_progress,
+    )
+    app.add_url_rule(
+        "/admin/export/<entity>.<fmt>",
+        endpoint="admin.bulk_export",
+        view_func=bulk_export,
+    )
     app.add_url_rule(
         "/admin/content/<section>",
         endpoint="admin.edit_content",
@@ -522,6 +3812,18 @@ def register_routes(app: Flask) -> None:
         view_func=manage_gallery,
         methods=["GET", "POST"],
     )
+    app.add_url_rule(
+        "/admin/gallery/order",
+        endpoint="admin.reorder_gallery",
+        view_func=reorder_gallery,
+        methods=["POST"],
+    )
+    app.add_url_rule(
+        "/admin/jobs/<int:job_id>/retry",
+        endpoint="admin.retry_job",
+        view_func=retry_failed_job,
+        methods=["POST"],
+    )
     app.add_url_rule(
         "/admin/features",
         endpoint="admin.manage_features",
@@ -536,102 +3838,1409 @@ def register_routes(app: Flask) -> None:
     )
 
 
+# Production server
+#
+# `flask --app app serve` runs a preforking server: the master has already
+# imported the app (schema checked, assets built), warms the page and query
+# caches and then forks workers that share one listening socket, so every
+# worker starts with compiled templates and hot caches in copy-on-write
+# memory. Each worker serves requests from a bounded thread pool.
+#
+# SIGHUP, or a change to the code, templates, static sources or the
+# identity of the SQLite file, re-executes the master with the listening
+# socket inherited. The new master boots and forks fresh workers before
+# the old ones are asked to finish their in-flight requests and exit, so
+# the socket never stops accepting connections.
+
+SERVE_FD_ENV = "CAFE_SERVE_FD"
+SERVE_RETIRE_ENV = "CAFE_SERVE_RETIRE"
+SERVE_METRICS_ENV = "CAFE_SERVE_METRICS"
+SERVE_POLL_SECONDS = 1.0
+
+
+class OneShotRequestHandler(WSGIRequestHandler):
+    # Without keep-alive an idle client cannot pin one of the pool's threads.
+    protocol_version = "HTTP/1.0"
+
+    def run_wsgi(self) -> None:
+        # The Link headers this path sent last time go out as 103 Early
+        # Hints before the view runs; HTTP/1.0 clients cannot take a 1xx.
+        app = self.server.app
+        if app.config["EARLY_HINTS"] and self.command == "GET" and self.request_version == "HTTP/1.1":
+            key = link_hint_key(app, self.headers.get("Host", ""), self.path.partition("?")[0])
+            hints = remembered_link_hints(key)
+            if hints:
+                self.wfile.write(f"HTTP/1.1 103 Early Hints\r\nLink: {hints}\r\n\r\n".encode("latin-1"))
+        super().run_wsgi()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, host: str, port: int, app, threads: int, fd: int | None = None) -> None:
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="request")
+        super().__init__(host, port, app, handler=OneShotRequestHandler, fd=fd)
+
+    def process_request(self, request, client_address) -> None:
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def warm_caches(app: Flask) -> int:
+    with app.test_request_context():
+        urls = [url_for(endpoint) for endpoint in PAGE_DEPENDENCIES]
+    client = app.test_client()
+    base_url = "http://localhost/"
+    if app.config["TENANTS_FOLDER"]:
+        # Warming one store compiles every template; the other tenants' data
+        # is loaded on demand so idle stores cost nothing.
+        tenants = list_tenants(app)
+        if not tenants:
+            return 0
+        base_url = f"http://{tenants[0].name}/"
+    # buffered=True drains streamed pages, which only reach the cache once sent.
+    warmed = sum(client.get(url, base_url=base_url, buffered=True).status_code == 200 for url in urls)
+    request_metrics.reset()
+    return warmed
+
+
+def watched_state() -> tuple:
+    sources = [BASE_DIR / "app.py"]
+    sources.extend(path for path in (BASE_DIR / "templates").rglob("*") if path.is_file())
+    sources.extend(
+        path
+        for path in STATIC_FOLDER.rglob("*")
+        if path.is_file() and path.relative_to(STATIC_FOLDER).parts[0] not in ASSET_SKIP_DIRS
+    )
+    code = tuple(sorted((str(path), path.stat().st_mtime_ns) for path in sources if path.exists()))
+    try:
+        database = os.stat(DATABASE_PATH)
+        # Compare identity rather than mtime: WAL checkpoints touch the file
+        # on every write, while a restored or replaced database gets a new inode.
+        database_identity = (database.st_dev, database.st_ino)
+    except FileNotFoundError:
+        database_identity = None
+    return code, database_identity
+
+
+def run_worker(app: Flask, sock: socket.socket, threads: int) -> None:
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads, fd=sock.fileno())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # shutdown() blocks until serve_forever() returns, so it cannot run on
+    # the thread that is inside serve_forever().
+    signal.signal(
+        signal.SIGTERM,
+        lambda *_: threading.Thread(target=server.shutdown, daemon=True).start(),
+    )
+    metrics_folder = os.environ.get(SERVE_METRICS_ENV)
+    if metrics_folder:
+        request_metrics.share(Path(metrics_folder))
+    try:
+        server.serve_forever(poll_interval=0.5)
+    finally:
+        # serve_forever() has closed the listening socket; let in-flight
+        # requests finish before the worker exits.
+        server.pool.shutdown(wait=True)
+        request_metrics.flush()
+
+
+def spawn_worker(app: Flask, sock: socket.socket, threads: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(app, sock, threads)
+        except BaseException:
+            logger.exception("Worker %s crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def spawn_job_process(app: Flask, threads: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            run_job_process(app, threads)
+        except BaseException:
+            logger.exception("Job process %s crashed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def stop_workers(pids, timeout: float = 30.0) -> None:
+    pids = set(pids)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    while pids and time.monotonic() < deadline:
+        for pid in list(pids):
+            try:
+                finished, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                finished = pid
+            if finished:
+                pids.discard(pid)
+        time.sleep(0.05)
+    for pid in pids:
+        logger.warning("Worker %s did not exit in %.0fs; killing it", pid, timeout)
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+
+
+def serve(
+    app: Flask, host: str, port: int, workers: int, threads: int, watch: bool, job_threads: int = 0
+) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+    if not hasattr(os, "fork"):
+        logger.warning("os.fork is unavailable; serving from a single threaded process")
+        run_simple(host, port, app, threaded=True)
+        return
+
+    inherited_fd = os.environ.pop(SERVE_FD_ENV, None)
+    retiring = [int(pid) for pid in os.environ.pop(SERVE_RETIRE_ENV, "").split(",") if pid]
+    if inherited_fd is not None:
+        sock = socket.socket(fileno=int(inherited_fd))
+    else:
+        sock = socket.create_server((host, port), backlog=2048)
+    sock.set_inheritable(True)
+
+    warmed = warm_caches(app)
+    logger.info("Warmed %d cached pages", warmed)
+    # Kept in the environment, so a reloaded master keeps adding to the
+    # same counters.
+    metrics_folder = os.environ.get(SERVE_METRICS_ENV)
+    if metrics_folder is None:
+        metrics_folder = os.environ[SERVE_METRICS_ENV] = tempfile.mkdtemp(prefix="cafe-metrics-")
+    metrics_folder = Path(metrics_folder)
+
+    # Web workers only enqueue; a separate, lower-priority process runs jobs.
+    global _job_queue_external
+    app.config["JOB_WORKERS"] = 0
+    _job_queue_external = True
+    if not job_threads:
+        logger.warning("--job-threads 0: queued jobs stay pending until `flask --app app jobs-worker` runs")
+    children = {spawn_worker(app, sock, threads) for _ in range(workers)}
+    job_pid = spawn_job_process(app, job_threads) if job_threads else None
+    if retiring:
+        stop_workers(retiring)
+        retire_worker_metrics(metrics_folder, retiring)
+    bound_host, bound_port = sock.getsockname()[:2]
+    click.echo(
+        f"{workers} ワーカー × {threads} スレッドで http://{bound_host}:{bound_port} を配信しています（PID {os.getpid()}）"
+    )
+
+    requested = {"action": None}
+
+    def request_action(action):
+        return lambda *_: requested.update(action=action)
+
+    signal.signal(signal.SIGTERM, request_action("stop"))
+    signal.signal(signal.SIGINT, request_action("stop"))
+    signal.signal(signal.SIGHUP, request_action("reload"))
+
+    state = watched_state() if watch else None
+    while requested["action"] is None:
+        time.sleep(SERVE_POLL_SECONDS)
+        while children:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            retire_worker_metrics(metrics_folder, [pid])
+            if pid in children:
+                children.discard(pid)
+                logger.warning("Worker %s exited; starting a replacement", pid)
+                children.add(spawn_worker(app, sock, threads))
+            elif pid == job_pid:
+                logger.warning("Job process %s exited; starting a replacement", pid)
+                job_pid = spawn_job_process(app, job_threads)
+        if watch and requested["action"] is None:
+            current = watched_state()
+            if current != state:
+                logger.info("Code or database changed; reloading workers")
+                requested["action"] = "reload"
+
+    if requested["action"] == "reload":
+        # The replacement master keeps the socket open and retires these
+        # workers only once its own workers are accepting connections.
+        os.environ[SERVE_FD_ENV] = str(sock.fileno())
+        os.environ[SERVE_RETIRE_ENV] = ",".join(map(str, children | {job_pid} - {None}))
+        os.execv(sys.executable, [sys.executable, *sys.orig_argv[1:]])
+
+    stop_workers(children | {job_pid} - {None})
+    sock.close()
+    shutil.rmtree(metrics_folder, ignore_errors=True)
+
+
+# CLI commands
+
+def register_commands(app: Flask) -> None:
+    def each_tenant(prepare: bool = True):
+        # Per-store commands run once for every tenant in multi-tenant mode.
+        for tenant in all_tenants(app):
+            if tenant.name:
+                click.echo(f"[{tenant.name}]")
+            with tenant_context(app, tenant, prepare):
+                yield tenant
+
+    @app.cli.command("migrate")
+    def migrate_command() -> None:
+        """Apply pending schema migrations to site.db."""
+        for _ in each_tenant(prepare=False):
+            applied = migrate_db()
+            if applied:
+                click.echo(f"マイグレーション {', '.join(map(str, applied))} を適用しました。")
+            click.echo(f"スキーマバージョン: v{schema_version(get_db_connection())}")
+
+    @app.cli.command("tenant-create")
+    @click.argument("host")
+    def tenant_create_command(host: str) -> None:
+        """Create the database and upload folder for a new tenant host."""
+        if not app.config["TENANTS_FOLDER"]:
+            raise click.UsageError("TENANTS_FOLDER を指定してください。")
+        try:
+            tenant = create_tenant(app, host)
+        except ValueError as exc:
+            raise click.UsageError(str(exc)) from exc
+        with tenant_context(app, tenant):
+            click.echo(f"{tenant.name} を作成しました（スキーマバージョン: v{schema_version(get_db_connection())}）。")
+
+    @app.cli.command("gc-uploads")
+    @click.option("--dry-run", is_flag=True, help="削除せずに対象ファイルだけを表示します。")
+    @click.option(
+        "--grace",
+        default=ORPHAN_GRACE_SECONDS,
+        show_default=True,
+        help="この秒数より新しいファイルは処理中とみなして残します。",
+    )
+    def gc_uploads_command(dry_run: bool, grace: int) -> None:
+        """Remove files in static/uploads that no gallery image references."""
+        for _ in each_tenant():
+            removed = gc_orphan_uploads(tenant_upload_folder(), grace, dry_run)
+            for path in removed:
+                click.echo(path.name)
+            if dry_run:
+                click.echo(f"{len(removed)} 件が削除対象です。")
+            else:
+                click.echo(f"{len(removed)} 件のファイルを削除しました。")
+
+    @app.cli.command("build-assets")
+    def build_assets_command() -> None:
+        """Minify, fingerprint and precompress everything under static/."""
+        manifest = build_static_assets(Path(app.static_folder))
+        for source, built in manifest.items():
+            click.echo(f"{source} -> {built}")
+
+    @app.cli.command("freeze")
+    @click.option("--stale-only", is_flag=True, help="内容が変わったページだけを書き出します。")
+    def freeze_command(stale_only: bool) -> None:
+        """Render the public pages to static HTML under FREEZE_FOLDER."""
+        for _ in each_tenant():
+            written = freeze_pages(app, force=not stale_only)
+            for endpoint in written:
+                click.echo(endpoint)
+            click.echo(f"{len(written)} ページを {tenant_frozen_folder(app)} に書き出しました。")
+
+    @app.cli.command("prune-changes")
+    @click.option(
+        "--days",
+        default=CHANGE_LOG_RETENTION_DAYS,
+        show_default=True,
+        help="この日数より古い変更履歴を削除します。",
+    )
+    def prune_changes_command(days: int) -> None:
+        """Delete change_log rows older than --days."""
+        for _ in each_tenant():
+            removed = prune_change_log(days)
+            click.echo(f"{removed} 件の変更履歴を削除しました。")
+
+    @app.cli.command("image-metadata")
+    def image_metadata_command() -> None:
+        """Fill in size and placeholder colour for gallery images missing them."""
+        for _ in each_tenant():
+            with write_transaction() as conn:
+                updated = backfill_image_metadata(conn.cursor())
+                if updated:
+                    record_change(conn, "gallery_images", "gallery_images", None, "update")
+            click.echo(f"{updated} 件の画像情報を更新しました。")
+
+    @app.cli.command("serve")
+    @click.option("--host", default="127.0.0.1", show_default=True)
+    @click.option("--port", default=8000, show_default=True)
+    @click.option(
+        "--workers",
+        default=os.cpu_count() or 2,
+        show_default=True,
+        help="フォークするワーカープロセス数。",
+    )
+    @click.option("--threads", default=8, show_default=True, help="ワーカーごとのスレッド数。")
+    @click.option(
+        "--watch/--no-watch",
+        default=True,
+        show_default=True,
+        help="コードやデータベースファイルの変更を検知して無停止でリロードします。",
+    )
+    @click.option(
+        "--job-threads",
+        default=JOB_WORKER_THREADS,
+        show_default=True,
+        help="バックグラウンドジョブ用プロセスのスレッド数（0 で起動しません）。",
+    )
+    def serve_command(
+        host: str, port: int, workers: int, threads: int, watch: bool, job_threads: int
+    ) -> None:
+        """Serve the site with preforked, pre-warmed worker processes."""
+        serve(app, host, port, max(1, workers), max(1, threads), watch, max(0, job_threads))
+
+    @app.cli.command("jobs-worker")
+    @click.option("--threads", default=JOB_WORKER_THREADS, show_default=True, help="ジョブを処理するスレッド数。")
+    @click.option(
+        "--nice",
+        default=JOB_NICE,
+        show_default=True,
+        help="CPU 優先度をこの値だけ下げ、公開ページの応答を優先します。",
+    )
+    def jobs_worker_command(threads: int, nice: int) -> None:
+        """Run queued background jobs for every store until interrupted."""
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+        click.echo(f"{max(1, threads)} スレッドでジョブを処理しています（PID {os.getpid()}）")
+        run_job_process(app, max(1, threads), nice)
+
+
 # Data helpers
 
+Page = namedtuple("Page", "rows next_cursor")
+CURSOR_TYPES = (str, int, float)
+
+
+def clamp_page_size(limit: int) -> int:
+    return max(1, min(int(limit), MAX_PAGE_SIZE))
+
+
+def encode_cursor(values) -> str:
+    raw = json.dumps(list(values), ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str | None, arity: int) -> tuple | None:
+    # A malformed or tampered cursor simply restarts from the first page.
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(values, list) or len(values) != arity:
+        return None
+    # Keys are hashed into cache keys and bound as SQL parameters, so only
+    # the scalar types encode_cursor() writes are accepted.
+    if not all(isinstance(value, CURSOR_TYPES) and not isinstance(value, bool) for value in values):
+        return None
+    return tuple(values)
+
+
+def keyset_page(cur: sqlite3.Cursor, limit: int, key_columns: tuple[str, ...]) -> Page:
+    rows = to_records(cur)
+    if len(rows) <= limit:
+        return Page(rows, None)
+    rows = rows[:limit]
+    return Page(rows, encode_cursor(rows[-1][column] for column in key_columns))
+
+
 def fetch_all_content():
     conn = get_db_connection()
     rows = conn.execute("SELECT * FROM site_content ORDER BY section").fetchall()
-    conn.close()
     return rows
 
 
-def fetch_gallery(limit: int | None = None):
+def fetch_dashboard_stats() -> dict:
+    row = get_db_connection().execute(
+        """
+        SELECT
+            (SELECT COUNT(*) FROM gallery_images) AS gallery_count,
+            (SELECT COUNT(*) FROM features) AS feature_count,
+            (SELECT COUNT(*) FROM announcements) AS announcement_count
+        """
+    ).fetchone()
+    return dict(row)
+
+
+def load_top_page() -> dict:
+    with read_snapshot():
+        return {
+            "content": fetch_content("top"),
+            "features": fetch_features(),
+            "announcements": fetch_announcements(limit=TOP_ANNOUNCEMENTS_LIMIT).rows,
+            "gallery": fetch_gallery(limit=4).rows,
+        }
+
+
+def load_dashboard_page() -> dict:
+    with read_snapshot():
+        return {
+            "contents": fetch_all_content(),
+            "stats": fetch_dashboard_stats(),
+        }
+
+
+def fetch_gallery(limit: int = GALLERY_PAGE_SIZE, after: str | None = None) -> Page:
+    limit = clamp_page_size(limit)
+    key = decode_cursor(after, 3)
+
+    def load():
+        conn = get_db_connection()
+        if key is None:
+            cur = conn.execute(
+                """
+                SELECT * FROM gallery_images
+                ORDER BY display_order, created_at DESC, id DESC
+                LIMIT ?
+                """,
+                (limit + 1,),
+            )
+        else:
+            display_order, created_at, image_id = key
+            cur = conn.execute(
+                """
+                SELECT * FROM gallery_images
+                WHERE display_order >= ?
+                  AND (display_order > ?
+                       OR (display_order = ? AND (created_at, id) < (?, ?)))
+                ORDER BY display_order, created_at DESC, id DESC
+                LIMIT ?
+                """,
+                (display_order, display_order, display_order, created_at, image_id, limit + 1),
+            )
+        return keyset_page(cur, limit, ("display_order", "created_at", "id"))
+
+    return cached_query("gallery_images", ("gallery_images", limit, key), load)
+
+
+def add_gallery_image(file_path: str, caption: str | None) -> int:
+    source = gallery_file_source(file_path)
+    metadata = (probe_image(source) if source else None) or (None,) * len(IMAGE_METADATA_COLUMNS)
     conn = get_db_connection()
-    query = "SELECT * FROM gallery_images ORDER BY display_order, created_at DESC"
-    if limit:
-        query += " LIMIT ?"
-        images = conn.execute(query, (limit,)).fetchall()
-    else:
-        images = conn.execute(query).fetchall()
-    conn.close()
-    return images
+    cur = conn.execute(
+        f"""
+        INSERT INTO gallery_images
+            (file_path, caption, width, height, byte_size, mime_type, placeholder,
+             display_order, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, {GALLERY_TOP_RANK}, ?)
+        """,
+        (file_path, caption, *metadata, datetime.utcnow().isoformat()),
+    )
+    record_change(conn, "gallery_images", "gallery_images", cur.lastrowid, "create")
+    conn.commit()
+    return cur.lastrowid
 
 
-def add_gallery_image(file_path: str, caption: str | None) -> None:
+def set_gallery_variants(
+    image_id: int, variants: list[dict], status: str, summary: dict | None = None
+) -> None:
     conn = get_db_connection()
+    summary = summary or {}
+    # Other rows still waiting on the same file share the result, so a bulk
+    # import schedules one job per distinct image. The decoded size wins over
+    # the header sniffed at upload because it accounts for EXIF rotation.
     conn.execute(
-        "INSERT INTO gallery_images (file_path, caption, created_at) VALUES (?, ?, ?)",
-        (file_path, caption, datetime.utcnow().isoformat()),
+        """
+        UPDATE gallery_images
+        SET variants = ?, status = ?,
+            width = COALESCE(?, width), height = COALESCE(?, height),
+            placeholder = COALESCE(?, placeholder)
+        WHERE id = ?
+           OR (status = 'processing'
+               AND file_path = (SELECT file_path FROM gallery_images WHERE id = ?))
+        """,
+        (
+            json.dumps(variants) if variants else None,
+            status,
+            summary.get("width"),
+            summary.get("height"),
+            summary.get("placeholder"),
+            image_id,
+            image_id,
+        ),
     )
+    record_change(conn, "gallery_images", "gallery_images", image_id, "update")
     conn.commit()
-    conn.close()
 
 
-def delete_gallery_image(image_id: str | None) -> None:
+def add_gallery_upload(
+    staged: StagedUpload, caption: str | None, upload_folder: Path
+) -> tuple[int, str]:
+    file_path = f"{UPLOAD_URL_PREFIX}/{staged.filename}"
+    try:
+        # Moving the file in under the write lock means a concurrent delete of
+        # the last row sharing this hash cannot unlink it from under us.
+        with write_transaction() as conn:
+            os.replace(staged.temp_path, upload_folder / staged.filename)
+            existing = conn.execute(
+                """
+                SELECT variants, width, height, byte_size, mime_type, placeholder
+                FROM gallery_images
+                WHERE file_path = ? AND status = 'ready' AND variants IS NOT NULL
+                LIMIT 1
+                """,
+                (file_path,),
+            ).fetchone()
+            metadata = staged.metadata or (None,) * len(IMAGE_METADATA_COLUMNS)
+            if existing is not None:
+                variants, status = existing["variants"], "ready"
+                metadata = ImageMetadata(*tuple(existing)[1:])
+            elif can_make_derivatives(staged.filename):
+                variants, status = None, "processing"
+            else:
+                variants, status = None, "ready"
+            cur = conn.execute(
+                f"""
+                INSERT INTO gallery_images
+                    (file_path, caption, variants, status, width, height, byte_size,
+                     mime_type, placeholder, display_order, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {GALLERY_TOP_RANK}, ?)
+                """,
+                (file_path, caption, variants, status, *metadata, datetime.utcnow().isoformat()),
+            )
+            record_change(conn, "gallery_images", "gallery_images", cur.lastrowid, "create")
+    finally:
+        staged.temp_path.unlink(missing_ok=True)
+    return cur.lastrowid, status
+
+
+def delete_gallery_image(image_id: str | None, upload_folder: Path | None = None) -> None:
     if not image_id:
         return
-    conn = get_db_connection()
-    conn.execute("DELETE FROM gallery_images WHERE id = ?", (image_id,))
-    conn.commit()
-    conn.close()
+    upload_folder = upload_folder or tenant_upload_folder()
+    with write_transaction() as conn:
+        row = conn.execute(
+            "SELECT file_path, variants FROM gallery_images WHERE id = ?", (image_id,)
+        ).fetchone()
+        if row is None:
+            return
+        conn.execute("DELETE FROM gallery_images WHERE id = ?", (image_id,))
+        record_change(conn, "gallery_images", "gallery_images", image_id, "delete")
+    # The files go only once the delete has committed, so a failed commit
+    # never leaves a row without its image. The check runs again under a
+    # fresh write lock: an upload of the same image may have claimed the
+    # file in between. If this step fails, gc-uploads collects the orphans.
+    with write_transaction() as conn:
+        remaining = conn.execute(
+            "SELECT COUNT(*) FROM gallery_images WHERE file_path = ?", (row["file_path"],)
+        ).fetchone()[0]
+        if not remaining:
+            for name in upload_file_names(row["file_path"], row["variants"]):
+                (upload_folder / name).unlink(missing_ok=True)
 
 
 def fetch_features():
-    conn = get_db_connection()
-    features = conn.execute("SELECT * FROM features ORDER BY id").fetchall()
-    conn.close()
-    return features
+    def load():
+        return to_records(
+            get_db_connection().execute("SELECT * FROM features ORDER BY id")
+        )
+
+    return cached_query("features", ("features",), load)
 
 
 def add_feature(title: str | None, description: str | None, icon: str) -> None:
     if not title or not description:
         return
     conn = get_db_connection()
-    conn.execute(
+    cur = conn.execute(
         "INSERT INTO features (title, description, icon) VALUES (?, ?, ?)",
         (title, description, icon),
     )
+    record_change(conn, "features", "features", cur.lastrowid, "create")
     conn.commit()
-    conn.close()
 
 
 def delete_feature(feature_id: str | None) -> None:
     if not feature_id:
         return
     conn = get_db_connection()
-    conn.execute("DELETE FROM features WHERE id = ?", (feature_id,))
+    cur = conn.execute("DELETE FROM features WHERE id = ?", (feature_id,))
+    if cur.rowcount:
+        record_change(conn, "features", "features", feature_id, "delete")
     conn.commit()
-    conn.close()
 
 
-def fetch_announcements():
-    conn = get_db_connection()
-    announcements = conn.execute(
-        "SELECT * FROM announcements ORDER BY datetime(published_at) DESC"
-    ).fetchall()
-    conn.close()
-    return announcements
+def fetch_announcements(
+    limit: int = ANNOUNCEMENTS_PAGE_SIZE, after: str | None = None
+) -> Page:
+    # ISO-8601 timestamps sort correctly as text, so the ordering no longer
+    # needs datetime() and can walk idx_announcements_published directly.
+    limit = clamp_page_size(limit)
+    key = decode_cursor(after, 2)
+
+    def load():
+        conn = get_db_connection()
+        if key is None:
+            cur = conn.execute(
+                """
+                SELECT * FROM announcements
+                ORDER BY published_at DESC, id DESC
+                LIMIT ?
+                """,
+                (limit + 1,),
+            )
+        else:
+            cur = conn.execute(
+                """
+                SELECT * FROM announcements
+                WHERE (published_at, id) < (?, ?)
+                ORDER BY published_at DESC, id DESC
+                LIMIT ?
+                """,
+                (*key, limit + 1),
+            )
+        return keyset_page(cur, limit, ("published_at", "id"))
+
+    return cached_query("announcements", ("announcements", limit, key), load)
 
 
 def add_announcement(title: str | None, content: str | None) -> None:
     if not title or not content:
         return
     conn = get_db_connection()
-    conn.execute(
+    cur = conn.execute(
         "INSERT INTO announcements (title, content, published_at) VALUES (?, ?, ?)",
         (title, content, datetime.utcnow().isoformat()),
     )
+    record_change(conn, "announcements", "announcements", cur.lastrowid, "create")
     conn.commit()
-    conn.close()
 
 
 def delete_announcement(announcement_id: str | None) -> None:
     if not announcement_id:
         return
     conn = get_db_connection()
-    conn.execute("DELETE FROM announcements WHERE id = ?", (announcement_id,))
+    cur = conn.execute("DELETE FROM announcements WHERE id = ?", (announcement_id,))
+    if cur.rowcount:
+        record_change(conn, "announcements", "announcements", announcement_id, "delete")
     conn.commit()
-    conn.close()
+
+
+# Bulk import / export
+#
+# Imports are read row by row (CSV, a JSON array or JSON Lines, optionally
+# inside a ZIP together with gallery images) and validated into a spooled
+# temporary file before the write lock is taken; archived images are read,
+# hashed and staged at that point too. The validated rows are then fed to a
+# single executemany() in one short write transaction, so a file either
+# lands completely or not at all: staged images move into the upload folder
+# inside it, and any that a failed import moved in are removed again before
+# the lock is released. Progress is written to a small JSON file that any
+# worker can serve while the upload is still being processed.
+# Exports stream straight from a cursor inside a read snapshot.
+
+BulkEntity = namedtuple("BulkEntity", "table scope columns required defaults")
+BULK_ENTITIES = {
+    "announcements": BulkEntity(
+        "announcements",
+        "announcements",
+        ("title", "content", "published_at"),
+        {"title", "content"},
+        {"published_at": lambda: datetime.utcnow().isoformat()},
+    ),
+    "features": BulkEntity(
+        "features",
+        "features",
+        ("title", "description", "icon"),
+        {"title", "description"},
+        {"icon": lambda: "fa-mug-hot"},
+    ),
+    "gallery": BulkEntity(
+        "gallery_images",
+        "gallery_images",
+        ("file_path", "caption", "display_order", "created_at"),
+        {"file_path"},
+        # Rows without display_order are ranked on import, see import_rows().
+        {"created_at": lambda: datetime.utcnow().isoformat()},
+    ),
+}
+BULK_TIMESTAMP_COLUMNS = {"published_at", "created_at"}
+IMPORT_EXTENSIONS = {"csv", "json", "jsonl", "ndjson", "zip"}
+IMPORT_PROGRESS_DIR = Path(tempfile.gettempdir()) / "cafe-imports"
+IMPORT_PROGRESS_EVERY = 500
+IMPORT_READ_CHARS = 64 * 1024
+IMPORT_MAX_RECORD_CHARS = 1024 * 1024
+IMPORT_SPOOL_BYTES = 4 * 1024 * 1024
+EXPORT_BATCH_ROWS = 200
+JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{16}$")
+
+
+class BulkImportError(ValueError):
+    pass
+
+
+def iter_csv_rows(stream):
+    # utf-8-sig accepts the BOM that Excel writes in front of UTF-8 CSV.
+    yield from csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8-sig", newline=""))
+
+
+def iter_json_rows(stream):
+    # Decodes one value at a time from a JSON array or JSON Lines, treating
+    # the brackets and commas between objects as separators.
+    decoder = json.JSONDecoder()
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig")
+    buffer = ""
+    while True:
+        chunk = text.read(IMPORT_READ_CHARS)
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,[]")
+            if not buffer:
+                break
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if not chunk or len(buffer) > IMPORT_MAX_RECORD_CHARS:
+                    raise BulkImportError("JSON の形式が正しくありません。") from None
+                break
+            yield value
+            buffer = buffer[end:]
+        if not chunk:
+            return
+
+
+def iter_import_rows(stream, extension: str):
+    if extension == "csv":
+        return iter_csv_rows(stream)
+    return iter_json_rows(stream)
+
+
+def find_archive_manifest(archive: zipfile.ZipFile) -> zipfile.ZipInfo:
+    for info in archive.infolist():
+        name = info.filename
+        if "/" not in name.strip("/") and name.rsplit(".", 1)[-1].lower() in IMPORT_EXTENSIONS - {"zip"}:
+            return info
+    raise BulkImportError("ZIP の直下に CSV または JSON ファイルが見つかりません。")
+
+
+def normalize_import_row(entity: BulkEntity, row, number: int) -> list:
+    if not isinstance(row, dict):
+        raise BulkImportError(f"{number} 件目: 項目名付きのデータではありません。")
+    values = []
+    for column in entity.columns:
+        value = row.get(column)
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == "":
+            if column in entity.required:
+                raise BulkImportError(f"{number} 件目: {column} が空です。")
+            value = entity.defaults[column]() if column in entity.defaults else None
+        elif column == "display_order":
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise BulkImportError(f"{number} 件目: display_order は整数で指定してください。") from None
+        elif column in BULK_TIMESTAMP_COLUMNS:
+            try:
+                parsed = datetime.fromisoformat(str(value))
+            except ValueError:
+                raise BulkImportError(f"{number} 件目: {column} の日時形式が正しくありません。") from None
+            # Stored timestamps are naive UTC and compared as text, so an
+            # offset is folded in rather than kept.
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            value = parsed.isoformat()
+        else:
+            value = str(value)
+        values.append(value)
+    return values
+
+
+def stage_archived_image(
+    archive: zipfile.ZipFile, name: str, number: int, upload_folder: Path
+) -> StagedUpload:
+    if not allowed_file(name):
+        raise BulkImportError(f"{number} 件目: {name} は対応していない画像形式です。")
+    try:
+        info = archive.getinfo(name)
+    except KeyError:
+        raise BulkImportError(f"{number} 件目: {name} が ZIP 内に見つかりません。") from None
+    with archive.open(info) as stream:
+        return stage_upload(FileStorage(stream=stream, filename=name), upload_folder)
+
+
+def write_import_progress(job_id: str | None, **state) -> None:
+    if not job_id:
+        return
+    state["updated_at"] = time.time()
+    _write_atomic(IMPORT_PROGRESS_DIR / f"{job_id}.json", json.dumps(state).encode("utf-8"))
+
+
+def read_import_progress(job_id: str) -> dict | None:
+    if not JOB_ID_PATTERN.match(job_id):
+        return None
+    try:
+        return json.loads((IMPORT_PROGRESS_DIR / f"{job_id}.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def import_rows(
+    entity_name: str,
+    rows,
+    archive: zipfile.ZipFile | None = None,
+    upload_folder: Path | None = None,
+    job_id: str | None = None,
+) -> int:
+    entity = BULK_ENTITIES[entity_name]
+    upload_folder = upload_folder or tenant_upload_folder()
+    columns = entity.columns
+    gallery = entity.table == "gallery_images"
+    if gallery:
+        columns += ("status",) + IMAGE_METADATA_COLUMNS
+        rank_index = columns.index("display_order")
+    staged: dict[str, StagedUpload] = {}  # archive name -> staged image
+    moved: list[Path] = []
+
+    def validate(spool) -> int:
+        number = 0
+        for number, row in enumerate(rows, 1):
+            values = normalize_import_row(entity, row, number)
+            image = None
+            if gallery:
+                status, metadata = "ready", None
+                path = values[0]
+                if archive is not None and not path.startswith(("/", "http://", "https://")):
+                    if path not in staged:
+                        staged[path] = stage_archived_image(archive, path, number, upload_folder)
+                    image, metadata = path, staged[path].metadata
+                    values[0] = f"{UPLOAD_URL_PREFIX}/{staged[path].filename}"
+                    if can_make_derivatives(values[0]):
+                        status = "processing"
+                elif path.startswith("/"):
+                    source = gallery_file_source(path)
+                    if source is None or not source.is_file():
+                        raise BulkImportError(
+                            f"{number} 件目: 画像 {path} がアップロード済みの画像にも静的ファイルにも見つかりません。"
+                        )
+                    metadata = probe_image(source)
+                elif not path.startswith(("http://", "https://")):
+                    raise BulkImportError(
+                        f"{number} 件目: 画像 {path} は ZIP に同梱するか URL で指定してください。"
+                    )
+                values.append(status)
+                values.extend(metadata or (None,) * len(IMAGE_METADATA_COLUMNS))
+            spool.write(json.dumps([values, image], ensure_ascii=False) + "\n")
+            if number % IMPORT_PROGRESS_EVERY == 0:
+                write_import_progress(job_id, state="running", processed=number)
+        return number
+
+    def replay(conn: sqlite3.Connection, spool):
+        if gallery:
+            # Unranked rows stack above the current top one step apart, as
+            # if each had been uploaded in turn.
+            next_rank = conn.execute(f"SELECT {GALLERY_TOP_RANK}").fetchone()[0]
+        spool.seek(0)
+        for line in spool:
+            values, image = json.loads(line)
+            if gallery and values[rank_index] is None:
+                values[rank_index] = next_rank
+                next_rank -= GALLERY_RANK_STEP
+            if image is not None and staged[image].temp_path.exists():
+                # Moved in under the write lock, like add_gallery_upload().
+                target = upload_folder / staged[image].filename
+                if not target.exists():
+                    moved.append(target)
+                os.replace(staged[image].temp_path, target)
+            yield values
+
+    write_import_progress(job_id, state="running", processed=0)
+    try:
+        with tempfile.SpooledTemporaryFile(IMPORT_SPOOL_BYTES, "w+", encoding="utf-8") as spool:
+            count = validate(spool)
+            write_import_progress(job_id, state="committing", processed=count)
+            with write_transaction() as conn:
+                try:
+                    last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {entity.table}").fetchone()[0]
+                    cur = conn.executemany(
+                        f"INSERT INTO {entity.table} ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))})",
+                        replay(conn, spool),
+                    )
+                    imported = cur.rowcount
+                    if imported:
+                        record_change(conn, entity.scope, entity.table, None, "import")
+                except BaseException:
+                    # Still under the write lock, so no other upload of the
+                    # same image can have started relying on these files.
+                    for target in moved:
+                        target.unlink(missing_ok=True)
+                    raise
+    except (BulkImportError, UnicodeDecodeError, csv.Error, zipfile.BadZipFile) as exc:
+        message = str(exc) if isinstance(exc, BulkImportError) else "ファイルを読み取れませんでした。"
+        write_import_progress(job_id, state="failed", error=message)
+        raise BulkImportError(message) from exc
+    finally:
+        for upload in staged.values():
+            upload.temp_path.unlink(missing_ok=True)
+    write_import_progress(job_id, state="done", processed=imported)
+
+    if gallery and imported:
+        pending = conn.execute(
+            "SELECT id, file_path FROM gallery_images WHERE id > ? AND status = 'processing'",
+            (last_id,),
+        ).fetchall()
+        scheduled = set()
+        for row in pending:
+            if row["file_path"] in scheduled:
+                continue
+            scheduled.add(row["file_path"])
+            filename = row["file_path"].rsplit("/", 1)[1]
+            schedule_derivatives(row["id"], upload_folder / filename)
+    return imported
+
+
+def import_upload(
+    entity_name: str, file, upload_folder: Path | None = None, job_id: str | None = None
+) -> int:
+    extension = file.filename.rsplit(".", 1)[-1].lower() if "." in file.filename else ""
+    if entity_name not in BULK_ENTITIES:
+        raise BulkImportError("取り込み先を選択してください。")
+    if extension not in IMPORT_EXTENSIONS:
+        raise BulkImportError("CSV・JSON・ZIP ファイルを選択してください。")
+    if extension != "zip":
+        return import_rows(
+            entity_name, iter_import_rows(file.stream, extension), upload_folder=upload_folder, job_id=job_id
+        )
+    try:
+        archive = zipfile.ZipFile(file.stream)
+    except zipfile.BadZipFile:
+        raise BulkImportError("ZIP ファイルを読み取れませんでした。") from None
+    with archive:
+        manifest = find_archive_manifest(archive)
+        with archive.open(manifest) as stream:
+            rows = iter_import_rows(stream, manifest.filename.rsplit(".", 1)[-1].lower())
+            return import_rows(entity_name, rows, archive, upload_folder, job_id)
+
+
+class ChunkSink:
+    # Minimal unseekable file for zipfile: collects writes until drained.
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def export_cursor(entity_name: str) -> sqlite3.Cursor:
+    entity = BULK_ENTITIES[entity_name]
+    return get_db_connection().execute(
+        f"SELECT {', '.join(entity.columns)} FROM {entity.table} ORDER BY id"
+    )
+
+
+def export_csv(entity_name: str):
+    columns = BULK_ENTITIES[entity_name].columns
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(columns)
+    with read_snapshot():
+        for number, row in enumerate(export_cursor(entity_name), 1):
+            writer.writerow(tuple(row))
+            if number % EXPORT_BATCH_ROWS == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_json(entity_name: str):
+    columns = BULK_ENTITIES[entity_name].columns
+    separator = "[\n"
+    with read_snapshot():
+        for row in export_cursor(entity_name):
+            yield separator + json.dumps(dict(zip(columns, row)), ensure_ascii=False)
+            separator = ",\n"
+    yield "[]\n" if separator == "[\n" else "\n]\n"
+
+
+def archive_name(file_path: str) -> str | None:
+    # Only uploaded photos travel inside the archive; bundled site images
+    # keep their /static/ path, which the importing site also serves.
+    if file_path.startswith(UPLOAD_URL_PREFIX + "/") and ".." not in file_path:
+        return "images/" + file_path.rsplit("/", 1)[1]
+    return None
+
+
+def export_gallery_zip(upload_folder: Path):
+    sink = ChunkSink()
+    with read_snapshot(), zipfile.ZipFile(sink, "w") as archive:
+        # The manifest goes first; images follow in a second pass over the
+        # same snapshot, so neither pass keeps the whole table in memory.
+        with archive.open("gallery.csv", "w", force_zip64=True) as manifest:
+            text = io.TextIOWrapper(manifest, encoding="utf-8-sig", newline="")
+            writer = csv.writer(text)
+            writer.writerow(BULK_ENTITIES["gallery"].columns)
+            for number, row in enumerate(export_cursor("gallery"), 1):
+                writer.writerow((archive_name(row["file_path"]) or row["file_path"], *tuple(row)[1:]))
+                if number % EXPORT_BATCH_ROWS == 0:
+                    text.flush()
+                    yield sink.drain()
+            text.flush()
+            text.detach()
+        yield sink.drain()
+        written = set()
+        for row in export_cursor("gallery"):
+            name = archive_name(row["file_path"])
+            if not name or name in written:
+                continue
+            source = upload_folder / name.split("/", 1)[1]
+            if not source.is_file():
+                continue
+            written.add(name)
+            with open(source, "rb") as image, archive.open(name, "w", force_zip64=True) as out:
+                for chunk in iter(lambda: image.read(UPLOAD_CHUNK_SIZE), b""):
+                    out.write(chunk)
+                    yield sink.drain()
+    yield sink.drain()
+
+
+# Full-text search
+#
+# search_index is an FTS5 table with the trigram tokenizer, which needs no
+# word segmentation and so works for Japanese as well as English. Triggers
+# keep it in step with announcements, features and site_content; a row's
+# rowid is its source id * 4 + the source number, so triggers can address
+# it directly. Trigrams cannot match terms shorter than three characters,
+# so search_bigrams indexes the same rows as the space-separated two-
+# character substrings starting at every position (the last one is a single
+# character) under the unicode61 tokenizer: a two-character term is then a
+# token and a one-character term a token prefix. That narrows and ranks
+# the candidates; a LIKE filter on just those rows keeps the match exact
+# where punctuation splits a gram.
+
+SEARCH_SOURCES = (
+    # table, kind, number, title, body, ref
+    ("announcements", "announcement", 1, "{row}.title", "{row}.content", "{row}.id"),
+    ("features", "feature", 2, "{row}.title", "{row}.description", "{row}.id"),
+    (
+        "site_content",
+        "content",
+        3,
+        "{row}.title",
+        "coalesce({row}.body, '') || char(10) || coalesce({row}.highlight, '')",
+        "{row}.section",
+    ),
+)
+SEARCH_TRIGRAM_LENGTH = 3
+SEARCH_GRAM_LENGTH = 2
+SEARCH_SNIPPET_CHARS = 60
+# Matches are delimited with control characters that never appear in edited
+# content, and only turned into <mark> after the text has been escaped.
+MARK_START, MARK_END = "\x02", "\x03"
+
+SEARCH_KIND_LABELS = {"announcement": "お知らせ", "feature": "ハイライト", "content": "ページ"}
+
+SearchHit = namedtuple("SearchHit", "kind ref title snippet")
+
+
+def search_grams_sql(text: str) -> str:
+    # Built-in SQL only, so the triggers work for every SQLite client.
+    # Triggers cannot use WITH, so json_each() over an array of length(text)
+    # zeros stands in for a recursive CTE to number the positions.
+    return (
+        f"(SELECT group_concat(substr({text}, key + 1, {SEARCH_GRAM_LENGTH}), ' ') "
+        f"FROM json_each('[' || replace(hex(zeroblob(length({text}))), '00', '0,') || '0]') "
+        f"WHERE key < length({text}))"
+    )
+
+
+def quote_search_term(term: str) -> str:
+    return '"' + term.replace('"', '""') + '"'
+
+
+def split_search_terms(query: str | None) -> tuple[list[str], list[str]]:
+    terms = list(dict.fromkeys((query or "").split()))[:SEARCH_MAX_TERMS]
+    phrases = [term for term in terms if len(term) >= SEARCH_TRIGRAM_LENGTH]
+    short = [term for term in terms if len(term) < SEARCH_TRIGRAM_LENGTH]
+    return phrases, short
+
+
+def mark_terms(text: str, terms: list[str], crop: bool = False) -> str:
+    if not terms:
+        return text
+    pattern = re.compile("|".join(map(re.escape, terms)), re.IGNORECASE)
+    if crop:
+        found = pattern.search(text)
+        start = max(0, found.start() - SEARCH_SNIPPET_CHARS // 3) if found else 0
+        end = start + SEARCH_SNIPPET_CHARS
+        text = ("…" if start else "") + text[start:end] + ("…" if end < len(text) else "")
+    return pattern.sub(lambda match: MARK_START + match.group(0) + MARK_END, text)
+
+
+def render_marks(text: str) -> Markup:
+    return (
+        escape(text)
+        .replace(MARK_START, Markup("<mark>"))
+        .replace(MARK_END, Markup("</mark>"))
+    )
+
+
+def search_site(query: str | None, limit: int = SEARCH_PAGE_SIZE, after: str | None = None) -> Page:
+    phrases, short = split_search_terms(query)
+    if not phrases and not short:
+        return Page([], None)
+    limit = clamp_page_size(limit)
+    key = decode_cursor(after, 2)
+    if key is not None and not (isinstance(key[0], (int, float)) and isinstance(key[1], int)):
+        key = None  # the seek compares a bm25 score and a rowid
+
+    # Each term is quoted so FTS5 query syntax in user input is inert;
+    # space-separated phrases are ANDed together, and a one-character term
+    # matches as a prefix of the grams it starts.
+    gram_match = " ".join(
+        quote_search_term(term) + ("" if len(term) == SEARCH_GRAM_LENGTH else "*") for term in short
+    )
+    conditions, params = [], []
+    grams, source = "", "search_index"
+    if phrases:
+        match = " ".join(map(quote_search_term, phrases))
+        if short:
+            # A rowid IN (subquery) is pushed down into search_index, which
+            # then re-runs the phrase query per bigram candidate (seconds on
+            # tens of thousands of rows). The candidates are materialised
+            # once instead, and CROSS JOIN keeps search_index as the outer
+            # loop so they are probed through an automatic index.
+            grams = (
+                "WITH grams (id) AS MATERIALIZED "
+                "(SELECT rowid FROM search_bigrams WHERE search_bigrams MATCH ?)"
+            )
+            source = "search_index CROSS JOIN grams ON grams.id = search_index.rowid"
+            params.append(gram_match)
+        conditions.append("search_index MATCH ?")
+        params.append(match)
+        score = "bm25(search_index, 4.0, 1.0)"
+    else:
+        source = "search_bigrams JOIN search_index ON search_index.rowid = search_bigrams.rowid"
+        conditions.append("search_bigrams MATCH ?")
+        params.append(gram_match)
+        score = "bm25(search_bigrams, 4.0, 1.0)"
+    for term in short:
+        # The explicit ESCAPE also keeps SQLite from handing short patterns
+        # to the trigram index, which cannot answer them.
+        pattern = "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+        conditions.append(
+            "(search_index.title LIKE ? ESCAPE '\\' OR search_index.body LIKE ? ESCAPE '\\')"
+        )
+        params.extend((pattern, pattern))
+    seek = ""
+    if key is not None:
+        seek = "WHERE (score, id) > (?, ?)"
+        params.extend(key)
+
+    # Rank every match but build highlights only for the rows on this page.
+    conn = get_db_connection()
+    cur = conn.execute(
+        f"""
+        {grams}
+        SELECT * FROM (
+            SELECT search_index.rowid AS id, {score} AS score
+            FROM {source}
+            WHERE {" AND ".join(conditions)}
+        )
+        {seek}
+        ORDER BY score, id
+        LIMIT ?
+        """,
+        (*params, limit + 1),
+    )
+    page = keyset_page(cur, limit, ("score", "id"))
+    ids = [row["id"] for row in page.rows]
+    if not ids:
+        return page
+    placeholders = ", ".join("?" * len(ids))
+    if phrases:
+        rows = conn.execute(
+            f"""
+            SELECT rowid AS id, kind, ref,
+                   highlight(search_index, 0, char(2), char(3)) AS title,
+                   snippet(search_index, 1, char(2), char(3), '…', 24) AS snippet
+            FROM search_index
+            WHERE search_index MATCH ? AND rowid IN ({placeholders})
+            """,
+            (match, *ids),
+        )
+    else:
+        rows = conn.execute(
+            f"""
+            SELECT rowid AS id, kind, ref, title, body AS snippet
+            FROM search_index WHERE rowid IN ({placeholders})
+            """,
+            ids,
+        )
+    found = {row["id"]: row for row in rows}
+    hits = [
+        SearchHit(
+            found[id_]["kind"],
+            found[id_]["ref"],
+            render_marks(mark_terms(found[id_]["title"] or "", short)),
+            render_marks(mark_terms(found[id_]["snippet"] or "", short, crop=not phrases)),
+        )
+        for id_ in ids
+    ]
+    return Page(hits, page.next_cursor)
+
+
+# Gallery ordering
+#
+# display_order holds sparse integer ranks GALLERY_RANK_STEP apart, so
+# dropping a photo between two neighbours writes one row: it takes the
+# midpoint of their ranks. Only when two neighbours have run out of room
+# does rebalance_gallery() spread every rank out again, inside the same
+# transaction. A whole new ordering (for example one admin page) is
+# applied by handing the listed rows the ranks they already occupy, in the
+# new sequence, so unaffected rows are never touched.
+# idx_gallery_images_order matches GALLERY_ORDER, so neighbour lookups and
+# fetch_gallery() walk the index without sorting.
+
+class GalleryOrderError(ValueError):
+    pass
+
+
+def rebalance_gallery(conn: sqlite3.Connection) -> int:
+    rows = conn.execute(
+        f"SELECT id, display_order FROM gallery_images ORDER BY {GALLERY_ORDER}"
+    ).fetchall()
+    updates = [
+        (position * GALLERY_RANK_STEP, row["id"])
+        for position, row in enumerate(rows, 1)
+        if row["display_order"] != position * GALLERY_RANK_STEP
+    ]
+    conn.executemany("UPDATE gallery_images SET display_order = ? WHERE id = ?", updates)
+    return len(updates)
+
+
+def _gallery_neighbour(conn: sqlite3.Connection, anchor, moving: int, following: bool):
+    # The row right after (or before) anchor in GALLERY_ORDER, skipping the
+    # image being moved.
+    if following:
+        condition = "display_order > ? OR (display_order = ? AND (created_at, id) < (?, ?))"
+        order = GALLERY_ORDER
+    else:
+        condition = "display_order < ? OR (display_order = ? AND (created_at, id) > (?, ?))"
+        order = "display_order DESC, created_at, id"
+    return conn.execute(
+        f"""
+        SELECT id, display_order, created_at FROM gallery_images
+        WHERE id != ? AND ({condition})
+        ORDER BY {order}
+        LIMIT 1
+        """,
+        (moving, anchor["display_order"], anchor["display_order"], anchor["created_at"], anchor["id"]),
+    ).fetchone()
+
+
+def _gallery_rank_between(
+    conn: sqlite3.Connection, image_id: int, after_id: int | None, before_id: int | None
+) -> int | None:
+    def row(row_id):
+        found = conn.execute(
+            "SELECT id, display_order, created_at FROM gallery_images WHERE id = ?", (row_id,)
+        ).fetchone()
+        if found is None:
+            raise GalleryOrderError("指定された画像が見つかりません。")
+        return found
+
+    if after_id is not None:
+        previous = row(after_id)
+        following = _gallery_neighbour(conn, previous, image_id, following=True)
+    elif before_id is not None:
+        following = row(before_id)
+        previous = _gallery_neighbour(conn, following, image_id, following=False)
+    else:
+        previous = None
+        following = conn.execute(
+            f"SELECT display_order FROM gallery_images WHERE id != ? ORDER BY {GALLERY_ORDER} LIMIT 1",
+            (image_id,),
+        ).fetchone()
+    low = previous["display_order"] if previous else None
+    high = following["display_order"] if following else None
+    if low is None and high is None:
+        return 0
+    if low is None:
+        return high - GALLERY_RANK_STEP
+    if high is None:
+        return low + GALLERY_RANK_STEP
+    if high - low < 2:
+        return None
+    return (low + high) // 2
+
+
+def move_gallery_image(image_id: int, after_id: int | None = None, before_id: int | None = None) -> None:
+    # after_id wins when both are given; neither moves the image to the top.
+    if image_id in (after_id, before_id):
+        raise GalleryOrderError("画像を自分自身の前後には移動できません。")
+    with write_transaction() as conn:
+        if conn.execute("SELECT 1 FROM gallery_images WHERE id = ?", (image_id,)).fetchone() is None:
+            raise GalleryOrderError("指定された画像が見つかりません。")
+        rank = _gallery_rank_between(conn, image_id, after_id, before_id)
+        if rank is None:
+            rebalance_gallery(conn)
+            rank = _gallery_rank_between(conn, image_id, after_id, before_id)
+        conn.execute("UPDATE gallery_images SET display_order = ? WHERE id = ?", (rank, image_id))
+        record_change(conn, "gallery_images", "gallery_images", image_id, "update")
+
+
+def apply_gallery_order(image_ids: list[int]) -> int:
+    if len(set(image_ids)) != len(image_ids):
+        raise GalleryOrderError("同じ画像が複数回指定されています。")
+    ids = json.dumps(image_ids)
+    with write_transaction() as conn:
+        query = "SELECT id, display_order FROM gallery_images WHERE id IN (SELECT value FROM json_each(?))"
+        current = {row["id"]: row["display_order"] for row in conn.execute(query, (ids,))}
+        if len(current) != len(image_ids):
+            raise GalleryOrderError("存在しない画像が含まれています。")
+        if len(set(current.values())) != len(current):
+            # Tied ranks cannot be handed out as distinct slots.
+            rebalance_gallery(conn)
+            current = {row["id"]: row["display_order"] for row in conn.execute(query, (ids,))}
+        updates = [
+            (rank, image_id)
+            for rank, image_id in zip(sorted(current.values()), image_ids)
+            if current[image_id] != rank
+        ]
+        conn.executemany("UPDATE gallery_images SET display_order = ? WHERE id = ?", updates)
+        if updates:
+            record_change(conn, "gallery_images", "gallery_images", None, "reorder")
+    return len(updates)
 
 
 app = create_app()
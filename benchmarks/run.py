@@ -0,0 +1,436 @@
+"""Load-test and micro-benchmark suite for the cafe CMS.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run                      # seed, measure, compare
+    python -m benchmarks.run --update-baseline    # store results as baseline
+    python -m benchmarks.run --skip-server --iterations 200
+
+The suite builds a synthetic database (benchmarks/bench.db by default),
+drives every public and admin endpoint through the Flask test client
+(latency percentiles and per-request allocations) and then through a
+preforked multi-worker server started with `flask --app app serve`
+(throughput and latency under concurrency, including public-page latency
+during a failed-login flood).
+Results are written as JSON; the process exits with status 1 when a
+scenario regresses past --threshold compared with the stored baseline.
+"""
+
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+
+PUBLIC_SCENARIOS = [
+    ("main.top", "GET", "/"),
+    ("main.access", "GET", "/access"),
+    ("main.reservations", "GET", "/reservations"),
+    ("main.gallery", "GET", "/gallery"),
+    ("main.about", "GET", "/about"),
+    ("main.features", "GET", "/highlights"),
+    ("main.search", "GET", f"/search?q={quote('季節 ブレンド')}"),
+    ("main.search:short", "GET", f"/search?q={quote('焙煎')}"),
+    ("main.search:mixed", "GET", f"/search?q={quote('季 coffee ラテ 限定')}"),
+]
+ADMIN_SCENARIOS = [
+    ("admin.dashboard", "GET", "/admin"),
+    ("admin.manage_gallery", "GET", "/admin/gallery"),
+    ("admin.manage_features", "GET", "/admin/features"),
+    ("admin.manage_announcements", "GET", "/admin/announcements"),
+    ("admin.edit_content", "GET", "/admin/content/top"),
+    ("admin.edit_content:post", "POST", "/admin/content/about"),
+    ("admin.metrics", "GET", "/admin/metrics"),
+    ("admin.search", "GET", f"/admin/search?q={quote('ラテ')}"),
+]
+# Search scenarios also have an absolute p99 ceiling, checked with or without
+# a baseline: a plan that degrades with the number of matches shows up as
+# seconds, not as a percentage over the previous run.
+SEARCH_P99_BUDGET_MS = 500.0
+ADMIN_CREDENTIALS = {"username": "admin", "password": "admin1234"}
+
+
+def percentiles(samples: list[float]) -> dict:
+    if len(samples) < 2:
+        value = samples[0] if samples else 0.0
+        return {"p50_ms": value * 1000, "p95_ms": value * 1000, "p99_ms": value * 1000}
+    cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "p50_ms": round(cuts[49] * 1000, 3),
+        "p95_ms": round(cuts[94] * 1000, 3),
+        "p99_ms": round(cuts[98] * 1000, 3),
+    }
+
+
+def edit_form(site) -> dict:
+    with site.app.app_context():
+        content = site.fetch_content("about")
+    return {key: content[key] or "" for key in ("title", "subtitle", "body", "highlight", "image", "extra_info")}
+
+
+def paged_scenarios(site) -> list[tuple[str, str, str]]:
+    # Second pages exercise the keyset seek rather than the first-page scan.
+    with site.app.app_context():
+        gallery = site.fetch_gallery()
+        announcements = site.fetch_announcements(limit=site.ADMIN_PAGE_SIZE)
+    scenarios = []
+    if gallery.next_cursor:
+        scenarios.append(("main.gallery:page2", "GET", f"/gallery?after={quote(gallery.next_cursor)}"))
+    if announcements.next_cursor:
+        scenarios.append(
+            ("admin.manage_announcements:page2", "GET", f"/admin/announcements?after={quote(announcements.next_cursor)}")
+        )
+    return scenarios
+
+
+def reorder_moves(site):
+    # Alternately drops one image just after and just before a neighbour in
+    # the middle of the first page, so every request really moves it.
+    with site.app.app_context():
+        rows = site.fetch_gallery().rows
+    if len(rows) < 4:
+        return None
+    moving, anchor = rows[len(rows) // 2]["id"], rows[len(rows) // 2 + 1]["id"]
+    sides = itertools.cycle(("after", "before"))
+    return lambda: {"id": moving, next(sides): anchor}
+
+
+def bench_test_client(site, scenarios: list, iterations: int, warmup: int) -> dict:
+    client = site.app.test_client()
+    client.post("/admin/login", data=ADMIN_CREDENTIALS)
+    form = edit_form(site)
+    moves = reorder_moves(site)
+    if moves is not None:
+        scenarios = [*scenarios, ("admin.reorder_gallery:post", "POST", "/admin/gallery/order")]
+    results = {}
+    for name, method, path in scenarios:
+        def call():
+            if name == "admin.reorder_gallery:post":
+                response = client.post(path, json=moves())
+            elif method == "POST":
+                response = client.post(path, data=form)
+            else:
+                response = client.get(path)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name}: HTTP {response.status_code}")
+
+        for _ in range(warmup):
+            call()
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - started)
+
+        # Allocations are measured in a separate pass: tracing skews timings.
+        allocation_runs = max(1, min(iterations, 20))
+        tracemalloc.start()
+        allocated = peaks = 0
+        for _ in range(allocation_runs):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            call()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks += peak - before
+            allocated += tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        total = sum(samples)
+        results[name] = {
+            "requests": iterations,
+            "throughput_rps": round(iterations / total, 2) if total else 0.0,
+            **percentiles(samples),
+            "peak_alloc_kib": round(peaks / allocation_runs / 1024, 1),
+            "retained_kib": round(allocated / allocation_runs / 1024, 1),
+        }
+    return results
+
+
+def wait_for_port(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def login_cookie(port: int) -> str:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    body = "&".join(f"{key}={value}" for key, value in ADMIN_CREDENTIALS.items())
+    conn.request("POST", "/admin/login", body, {"Content-Type": "application/x-www-form-urlencoded"})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader("Set-Cookie", "").split(";", 1)[0]
+    conn.close()
+    return cookie
+
+
+def drive(
+    port: int,
+    method: str,
+    path: str,
+    headers: dict,
+    concurrency: int,
+    duration: float,
+    body=None,
+    source=None,
+) -> dict:
+    # body and source may be callables, evaluated per request; source names
+    # the local address the next connection is made from.
+    samples: list[float] = []
+    errors = [0]
+    statuses: Counter = Counter()
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        local = []
+        while time.monotonic() < deadline:
+            if source is not None:
+                conn.close()
+                conn.source_address = (source(), 0)
+            payload = body() if callable(body) else body
+            started = time.perf_counter()
+            try:
+                conn.request(method, path, payload, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                with lock:
+                    statuses[response.status] += 1
+                if response.status >= 400:
+                    errors[0] += 1
+                if response.getheader("Connection", "").lower() == "close":
+                    conn.close()
+            except (OSError, http.client.HTTPException):
+                errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            local.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            samples.extend(local)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(samples),
+        "errors": errors[0],
+        "throughput_rps": round(len(samples) / elapsed, 2),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        **percentiles(samples),
+    }
+
+
+def loopback_sources(count: int = 1024):
+    # Linux routes all of 127/8 to loopback, so every attempt can come from
+    # its own client address and get past the per-IP login bucket. Where
+    # only 127.0.0.1 exists the flood is throttled per IP after 10 tries.
+    try:
+        with socket.socket() as probe:
+            probe.bind(("127.0.1.2", 0))
+    except OSError:
+        return None
+    addresses = itertools.cycle(f"127.0.{2 + n // 250}.{2 + n % 250}" for n in range(count))
+    lock = threading.Lock()
+
+    def source() -> str:
+        with lock:
+            return next(addresses)
+
+    return source
+
+
+def bench_login_flood(port: int, concurrency: int, duration: float) -> dict:
+    # Public-page latency while failed logins are hammered as fast as the
+    # server answers; compare with the plain main.top server scenario.
+    # Usernames and client addresses vary, so attempts reach the bounded
+    # password-hash pool (200 = hashed and rejected, 503 = pool full)
+    # instead of all being answered 429 by the rate limiter.
+    attempts = itertools.count()
+    flood_headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    flood = {}
+    flooder = threading.Thread(
+        target=lambda: flood.update(
+            drive(
+                port,
+                "POST",
+                "/admin/login",
+                flood_headers,
+                concurrency,
+                duration,
+                lambda: f"username=flood-{next(attempts)}&password=wrong-password",
+                loopback_sources(),
+            )
+        )
+    )
+    flooder.start()
+    stats = drive(port, "GET", "/", {}, max(1, concurrency // 4), duration)
+    flooder.join()
+    stats["flood_rps"] = flood.get("throughput_rps", 0.0)
+    stats["flood_statuses"] = flood.get("statuses", {})
+    return stats
+
+
+def bench_server(db_path: Path, scenarios: list, workers: int, concurrency: int, duration: float, port: int) -> dict:
+    env = dict(os.environ, SITE_DB_PATH=str(db_path))
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "flask", "--app", "app", "serve",
+            "--port", str(port), "--workers", str(workers), "--no-watch",
+        ],
+        cwd=REPO_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        cookie = login_cookie(port)
+        results = {}
+        for name, method, path in scenarios:
+            if method != "GET":
+                continue
+            headers = {"Cookie": cookie} if name.startswith("admin.") else {}
+            results[name] = drive(port, method, path, headers, concurrency, duration)
+        # Last, so the throttle state the flood leaves behind affects nothing else.
+        results["main.top:login-flood"] = bench_login_flood(port, concurrency, duration)
+        return results
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for suite, scenarios in results.get("suites", {}).items():
+        for name, current in scenarios.items():
+            previous = baseline.get("suites", {}).get(suite, {}).get(name)
+            if not previous:
+                continue
+            for metric in ("p95_ms", "p99_ms"):
+                if previous[metric] and current[metric] > previous[metric] * (1 + threshold):
+                    regressions.append(
+                        f"{suite}/{name}: {metric} {previous[metric]:.2f} -> {current[metric]:.2f}"
+                    )
+            if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - threshold):
+                regressions.append(
+                    f"{suite}/{name}: throughput {previous['throughput_rps']:.1f} -> {current['throughput_rps']:.1f} rps"
+                )
+    return regressions
+
+
+def over_budget(results: dict) -> list[str]:
+    # The budget is per request, so it is checked against the sequential
+    # test-client run; server latencies also include time spent queued
+    # behind the other connections.
+    return [
+        f"test_client/{name}: p99 {stats['p99_ms']:.2f} ms over the {SEARCH_P99_BUDGET_MS:.0f} ms search budget"
+        for name, stats in results.get("suites", {}).get("test_client", {}).items()
+        if name.split(":")[0].endswith(".search") and stats["p99_ms"] > SEARCH_P99_BUDGET_MS
+    ]
+
+
+def print_table(suite: str, scenarios: dict) -> None:
+    print(f"\n[{suite}]")
+    print(f"{'scenario':32} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'alloc KiB':>10}")
+    for name, stats in scenarios.items():
+        print(
+            f"{name:32} {stats['throughput_rps']:9.1f} {stats['p50_ms']:9.2f} "
+            f"{stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} {stats.get('peak_alloc_kib', ''):>10}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", type=Path, default=BENCH_DIR / "bench.db")
+    parser.add_argument("--announcements", type=int, default=20000)
+    parser.add_argument("--gallery", type=int, default=3000)
+    parser.add_argument("--features", type=int, default=300)
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per server scenario")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--skip-server", action="store_true")
+    parser.add_argument("--output", type=Path, default=BENCH_DIR / "results" / "latest.json")
+    parser.add_argument("--baseline", type=Path, default=BENCH_DIR / "baseline.json")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    for suffix in ("", "-wal", "-shm"):
+        Path(f"{args.db}{suffix}").unlink(missing_ok=True)
+    os.environ["SITE_DB_PATH"] = str(args.db)
+    sys.path.insert(0, str(REPO_DIR))
+    import app as site  # noqa: E402  (import after SITE_DB_PATH is set)
+
+    from benchmarks.seed import populate
+
+    with site.app.app_context():
+        populate(site, args.announcements, args.gallery, args.features)
+
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "dataset": {
+            "announcements": args.announcements,
+            "gallery": args.gallery,
+            "features": args.features,
+        },
+    }
+    scenarios = PUBLIC_SCENARIOS + ADMIN_SCENARIOS + paged_scenarios(site)
+    results["suites"] = {"test_client": bench_test_client(site, scenarios, args.iterations, args.warmup)}
+    if not args.skip_server:
+        results["suites"]["server"] = bench_server(
+            args.db, scenarios, args.workers, args.concurrency, args.duration, args.port
+        )
+
+    for suite, scenarios in results["suites"].items():
+        print_table(suite, scenarios)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(results, ensure_ascii=False, indent=2))
+    print(f"\nresults written to {args.output}")
+
+    regressions = over_budget(results)
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps(results, ensure_ascii=False, indent=2))
+        print(f"baseline updated: {args.baseline}")
+    elif not args.baseline.exists():
+        print("no baseline stored yet; run with --update-baseline to create one")
+    else:
+        regressions += compare(results, json.loads(args.baseline.read_text()), args.threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Populate a site.db with a realistic amount of synthetic content.
+
+The schema itself comes from the application's migrations; this module
+only bulk-inserts rows, so it must be given the already-imported ``app``
+module (which has created/migrated the database at SITE_DB_PATH).
+"""
+
+import random
+from datetime import datetime, timedelta
+
+WORDS = (
+    "季節", "ブレンド", "エスプレッソ", "ラテ", "焙煎", "シングルオリジン", "デザート",
+    "タルト", "ワークショップ", "ライブ", "限定", "新作", "モーニング", "テラス", "焼き菓子",
+    "ハンドドリップ", "カフェ", "おすすめ", "イベント", "ペアリング", "coffee", "brunch",
+)
+ICONS = ("fa-mug-hot", "fa-leaf", "fa-music", "fa-coffee", "fa-cookie-bite", "fa-seedling")
+GALLERY_FILES = tuple(f"/static/images/gallery{number}.svg" for number in (1, 2, 3))
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return "".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _gallery_rows(site, rng: random.Random, count: int, start: datetime):
+    # Ranked the way the app ranks them: every upload lands one
+    # GALLERY_RANK_STEP above the previous top, and a few images have since
+    # been dragged between two neighbours (the midpoint rank a reorder
+    # writes). Metadata is probed from the files, as uploads record it.
+    metadata = {}
+    for path in GALLERY_FILES:
+        source = site.gallery_file_source(path)
+        metadata[path] = (source and site.probe_image(source)) or (None,) * len(site.IMAGE_METADATA_COLUMNS)
+    created = sorted(
+        start + timedelta(minutes=rng.randrange(60 * 24 * 365 * 10)) for _ in range(count)
+    )
+    ranks = [-number * site.GALLERY_RANK_STEP for number in range(count)]
+    for _ in range(count // 20):
+        moved, target = rng.randrange(count), rng.randrange(1, count)
+        ranks[moved] = ranks[target] + site.GALLERY_RANK_STEP // 2
+    for created_at, rank in zip(created, ranks):
+        path = rng.choice(GALLERY_FILES)
+        yield (path, _sentence(rng, 2), rank, created_at.isoformat(), "ready", *metadata[path])
+
+
+def populate(site, announcements: int, gallery: int, features: int, seed: int = 42) -> None:
+    rng = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    conn = site.get_db_connection()
+    with site.write_transaction():
+        conn.execute("DELETE FROM announcements")
+        conn.execute("DELETE FROM gallery_images")
+        conn.execute("DELETE FROM features")
+        conn.executemany(
+            "INSERT INTO announcements (title, content, published_at) VALUES (?, ?, ?)",
+            (
+                (
+                    _sentence(rng, 3),
+                    _sentence(rng, 30),
+                    (start + timedelta(hours=rng.randrange(24 * 365 * 10))).isoformat(),
+                )
+                for _ in range(announcements)
+            ),
+        )
+        columns = ("file_path", "caption", "display_order", "created_at", "status", *site.IMAGE_METADATA_COLUMNS)
+        conn.executemany(
+            f"INSERT INTO gallery_images ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            _gallery_rows(site, rng, gallery, start),
+        )
+        conn.executemany(
+            "INSERT INTO features (title, description, icon) VALUES (?, ?, ?)",
+            (
+                (_sentence(rng, 2), _sentence(rng, 12), rng.choice(ICONS))
+                for _ in range(features)
+            ),
+        )
+        for scope in ("announcements", "gallery_images", "features"):
+            site.bump_generation(conn, scope)
+    conn.execute("ANALYZE")
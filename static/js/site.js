@@ -10,12 +10,49 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    window.addEventListener('load', () => {
-        setTimeout(() => {
-            if (loader) {
-                loader.classList.add('hide');
+    if (loader) {
+        // Lift the loader once the web fonts and the hero image are ready to
+        // paint, rather than after every image on the page has loaded.
+        const hero = document.querySelector('.hero, .page-hero');
+        const heroUrl = hero && /url\(["']?(.+?)["']?\)/.exec(hero.style.backgroundImage);
+        const waits = [document.fonts ? document.fonts.ready : Promise.resolve()];
+        if (heroUrl) {
+            const image = new Image();
+            image.src = heroUrl[1];
+            waits.push(image.decode().catch(() => {}));
+        }
+        const timeout = new Promise(resolve => setTimeout(resolve, 3000));
+        Promise.race([Promise.all(waits), timeout]).then(() => loader.classList.add('hide'));
+    }
+
+    document.querySelectorAll('[data-load-more]').forEach(link => {
+        link.addEventListener('click', async event => {
+            const list = document.querySelector(link.dataset.loadMore);
+            if (!list || !window.fetch) {
+                return;
             }
-        }, 600);
+            event.preventDefault();
+            link.classList.add('loading');
+            try {
+                const response = await fetch(link.href, { headers: { Accept: 'text/html' } });
+                const page = new DOMParser().parseFromString(await response.text(), 'text/html');
+                const nextList = page.querySelector(link.dataset.loadMore);
+                const nextLink = page.querySelector(`[data-load-more="${link.dataset.loadMore}"]`);
+                if (nextList) {
+                    nextList.querySelectorAll('[data-animate]').forEach(el => el.classList.add('in-view'));
+                    list.append(...nextList.children);
+                }
+                if (nextLink) {
+                    link.href = nextLink.href;
+                } else {
+                    link.parentElement.remove();
+                }
+            } catch (error) {
+                window.location.href = link.href;
+            } finally {
+                link.classList.remove('loading');
+            }
+        });
     });
 
     if (!prefersReducedMotion) {